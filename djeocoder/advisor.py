@@ -0,0 +1,296 @@
+"""
+Checks the plans of the queries that the searchers make, against a
+database loaded with the OpenBlock tables (a local, throwaway one: every
+query is run, with EXPLAIN ANALYZE):
+
+    python advisor.py --dsn 'dbname=openblock_test' [--samples 3] [--save plans.json | --baseline plans.json]
+
+Each shape of query that PostgisBlockSearcher and PostgisIntersectionSearcher
+can make (each combination of their optional filters) is run with
+EXPLAIN (ANALYZE, BUFFERS), with its parameters taken from a sample of rows of
+the table. Shapes whose plans scan blocks or intersections sequentially, or
+have a node costing more than --max-cost, are reported, followed by the
+CREATE INDEX statements that would serve the sequential scans.
+
+With --baseline, each shape's plan is also compared with the one saved by an
+earlier run with --save, and reported as a regression if it now scans a
+table sequentially, or is estimated to cost more than --regression times as
+much. The exit status is 1 if anything was reported, so that a plan
+regression can fail a build before it's deployed.
+"""
+import re
+import sys
+import json
+import argparse
+from itertools import combinations
+
+from postgis import PostgisBlockSearcher, PostgisIntersectionSearcher, STREET_QUERY, INTERSECTION_FIELDS
+
+# The optional filters of PostgisBlockSearcher.search(), and the columns of
+# the blocks table that sample values for them (and for street) come from.
+BLOCK_FILTERS = ('pre_dir', 'suffix', 'post_dir', 'city', 'state', 'zip', 'number')
+BLOCK_SAMPLE_COLUMNS = {'street': 'street', 'pre_dir': 'predir', 'suffix': 'suffix', 'post_dir': 'postdir',
+                        'city': 'left_city', 'state': 'left_state', 'zip': 'left_zip', 'number': 'from_num'}
+
+# The filters of PostgisIntersectionSearcher.search() besides the two
+# streets, which the geocoders always give. Their sample values come from
+# the intersections columns of the same names.
+INTERSECTION_FILTERS = tuple([field for field in INTERSECTION_FIELDS if not field.startswith('street_')])
+
+# The tables whose sequential scans are reported.
+TABLES = ('blocks', 'intersections')
+
+class Shape(object):
+    """
+    A shape of query: name describes it, fields are the filters it needs
+    sample values for (from rows of table), queries(samples) returns the
+    (query, params) pairs to run for a list of dicts of sample values, and
+    indexes are the column lists of the indexes that would serve it.
+    """
+    def __init__(self, name, table, fields, queries, indexes):
+        self.name = name
+        self.table = table
+        self.fields = fields
+        self.queries = queries
+        self.indexes = indexes
+
+    def sample_columns(self):
+        if self.table == 'blocks':
+            return [BLOCK_SAMPLE_COLUMNS[field] for field in self.fields]
+        return list(self.fields)
+
+def _each(build):
+    return lambda samples: [build(values) for values in samples]
+
+def query_shapes(street_pair_key=False):
+    """
+    Returns the Shapes of every query the searchers can make, including
+    those of the street pair key (see migrations.py) if street_pair_key.
+    """
+    blocks = PostgisBlockSearcher(None)
+    shapes = [Shape('fetch_street(street)', 'blocks', ('street',),
+                    _each(lambda values: (STREET_QUERY, (values['street'],))), [('street',)])]
+    for n in range(len(BLOCK_FILTERS) + 1):
+        for filters in combinations(BLOCK_FILTERS, n):
+            fields = ('street',) + filters
+            columns = ['street'] + [BLOCK_SAMPLE_COLUMNS[f] for f in filters if f in ('pre_dir', 'suffix', 'post_dir')]
+            if 'number' in filters:
+                columns.append('from_num')
+            shapes.append(Shape('search(%s)' % ', '.join(fields), 'blocks', fields,
+                                _each(lambda values: blocks._block_query(**values)), [tuple(columns)]))
+
+    modes = [False]
+    if street_pair_key:
+        modes.append(True)
+    for keyed in modes:
+        searcher = PostgisIntersectionSearcher(None, street_pair_key=keyed)
+        # The OR of the unkeyed query can only be served by a BitmapOr of an
+        # index on each side.
+        indexes = keyed and [('street_lo', 'street_hi')] or [('street_a',), ('street_b',)]
+        mode = keyed and ', street_pair_key' or ''
+        for n in range(len(INTERSECTION_FILTERS) + 1):
+            for filters in combinations(INTERSECTION_FILTERS, n):
+                fields = ('street_a', 'street_b') + filters
+                shapes.append(Shape('intersection search(%s%s)' % (', '.join(fields), mode), 'intersections', fields,
+                                    _each(lambda values, searcher=searcher: searcher._intersection_query(**values)), indexes))
+        shapes.append(Shape('search_pairs(street_a, street_b%s)' % mode, 'intersections', ('street_a', 'street_b'),
+                            lambda samples, searcher=searcher: [searcher._pairs_query(samples)], indexes))
+    return shapes
+
+def sample(cursor, shape, count):
+    """
+    Returns up to count dicts of values for shape's fields, from random rows
+    of its table that have all of them.
+    """
+    columns = shape.sample_columns()
+    cursor.execute('SELECT %s FROM %s WHERE %s ORDER BY random() LIMIT %%s' % (
+        ', '.join(columns), shape.table, ' AND '.join(["coalesce(%s::text, '') <> ''" % column for column in columns])),
+        (count,))
+    return [dict(zip(shape.fields, row)) for row in cursor.fetchall()]
+
+def explain(cursor, query, params):
+    """
+    Runs query with EXPLAIN (ANALYZE, BUFFERS), returning its plan (the
+    object that FORMAT JSON gives for the statement).
+    """
+    cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return plan[0]
+
+def plan_nodes(node):
+    yield node
+    for child in node.get('Plans', ()):
+        for descendant in plan_nodes(child):
+            yield descendant
+
+def plan_summary(plan, max_cost):
+    """
+    Returns a dict summarizing a plan from explain(): its estimated cost,
+    actual time (in ms) and shared buffers touched, the tables it scans
+    sequentially, and the nodes that cost more than max_cost when none of
+    their children do.
+    """
+    summary = {'cost': plan['Plan']['Total Cost'], 'time': plan['Plan'].get('Actual Total Time', 0.0),
+               'buffers': 0, 'seq_scans': [], 'costly': []}
+    for node in plan_nodes(plan['Plan']):
+        summary['buffers'] += node.get('Shared Hit Blocks', 0) + node.get('Shared Read Blocks', 0)
+        if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in TABLES:
+            if node['Relation Name'] not in summary['seq_scans']:
+                summary['seq_scans'].append(node['Relation Name'])
+        if node['Total Cost'] > max_cost and not [child for child in node.get('Plans', ()) if child['Total Cost'] > max_cost]:
+            summary['costly'].append('%s (cost %.0f)' % (node['Node Type'], node['Total Cost']))
+    return summary
+
+def merge_summaries(summaries):
+    """
+    Combines the summaries of one shape's samples: the worst cost and time,
+    the most buffers, and every sequential scan and costly node.
+    """
+    merged = {'cost': 0.0, 'time': 0.0, 'buffers': 0, 'seq_scans': [], 'costly': []}
+    for summary in summaries:
+        for key in ('cost', 'time', 'buffers'):
+            merged[key] = max(merged[key], summary[key])
+        for key in ('seq_scans', 'costly'):
+            merged[key].extend([item for item in summary[key] if item not in merged[key]])
+    return merged
+
+def existing_indexes(cursor, table):
+    """
+    Returns the column lists of the indexes on table.
+    """
+    cursor.execute('SELECT indexdef FROM pg_indexes WHERE tablename=%s', (table,))
+    indexes = []
+    for (indexdef,) in cursor.fetchall():
+        matcher = re.search(r'\((.*)\)', indexdef)
+        if matcher:
+            indexes.append(tuple([column.strip() for column in matcher.group(1).split(',')]))
+    return indexes
+
+def recommend(shapes, summaries, existing):
+    """
+    Returns the CREATE INDEX statements for the indexes that would serve the
+    shapes whose plans scan their table sequentially, leaving out those
+    that an existing index (or another recommended one) begins with the
+    columns of. existing is a dict of table to existing_indexes().
+    """
+    wanted = []
+    for shape in shapes:
+        summary = summaries.get(shape.name)
+        if summary is None or shape.table not in summary['seq_scans']:
+            continue
+        for columns in shape.indexes:
+            if (shape.table, columns) not in wanted:
+                wanted.append((shape.table, columns))
+
+    statements = []
+    for table, columns in wanted:
+        if [ex for ex in existing.get(table, ()) if ex[:len(columns)] == columns]:
+            continue
+        if [other for t, other in wanted if t == table and other != columns and other[:len(columns)] == columns]:
+            continue
+        statements.append('CREATE INDEX %s_%s_idx ON %s (%s);' % (table, '_'.join(columns), table, ', '.join(columns)))
+    return statements
+
+def regressions(baseline, summaries, factor):
+    """
+    Returns (shape name, description) pairs for the shapes whose plans have
+    got worse since the baseline (a dict of shape name to summary, as saved
+    with --save).
+    """
+    found = []
+    for name in sorted(summaries):
+        before, now = baseline.get(name), summaries[name]
+        if before is None:
+            continue
+        for table in now['seq_scans']:
+            if table not in before['seq_scans']:
+                found.append((name, 'now scans %s sequentially' % table))
+        if before['cost'] and now['cost'] > factor * before['cost']:
+            found.append((name, 'estimated cost rose from %.1f to %.1f' % (before['cost'], now['cost'])))
+    return found
+
+def has_street_pair_key(cursor):
+    cursor.execute("SELECT 1 FROM information_schema.columns WHERE table_name='intersections' AND column_name='street_lo'")
+    return bool(cursor.fetchall())
+
+def advise(conn, samples=3, max_cost=1000.0):
+    """
+    Explains every query shape, returning the list of Shapes, a dict of
+    shape name to merged plan_summary() (for the shapes that found sample
+    rows), and a dict of table to existing_indexes().
+    """
+    cursor = conn.cursor()
+    try:
+        shapes = query_shapes(has_street_pair_key(cursor))
+        summaries = {}
+        for shape in shapes:
+            values = sample(cursor, shape, samples)
+            if not values:
+                continue
+            summaries[shape.name] = merge_summaries([plan_summary(explain(cursor, query, params), max_cost)
+                                                     for query, params in shape.queries(values)])
+        existing = dict([(table, existing_indexes(cursor, table)) for table in TABLES])
+    finally:
+        cursor.close()
+        conn.rollback()
+    return shapes, summaries, existing
+
+def report(out, shapes, summaries, existing, found=()):
+    """
+    Writes the findings to out, returning whether there were any.
+    """
+    flagged = False
+    for shape in shapes:
+        summary = summaries.get(shape.name)
+        if summary is None or not (summary['seq_scans'] or summary['costly']):
+            continue
+        flagged = True
+        problems = ['seq scan on %s' % table for table in summary['seq_scans']] + summary['costly']
+        out.write('%s: cost %.1f, %.2f ms, %d buffers: %s\n' % (
+            shape.name, summary['cost'], summary['time'], summary['buffers'], '; '.join(problems)))
+    for name, description in found:
+        flagged = True
+        out.write('REGRESSION %s: %s\n' % (name, description))
+    statements = recommend(shapes, summaries, existing)
+    if statements:
+        out.write('\nRecommended indexes:\n')
+        for statement in statements:
+            out.write('    %s\n' % statement)
+    return flagged
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python advisor.py', description='Explain the searchers\' queries and recommend indexes.')
+    parser.add_argument('--dsn', default='dbname=openblock', help='psycopg2 connection string (of a throwaway database)')
+    parser.add_argument('--samples', type=int, default=3, help='sample rows to run each query shape with')
+    parser.add_argument('--max-cost', type=float, default=1000.0, help='estimated cost above which a plan node is reported')
+    parser.add_argument('--save', help='file to save the plan summaries to, as a baseline')
+    parser.add_argument('--baseline', help='file of plan summaries saved by an earlier run to compare with')
+    parser.add_argument('--regression', type=float, default=2.0, help='cost increase over the baseline reported as a regression')
+    args = parser.parse_args(argv)
+
+    import psycopg2
+    conn = psycopg2.connect(args.dsn)
+    try:
+        shapes, summaries, existing = advise(conn, args.samples, args.max_cost)
+    finally:
+        conn.close()
+
+    found = []
+    if args.baseline:
+        f = open(args.baseline)
+        try:
+            found = regressions(json.load(f), summaries, args.regression)
+        finally:
+            f.close()
+    if args.save:
+        f = open(args.save, 'w')
+        try:
+            json.dump(summaries, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+    return report(sys.stdout, shapes, summaries, existing, found) and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,451 @@
+"""
+Geocoding without blocking the caller.
+
+    geocoder = AsyncGeocoder(ThreadPoolBackend(ConnectionPool(connect, max_size=8), workers=8),
+                             max_concurrency=64, timeout=2.0)
+    future = geocoder.geocode('228 S BROADWAY AVE')
+    future.add_done_callback(respond)     # or: result = future.get()
+
+AsyncGeocoder.geocode() parses the location in the calling thread, and hands
+each block or intersection lookup to a backend, which calls back when it's
+done; it returns a Future straight away. The geocoding logic is LocalGeocoder's
+own: PostgisAddressGeocoder and PostgisIntersectionGeocoder are written as
+generator coroutines that yield the lookups they need, which geocode() answers
+through the backend rather than by querying the database itself.
+
+This package runs on Python 2, which has neither asyncio nor async/await;
+Futures here are thread-safe, so an event loop can wait on one by adding a
+done callback that wakes it.
+"""
+import time
+import heapq
+import logging
+import threading
+from collections import deque
+from itertools import count, izip
+from multiprocessing.pool import ThreadPool
+
+from parser.parsing import normalize, ParsingError
+from djeocoder import GeocoderException, Return, PostgisAddressGeocoder, PostgisIntersectionGeocoder, intersection_re
+from postgis import PostgisBlockSearcher, PostgisIntersectionSearcher, SpellingCorrector
+
+log = logging.getLogger(__name__)
+
+class GeocodeTimeout(GeocoderException):
+    def __init__(self, msg):
+        GeocoderException.__init__(self, msg)
+
+class Future(object):
+    """
+    The eventual result of an AsyncGeocoder call. It's done once the call
+    returns a result or raises an error.
+    """
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.isSet()
+
+    def get(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever, if it's None) for the call to
+        finish, and returns its result or raises its error. Raises
+        GeocodeTimeout if it doesn't finish in time.
+        """
+        if not self._done.wait(timeout):
+            raise GeocodeTimeout('Geocoding took more than %s seconds' % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def add_done_callback(self, fn):
+        """
+        Arranges for fn to be called with this Future when it's done -- right
+        away, if it already is. It may be called from a backend thread.
+        """
+        self._lock.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        fn(self)
+
+    def _finish(self, result=None, error=None):
+        self._lock.acquire()
+        try:
+            self.result = result
+            self.error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for fn in callbacks:
+            # One failing callback mustn't keep the rest from running, nor
+            # kill the backend thread that finished this Future.
+            try:
+                fn(self)
+            except Exception:
+                log.exception('Exception in Future callback %r', fn)
+
+class GeocoderBackend(object):
+    """
+    Runs the database lookups of an AsyncGeocoder. Each method starts a
+    lookup with the arguments of the Postgis searcher method of the same
+    name -- the keyword arguments of PostgisBlockSearcher.search(), or the
+    list of PostgisIntersectionSearcher.search_pairs() -- and arranges for
+    callback(results, error) to be called when it's done, from any thread.
+    """
+    def search_blocks(self, filters, callback):
+        raise NotImplementedError()
+
+    def search_pairs(self, pairs, callback):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+def _call(func, args, kwargs):
+    try:
+        return func(*args, **kwargs), None
+    except Exception, e:
+        return None, e
+
+class ThreadPoolBackend(GeocoderBackend):
+    """
+    Runs lookups with PostgisBlockSearcher and PostgisIntersectionSearcher
+    on a pool of threads. cxn should be a pool.ConnectionPool with room for
+    as many connections as there are workers. street_pair_key is as for
+    PostgisIntersectionSearcher.
+    """
+    def __init__(self, cxn, workers=4, street_pair_key=False):
+        self.cxn = cxn
+        self.street_pair_key = street_pair_key
+        self.threads = ThreadPool(workers)
+
+    def _submit(self, func, args, kwargs, callback):
+        def deliver(outcome):
+            # Runs on the ThreadPool's result handler thread, which an
+            # exception would kill, leaving every later lookup unanswered.
+            try:
+                callback(*outcome)
+            except Exception:
+                log.exception('Exception in lookup callback %r', callback)
+        self.threads.apply_async(_call, (func, args, kwargs), callback=deliver)
+
+    def search_blocks(self, filters, callback):
+        self._submit(PostgisBlockSearcher(self.cxn).search, (), filters, callback)
+
+    def search_pairs(self, pairs, callback):
+        searcher = PostgisIntersectionSearcher(self.cxn, street_pair_key=self.street_pair_key)
+        self._submit(searcher.search_pairs, (pairs,), {}, callback)
+
+    def close(self):
+        self.threads.close()
+        self.threads.join()
+
+class MemoryBackend(GeocoderBackend):
+    """
+    Answers lookups, as soon as they're made, from a dict of street name to
+    BlockResults and a dict of frozenset([street_a, street_b]) to
+    IntersectionResults. Only the street names and house number are matched.
+    """
+    def __init__(self, blocks=None, intersections=None):
+        self.blocks = blocks or {}
+        self.intersections = intersections or {}
+        self.lookups = 0
+
+    def search_blocks(self, filters, callback):
+        self.lookups += 1
+        blocks = self.blocks.get(filters['street'], [])
+        if filters.get('number'):
+            number = int(filters['number'])
+            blocks = [block for block in blocks if block.contains_number(number)[0]]
+        callback(blocks, None)
+
+    def search_pairs(self, pairs, callback):
+        self.lookups += 1
+        callback([self.intersections.get(frozenset([pair['street_a'], pair['street_b']]), []) for pair in pairs], None)
+
+class _Timers(object):
+    """
+    Calls functions at given times, from a single daemon thread, which is
+    started with the first of them.
+    """
+    def __init__(self):
+        self.heap = [] # [when, sequence number, function or None if cancelled]
+        self.sequence = count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def call_at(self, when, fn):
+        """
+        Arranges for fn() to be called at when (a time.time()), returning a
+        handle for cancel().
+        """
+        timer = [when, self.sequence.next(), fn]
+        self.condition.acquire()
+        try:
+            heapq.heappush(self.heap, timer)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='AsyncGeocoder timers')
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        return timer
+
+    def cancel(self, timer):
+        # Left in the heap until it's due, and skipped then.
+        timer[2] = None
+
+    def _run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.heap or self.heap[0][0] > time.time():
+                    if self.heap:
+                        self.condition.wait(max(self.heap[0][0] - time.time(), 0))
+                    else:
+                        self.condition.wait()
+                when, sequence, fn = heapq.heappop(self.heap)
+            finally:
+                self.condition.release()
+            if fn is not None:
+                try:
+                    fn()
+                except Exception:
+                    log.exception('Exception in timer %r', fn)
+
+def _converted(callback, convert):
+    # Wraps a lookup callback to pass it convert(results) rather than results.
+    def converted(results, error):
+        if error is None:
+            try:
+                results = convert(results)
+            except Exception, e:
+                results, error = None, e
+        callback(results, error)
+    return converted
+
+class _Task(object):
+    """
+    Drives a geocoding coroutine (see PostgisAddressGeocoder._geocoding()):
+    starts each lookup it yields, and resumes it with the outcome.
+
+    The task finishes its Future, and frees its concurrency slot, exactly
+    once: when the coroutine ends, or at the deadline, whichever comes first.
+    The outcome of a lookup that's still running at the deadline is ignored.
+    """
+    def __init__(self, geocoder, coroutine, future, deadline):
+        self.geocoder = geocoder
+        self.coroutine = coroutine
+        self.future = future
+        self.deadline = deadline
+        self.timer = None
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.deadline is not None:
+            self.timer = self.geocoder.timers.call_at(self.deadline, self._expire)
+        self._run(None, None)
+
+    def _expire(self):
+        self._finish(error=GeocodeTimeout('Geocoding took more than %s seconds' % self.geocoder.timeout))
+
+    def _run(self, value, error):
+        while True:
+            if self.finished:
+                return
+            if self.deadline is not None and time.time() > self.deadline:
+                return self._expire()
+            try:
+                if error is not None:
+                    request = self.coroutine.throw(error)
+                else:
+                    request = self.coroutine.send(value)
+            except Return, r:
+                return self._finish(result=r.value)
+            except StopIteration:
+                return self._finish()
+            except Exception, e:
+                return self._finish(error=e)
+
+            self.answered = False
+            self.starting = True
+            try:
+                self.geocoder._start_lookup(request, self._callback)
+            except Exception, e:
+                # A lookup the backend can't start (say, its ThreadPool is
+                # closed) fails as if it had called back with the error,
+                # so the coroutine still finishes and frees its slot.
+                self._callback(None, e)
+
+            self.lock.acquire()
+            try:
+                self.starting = False
+                if not self.answered:
+                    # The callback resumes the coroutine.
+                    return
+            finally:
+                self.lock.release()
+            # The lookup finished while it was being started (as with
+            # MemoryBackend), so carry on here rather than recursing.
+            value, error = self.value, self.error
+
+    def _callback(self, results, error):
+        self.lock.acquire()
+        try:
+            if self.finished:
+                return
+            self.value, self.error = results, error
+            self.answered = True
+            resume = not self.starting
+        finally:
+            self.lock.release()
+        if resume:
+            self._run(results, error)
+
+    def _finish(self, result=None, error=None):
+        self.lock.acquire()
+        try:
+            if self.finished:
+                return
+            self.finished = True
+        finally:
+            self.lock.release()
+        if self.timer is not None:
+            self.geocoder.timers.cancel(self.timer)
+        try:
+            self.future._finish(result, error)
+        finally:
+            self.geocoder._task_finished()
+
+class AsyncGeocoder(object):
+    """
+    Geocodes like LocalGeocoder, but returns Futures, running its lookups on
+    a GeocoderBackend.
+
+    At most max_concurrency geocode() calls run at once; later calls wait
+    their turn. A call that takes longer than timeout seconds (if it's not
+    None), counting from when it was made, raises GeocodeTimeout and frees
+    its place; a lookup that's already started is left to finish, and its
+    outcome ignored, so it's the backend (such as the workers of a
+    ThreadPoolBackend) that bounds how many lookups a slow database sees.
+
+    spelling is the postgis.SpellingCorrector that misspelled streets are
+    corrected with, as for LocalGeocoder.
+    """
+    def __init__(self, backend, max_concurrency=16, timeout=None, spelling=None):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.spelling = spelling or SpellingCorrector()
+        # Their _geocoding() coroutines, and the methods that turn lookups'
+        # outcomes into results; they never query the database themselves.
+        self.addresses = PostgisAddressGeocoder(None, spelling=self.spelling)
+        self.intersections = PostgisIntersectionGeocoder(None, spelling=self.spelling)
+        self.timers = _Timers()
+        self.running = 0
+        self.waiting = deque()
+        self.lock = threading.Lock()
+
+    def geocode(self, location):
+        """
+        Returns a Future of the PostgisResult for location.
+        """
+        future = Future()
+        if intersection_re.search(location):
+            coroutine = self.intersections._geocoding(location)
+        else:
+            # Including blocks: LocalGeocoder gives those to
+            # PostgisBlockGeocoder, which geocodes them as addresses.
+            coroutine = self.addresses._geocoding(location)
+
+        self.lock.acquire()
+        try:
+            if self.running >= self.max_concurrency:
+                self.waiting.append((coroutine, future, time.time()))
+                return future
+            self.running += 1
+        finally:
+            self.lock.release()
+        self._start(coroutine, future, time.time())
+        return future
+
+    def geocode_many(self, locations):
+        """
+        Returns a Future of a list of (result, error) pairs for the given
+        locations, as LocalGeocoder.geocode_many() returns, geocoding each
+        normalized form once. Errors other than GeocoderException and
+        ParsingError (such as a failed query) fail the whole list.
+        """
+        future = Future()
+        keys = [(bool(intersection_re.search(location)), normalize(location)) for location in locations]
+        unique = {}
+        for key, location in izip(keys, locations):
+            if key not in unique:
+                unique[key] = location
+        if not unique:
+            future._finish([])
+            return future
+
+        outcomes = {}
+        lock = threading.Lock()
+        def done(key):
+            def callback(f):
+                lock.acquire()
+                try:
+                    outcomes[key] = f
+                    finished = len(outcomes) == len(unique)
+                finally:
+                    lock.release()
+                if finished:
+                    for f in outcomes.values():
+                        if f.error is not None and not isinstance(f.error, (GeocoderException, ParsingError)):
+                            return future._finish(error=f.error)
+                    future._finish([(outcomes[k].result, outcomes[k].error) for k in keys])
+            return callback
+        for key, location in unique.items():
+            self.geocode(location).add_done_callback(done(key))
+        return future
+
+    def close(self):
+        self.backend.close()
+
+    def _start(self, coroutine, future, started):
+        deadline = self.timeout is not None and started + self.timeout or None
+        _Task(self, coroutine, future, deadline).start()
+
+    def _task_finished(self):
+        self.lock.acquire()
+        try:
+            if not self.waiting:
+                self.running -= 1
+                return
+            coroutine, future, started = self.waiting.popleft()
+        finally:
+            self.lock.release()
+        self._start(coroutine, future, started)
+
+    def _start_lookup(self, request, callback):
+        # Starts a lookup that a _geocoding() coroutine yielded on the
+        # backend, which calls back with what the coroutine expects.
+        if request[0] == 'addresses':
+            location = request[1]
+            if not location['number']:
+                return callback([], None)
+            build = lambda blocks: [self.addresses._build_result(location, block) for block in blocks]
+            self.backend.search_blocks(dict(location.items()), _converted(callback, build))
+        elif request[0] == 'street':
+            self.backend.search_blocks(request[1], callback)
+        else:
+            filters = self.intersections._pair_filters(request[1])
+            self.backend.search_pairs(filters, _converted(callback, lambda found: self.intersections._pair_results(filters, found)))
@@ -0,0 +1,176 @@
+"""
+Type-ahead completion of street names, answered from memory rather than
+the blocks table.
+
+    streets = StreetAutocomplete.from_connection(cxn)
+    streets.complete('s broadw')    # ['S BROADWAY AVE', ...]
+
+Each street (a distinct predir, street, suffix and postdir in the blocks
+table) is named in its standard form, such as 'S BROADWAY AVE', and can be
+completed from that, from the street without its predir, or with its
+directionals spelled out or its suffix spelled any way that
+parser/suffixes.py knows ('SOUTH BROADWAY AVENUE'). The streets with the most
+blocks come first.
+
+The names are kept in a compressed prefix trie, each of whose nodes holds
+the top_k streets below it, so a completion walks at most one node per
+letter of the prefix and copies out a precomputed list.
+"""
+import heapq
+
+from parser.parsing import Normalizer, uppercase, remove_punctuation, standard_forms
+from pool import borrow
+from textfiles import BlockFileLoader
+
+def collapse_inner_whitespace(prefix):
+    """
+    Collapses whitespace like collapse_whitespace(), but keeps a single
+    trailing space, which marks a finished word.
+
+    >>> collapse_inner_whitespace('  S  BROADWAY  ')
+    'S BROADWAY '
+    """
+    collapsed = ' '.join(prefix.split())
+    if collapsed and prefix[-1:].isspace():
+        collapsed += ' '
+    return collapsed
+
+# Normalizes prefixes, and the names they're matched against.
+prefix_normalizer = Normalizer([uppercase, remove_punctuation, collapse_inner_whitespace])
+
+class _Node(object):
+    __slots__ = ('edges', 'entries', 'top')
+    def __init__(self):
+        self.edges = {} # first letter -> (label, node)
+        self.entries = [] # the streets whose names end here
+        self.top = ()
+
+class StreetAutocomplete(object):
+    """
+    Completes prefixes of street names; see the module docstring.
+
+    streets is a sequence of (predir, street, suffix, postdir, blocks) rows,
+    as in the blocks table (with None or '' for a missing part), each with
+    its number of blocks.
+    """
+    def __init__(self, streets, top_k=10):
+        self.top_k = top_k
+        blocks = {}
+        for predir, street, suffix, postdir, count in streets:
+            parts = tuple([part and part.upper() or None for part in (predir, street, suffix, postdir)])
+            blocks[parts] = blocks.get(parts, 0) + count
+        # Ranked, so that a street's index is its rank: most blocks first,
+        # then alphabetically.
+        ranked = sorted(blocks.items(), key=lambda (parts, count): (-count, self._name(parts)))
+        self.names = [self._name(parts) for parts, count in ranked]
+        self.blocks = [count for parts, count in ranked]
+
+        self.root = _Node()
+        for rank, (parts, count) in enumerate(ranked):
+            for key in self._keys(parts):
+                self._insert(key, rank)
+        self._rank(self.root)
+
+    @classmethod
+    def from_connection(cls, conn, **kwargs):
+        """
+        Returns an autocomplete of the streets in the blocks table. conn is
+        either a connection or a pool.ConnectionPool.
+        """
+        with borrow(conn) as c:
+            cursor = c.cursor()
+            cursor.execute('select predir, street, suffix, postdir, count(*) from blocks group by predir, street, suffix, postdir')
+            rows = cursor.fetchall()
+            cursor.close()
+        return cls(rows, **kwargs)
+
+    @classmethod
+    def from_pipe_file(cls, filename, **kwargs):
+        """
+        Returns an autocomplete of the streets in a blocks pipe file, such as
+        blocks.txt.gz.
+        """
+        loader = BlockFileLoader(filename)
+        columns = [loader.columns[name] for name in ('predir', 'street', 'suffix', 'postdir')]
+        counts = {}
+        for row in loader.rows:
+            if len(row) > max(columns) and row[columns[1]]:
+                parts = tuple([row[column] for column in columns])
+                counts[parts] = counts.get(parts, 0) + 1
+        return cls([parts + (count,) for parts, count in counts.items()], **kwargs)
+
+    def complete(self, prefix, limit=None):
+        """
+        Returns the names of the streets (at most limit, and at most top_k)
+        that prefix begins the name of, most blocks first.
+        """
+        prefix = prefix_normalizer(prefix)
+        node = self.root
+        i = 0
+        while i < len(prefix):
+            edge = node.edges.get(prefix[i])
+            if edge is None:
+                return []
+            label, node = edge
+            if not label.startswith(prefix[i:i + len(label)]):
+                return []
+            i += len(label)
+        return [self.names[rank] for rank in node.top[:limit]]
+
+    def _name(self, parts):
+        return ' '.join([part for part in parts if part])
+
+    def _keys(self, parts):
+        # Every spelling of the street's name that it can be completed from.
+        predir, street, suffix, postdir = parts
+        predirs = [None]
+        if predir:
+            predirs.extend([predir, standard_forms('directionals').get(predir)])
+        suffixes = [suffix]
+        if suffix:
+            suffixes.extend(standard_forms('suffixes').get(suffix, ()))
+        postdirs = [postdir]
+        if postdir:
+            postdirs.append(standard_forms('directionals').get(postdir))
+        keys = set()
+        for p in predirs:
+            for s in suffixes:
+                for d in postdirs:
+                    keys.add(prefix_normalizer(self._name((p, street, s, d))))
+        return keys
+
+    def _insert(self, key, rank):
+        node = self.root
+        i = 0
+        while i < len(key):
+            edge = node.edges.get(key[i])
+            if edge is None:
+                child = _Node()
+                node.edges[key[i]] = (key[i:], child)
+                node = child
+                break
+            label, child = edge
+            n = 1
+            while n < len(label) and i + n < len(key) and label[n] == key[i + n]:
+                n += 1
+            if n < len(label):
+                # Split the edge where the key leaves it.
+                middle = _Node()
+                middle.edges[label[n]] = (label[n:], child)
+                node.edges[key[i]] = (label[:n], middle)
+                child = middle
+            node = child
+            i += n
+        node.entries.append(rank)
+
+    def _rank(self, node):
+        candidates = set(node.entries)
+        for label, child in node.edges.values():
+            self._rank(child)
+            candidates.update(child.top)
+        node.top = tuple(heapq.nsmallest(self.top_k, candidates))
+        node.entries = None
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
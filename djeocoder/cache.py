@@ -0,0 +1,341 @@
+"""
+A cache of geocoding results, to replace Openblock's GeocoderCache model.
+
+    cache = GeocoderCache('geocoder_cache.sqlite', ttl=7 * 24 * 3600)
+    geocoder = LocalGeocoder(cxn, cache=cache)
+
+Results are keyed on the normalized location string, so differently
+punctuated spellings of a location share an entry. Locations that can't be
+geocoded are cached too, with the exception they raised (if it's one of
+NEGATIVE_ERRORS), for a shorter negative_ttl, so that junk input is rejected
+without running every fallback again. Entries are kept in two tiers:
+an in-process LRU cache, and (if a filename is given) a SQLite file that
+outlives the process and can be shared by several. Every entry expires ttl
+seconds after it was stored, and the SQLite tier holds at most max_rows
+entries, dropping the least recently used (as of the last used_interval
+seconds, since hits only record when an entry was used once it's that old).
+
+When the blocks table is reloaded, invalidate_street() drops the entries
+for the streets that changed (or clear() drops everything).
+"""
+import json
+import time
+import sqlite3
+import threading
+
+from parser.lru import LRUCache
+from parser.parsing import normalize, parse, ParsingError
+from djeocoder import PostgisResult, DoesNotExist, InvalidBlockButValidStreet, AmbiguousResult, intersection_re
+
+def cache_key(location):
+    """
+    Returns the key that location is cached under: its normalized form,
+    marked with an '@' (which normalize() removes) if it's an intersection,
+    since normalize() may remove what separates the two streets.
+
+    >>> cache_key('228 S. Broadway') == cache_key('228 s broadway')
+    True
+    >>> cache_key('Damen / Diversey') == cache_key('Damen Diversey')
+    False
+    """
+    key = normalize(location)
+    if intersection_re.search(location):
+        return '@' + key
+    return key
+
+# The PostgisResult attributes that aren't stored in the SQLite tier, since
+# they hold searcher result objects rather than plain values; results from
+# the SQLite tier have them set to None.
+UNSTORED_FIELDS = ('block', 'intersection')
+
+def encode_result(result):
+    """
+    Returns a PostgisResult as JSON.
+    """
+    fields = dict([(k, v) for k, v in vars(result).items() if k not in UNSTORED_FIELDS])
+    return json.dumps(fields, sort_keys=True)
+
+def decode_result(data):
+    """
+    Returns the PostgisResult that encode_result() turned into data. JSON
+    floats round-trip exactly, so the point is unchanged.
+
+    >>> result = decode_result(encode_result(PostgisResult(address=u'228 S BROADWAY AVE', point=(-87.6245, 41.8756))))
+    >>> result.address, result.point, result.block
+    (u'228 S BROADWAY AVE', (-87.6245, 41.8756), None)
+    """
+    fields = dict([(k, None) for k in UNSTORED_FIELDS])
+    fields.update([(str(k), v) for k, v in json.loads(data).items()])
+    for k in ('point', 'streets'):
+        if isinstance(fields.get(k), list):
+            fields[k] = tuple(fields[k])
+    return PostgisResult(**fields)
+
+# The exceptions that mean a location can't be geocoded (rather than that
+# something went wrong geocoding it), and so are cached, by name.
+NEGATIVE_ERRORS = dict([(cls.__name__, cls) for cls in (ParsingError, DoesNotExist, InvalidBlockButValidStreet, AmbiguousResult)])
+
+def is_negative(error):
+    return NEGATIVE_ERRORS.get(error.__class__.__name__) is error.__class__
+
+def encode_error(error):
+    """
+    Returns one of the NEGATIVE_ERRORS as JSON: its message, and the choices
+    of an AmbiguousResult.
+    """
+    fields = {'message': str(error)}
+    if isinstance(error, AmbiguousResult):
+        fields['choices'] = [encode_result(choice) for choice in error.choices]
+    return json.dumps(fields, sort_keys=True)
+
+def decode_error(name, data):
+    """
+    Returns the exception that encode_error() turned into data.
+
+    >>> error = decode_error('DoesNotExist', encode_error(DoesNotExist('Nowhere')))
+    >>> error.__class__.__name__, str(error)
+    ('DoesNotExist', 'Nowhere')
+    """
+    cls = NEGATIVE_ERRORS[name]
+    fields = json.loads(data)
+    # Their constructors build the message, so bypass them.
+    error = cls.__new__(cls)
+    Exception.__init__(error, fields['message'].encode('utf-8'))
+    if 'choices' in fields:
+        error.choices = [decode_result(choice) for choice in fields['choices']]
+    return error
+
+def candidate_streets(location):
+    """
+    Returns the set of streets that location might be on (either side of it,
+    if it's an intersection), for invalidating the failures cached for it.
+
+    >>> sorted(candidate_streets('228 Broadway'))
+    ['228 BROADWAY', '228TH', 'BROADWAY']
+    """
+    streets = set()
+    for side in intersection_re.split(location):
+        try:
+            streets.update([loc['street'] for loc in parse(side) if loc['street']])
+        except ParsingError:
+            pass
+    return streets
+
+class GeocoderCache(object):
+    """
+    Caches the outcome of geocoding each location, in an LRU tier of at most
+    max_entries outcomes, and a SQLite tier of at most max_rows outcomes if
+    filename is given. Results expire after ttl seconds, and failures after
+    negative_ttl seconds (never, if it's None).
+
+    A hit in the SQLite tier only writes down when the entry was used (for
+    dropping the least recently used) if that was more than used_interval
+    seconds ago, so that most hits don't write to the file.
+    """
+    def __init__(self, filename=None, ttl=7 * 24 * 3600, negative_ttl=3600, max_entries=10000, max_rows=1000000,
+                 used_interval=3600, clock=time.time):
+        self.filename = filename
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_rows = max_rows
+        self.used_interval = used_interval
+        self.clock = clock
+        # key -> (expires, result, error, streets)
+        self.memory = LRUCache(max_entries)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.db = None
+        if filename is not None:
+            self.db = sqlite3.connect(filename, check_same_thread=False)
+            self.db.executescript("""
+                create table if not exists geocoder_cache (
+                    key text primary key,
+                    result text not null,
+                    expires real,
+                    used real not null
+                );
+                create index if not exists geocoder_cache_used on geocoder_cache (used);
+                create table if not exists geocoder_cache_streets (
+                    street text not null,
+                    key text not null
+                );
+                create index if not exists geocoder_cache_streets_street on geocoder_cache_streets (street);
+                create index if not exists geocoder_cache_streets_key on geocoder_cache_streets (key);
+            """)
+            # The name of the exception, for a failure (whose encode_error() is
+            # in the result column). Files written before failures were cached
+            # don't have it.
+            if 'error' not in [row[1] for row in self.db.execute('pragma table_info(geocoder_cache)')]:
+                self.db.execute('alter table geocoder_cache add column error text')
+            self.rows = self.db.execute('select count(*) from geocoder_cache').fetchone()[0]
+
+    def lookup(self, location):
+        """
+        Returns the outcome cached for location, as a (result, error) pair
+        where one of the two is None, or None if nothing is cached.
+        """
+        key = cache_key(location)
+        now = self.clock()
+        entry = self.memory.get(key)
+        if entry is not None:
+            expires, result, error, streets = entry
+            if expires is None or expires > now:
+                self._count_hit(error)
+                return result, error
+            self.memory.discard(key)
+
+        entry = None
+        if self.db is not None:
+            with self.lock:
+                row = self.db.execute('select result, error, expires, used from geocoder_cache where key=?', (key,)).fetchone()
+                if row is not None:
+                    data, name, expires, used = row
+                    if expires is None or expires > now:
+                        if used <= now - self.used_interval:
+                            self.db.execute('update geocoder_cache set used=? where key=?', (now, key))
+                            self.db.commit()
+                        streets = [street for (street,) in self.db.execute(
+                            'select street from geocoder_cache_streets where key=?', (key,))]
+                        if name is None:
+                            entry = (expires, decode_result(data), None, streets)
+                        else:
+                            entry = (expires, None, decode_error(name, data), streets)
+                    else:
+                        self._delete(key)
+                        self.expirations += 1
+                        self.db.commit()
+        if entry is None:
+            self._count_miss()
+            return None
+        self.memory.put(key, entry)
+        expires, result, error, streets = entry
+        self._count_hit(error)
+        return result, error
+
+    def get(self, location):
+        """
+        Returns the PostgisResult cached for location, or None if there's none
+        (or a failure is cached for it).
+        """
+        outcome = self.lookup(location)
+        if outcome is None:
+            return None
+        return outcome[0]
+
+    def put(self, location, result, ttl=None):
+        """
+        Caches result for location, for ttl seconds if it's given, or the
+        cache's ttl.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        self._put(location, result, None, getattr(result, 'streets', ()), ttl)
+
+    def put_error(self, location, error, ttl=None):
+        """
+        Caches the failure to geocode location with the given exception, for
+        ttl seconds if it's given, or the cache's negative_ttl. Exceptions
+        that aren't NEGATIVE_ERRORS (such as failed queries or timeouts) are
+        ignored, since the next attempt may well succeed.
+        """
+        if not is_negative(error):
+            return
+        if ttl is None:
+            ttl = self.negative_ttl
+        self._put(location, None, error, candidate_streets(location), ttl)
+
+    def _put(self, location, result, error, streets, ttl):
+        key = cache_key(location)
+        now = self.clock()
+        expires = ttl is not None and now + ttl or None
+        streets = tuple(set(streets))
+        self.memory.put(key, (expires, result, error, streets))
+        if self.db is None:
+            return
+        if error is None:
+            data, name = encode_result(result), None
+        else:
+            data, name = encode_error(error), error.__class__.__name__
+        with self.lock:
+            if not self.db.execute('update geocoder_cache set result=?, error=?, expires=?, used=? where key=?',
+                                   (data, name, expires, now, key)).rowcount:
+                self.db.execute('insert into geocoder_cache (key, result, error, expires, used) values (?, ?, ?, ?, ?)',
+                                (key, data, name, expires, now))
+                self.rows += 1
+            self.db.execute('delete from geocoder_cache_streets where key=?', (key,))
+            self.db.executemany('insert into geocoder_cache_streets (street, key) values (?, ?)',
+                                [(street, key) for street in streets])
+            if self.max_rows is not None and self.rows > self.max_rows:
+                for (oldest,) in self.db.execute('select key from geocoder_cache order by used limit ?',
+                                                 (self.rows - self.max_rows,)).fetchall():
+                    self._delete(oldest)
+            self.db.commit()
+
+    def invalidate_street(self, street):
+        """
+        Drops every cached result on the given street (as it's named in the
+        blocks table, such as 'BROADWAY'), and every failure for a location
+        that might be on it, returning how many there were in the SQLite tier
+        (or the LRU tier, if there's no SQLite tier).
+        """
+        dropped = self.memory.discard_matching(lambda key, entry: street in entry[3])
+        if self.db is None:
+            return dropped
+        with self.lock:
+            keys = self.db.execute('select distinct key from geocoder_cache_streets where street=?', (street,)).fetchall()
+            for (key,) in keys:
+                self._delete(key)
+            self.db.commit()
+        return len(keys)
+
+    def clear(self):
+        self.memory.clear()
+        if self.db is not None:
+            with self.lock:
+                self.db.execute('delete from geocoder_cache')
+                self.db.execute('delete from geocoder_cache_streets')
+                self.db.commit()
+                self.rows = 0
+
+    def stats(self):
+        """
+        Returns the overall counters of hits on results ('hits'), hits on
+        failures ('negative_hits') and misses, the number of entries found
+        expired in the SQLite tier, and the counters of the LRU tier.
+        """
+        with self.lock:
+            stats = {'hits': self.hits, 'negative_hits': self.negative_hits, 'misses': self.misses,
+                     'expirations': self.expirations}
+            if self.db is not None:
+                stats['rows'] = self.rows
+        stats['memory'] = self.memory.stats()
+        return stats
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def _delete(self, key):
+        # Called with the lock held.
+        if self.db.execute('delete from geocoder_cache where key=?', (key,)).rowcount:
+            self.rows -= 1
+        self.db.execute('delete from geocoder_cache_streets where key=?', (key,))
+
+    def _count_hit(self, error):
+        with self.lock:
+            if error is None:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+
+    def _count_miss(self):
+        with self.lock:
+            self.misses += 1
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,292 @@
+"""
+Bulk geocoding from the command line:
+
+    python -m djeocoder [options] [input file]
+
+Reads one location string per line from the input file (which may be
+gzipped) or from stdin, geocodes the lines in a pool of worker processes that
+each hold their own database connection, and writes one tab-separated row per
+input line, in input order:
+
+    line number, location, status, address, city, state, zip, x, y
+
+The status is 'OK', or the name of the exception that geocoding the line
+raised. With --checkpoint, the number of input lines written so far, and the
+size of the output file then, are saved after every batch, so that an
+interrupted run can be continued with --resume. Resuming cuts the output
+back to that size first, dropping any rows written after the last
+checkpoint; output to stdout can't be cut back, so a resumed run may repeat
+the last batch's rows there (which the line numbers tell apart).
+"""
+import os
+import sys
+import gzip
+import time
+import argparse
+import multiprocessing
+from collections import deque
+from itertools import izip
+
+import psycopg2
+
+from djeocoder import LocalGeocoder
+from pool import ConnectionPool
+
+# The LocalGeocoder of this worker process, created by init_worker().
+_geocoder = None
+
+def init_worker(dsn):
+    global _geocoder
+    _geocoder = LocalGeocoder(psycopg2.connect(dsn))
+
+def _field(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\t', ' ')
+
+def format_row(offset, location, result=None, error=None):
+    """
+    Formats an output row for a geocoded line: either its PostgisResult, or
+    the exception raised while geocoding it.
+    """
+    if error is not None:
+        fields = [offset, location, error.__class__.__name__, None, None, None, None, None, None]
+    else:
+        x, y = result.point
+        fields = [offset, location, 'OK', result.address, result.city, result.state, result.zip, '%.6f' % x, '%.6f' % y]
+    return '\t'.join([_field(f) for f in fields])
+
+def geocode_batch(batch, geocoder=None):
+    """
+    Geocodes a list of (line number, location) pairs with the worker's
+    geocoder, returning their formatted output rows.
+    """
+    if geocoder is None:
+        geocoder = _geocoder
+    try:
+        outcomes = geocoder.geocode_many([location for offset, location in batch])
+    except Exception, e:
+        # Something went wrong other than a location not geocoding, like a
+        # failed query: geocode the lines one at a time instead, so that it
+        # only costs the line that caused it.
+        if isinstance(e, psycopg2.Error) and not isinstance(geocoder.cxn, ConnectionPool):
+            geocoder.cxn.rollback()
+        return geocode_each(batch, geocoder)
+    return [format_row(offset, location, result, error) for (offset, location), (result, error) in izip(batch, outcomes)]
+
+def geocode_each(batch, geocoder):
+    rows = []
+    for offset, location in batch:
+        try:
+            rows.append(format_row(offset, location, result=geocoder.geocode(location)))
+        except psycopg2.Error, e:
+            # Don't let a failed query abort the rest of the batch. (A pool
+            # rolls back the connections it lends out by itself.)
+            if not isinstance(geocoder.cxn, ConnectionPool):
+                geocoder.cxn.rollback()
+            rows.append(format_row(offset, location, error=e))
+        except Exception, e:
+            rows.append(format_row(offset, location, error=e))
+    return rows
+
+def open_input(filename):
+    if filename is None or filename == '-':
+        return sys.stdin
+    elif filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    else:
+        return open(filename, 'r')
+
+def read_batches(lines, batch_size, start_offset=0):
+    """
+    Yields lists of up to batch_size (line number, location) pairs, skipping
+    the first start_offset lines.
+    """
+    batch = []
+    for offset, line in enumerate(lines):
+        if offset < start_offset:
+            continue
+        batch.append((offset, line.rstrip('\r\n')))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def read_checkpoint(filename):
+    """
+    Returns the (line number, output position) pair saved by
+    write_checkpoint(), with a position of None if none was saved (as for
+    stdout, or for checkpoints written before positions were). A missing
+    checkpoint is (0, None).
+    """
+    try:
+        f = open(filename, 'r')
+    except IOError:
+        return 0, None
+    try:
+        fields = f.read().split()
+    finally:
+        f.close()
+    if not fields:
+        return 0, None
+    if len(fields) == 1:
+        return int(fields[0]), None
+    return int(fields[0]), int(fields[1])
+
+def write_checkpoint(filename, offset, position=None):
+    # Write-and-rename, so a crash never leaves a truncated checkpoint.
+    tmp = filename + '.tmp'
+    f = open(tmp, 'w')
+    try:
+        if position is None:
+            f.write('%d\n' % offset)
+        else:
+            f.write('%d %d\n' % (offset, position))
+    finally:
+        f.close()
+    os.rename(tmp, filename)
+
+def output_position(out):
+    try:
+        return out.tell()
+    except (IOError, AttributeError):
+        # A pipe or terminal.
+        return None
+
+def open_output(filename, resume=False, position=None):
+    """
+    Opens the output file for writing: emptied, unless resuming, when it's
+    cut back to position (see read_checkpoint()) or, if that's None,
+    appended to.
+    """
+    if not resume or not os.path.exists(filename):
+        return open(filename, 'w')
+    if position is None:
+        return open(filename, 'a')
+    out = open(filename, 'r+')
+    out.truncate(position)
+    out.seek(position)
+    return out
+
+class _Finished:
+    """
+    Stands in for a pool's AsyncResult when geocoding in-process.
+    """
+    def __init__(self, value):
+        self.value = value
+    def get(self):
+        return self.value
+
+class Progress:
+    """
+    Counts output rows and periodically reports the throughput to a stream.
+    """
+    def __init__(self, stream=None, interval=10.0):
+        self.stream = stream
+        self.interval = interval
+        self.rows = 0
+        self.started = self.reported = time.time()
+
+    def add(self, rows):
+        self.rows += rows
+        now = time.time()
+        if self.stream is not None and now - self.reported >= self.interval:
+            self.reported = now
+            self.report(now)
+
+    def rate(self, now=None):
+        elapsed = (now or time.time()) - self.started
+        return elapsed > 0 and self.rows / elapsed or 0.0
+
+    def report(self, now=None):
+        if self.stream is not None:
+            self.stream.write('%d rows, %.1f rows/second\n' % (self.rows, self.rate(now)))
+            self.stream.flush()
+
+def geocode_stream(batches, out, pool=None, geocoder=None, max_in_flight=16, checkpoint=None, progress=None):
+    """
+    Geocodes each batch (see read_batches()) on the pool -- or in-process with
+    the given geocoder, if there's no pool -- and writes the rows to out in
+    input order as soon as they're ready. At most max_in_flight batches are
+    submitted but not yet written at any time.
+
+    If a checkpoint filename is given, the line number following the last
+    written batch, and the position of out after it, are saved to it after
+    every batch.
+    """
+    pending = deque()
+
+    def write_oldest():
+        batch, result = pending.popleft()
+        rows = result.get()
+        out.write(''.join([row + '\n' for row in rows]))
+        out.flush()
+        if checkpoint is not None:
+            write_checkpoint(checkpoint, batch[-1][0] + 1, output_position(out))
+        if progress is not None:
+            progress.add(len(rows))
+
+    for batch in batches:
+        if pool is None:
+            pending.append((batch, _Finished(geocode_batch(batch, geocoder))))
+        else:
+            pending.append((batch, pool.apply_async(geocode_batch, (batch,))))
+        while len(pending) >= max_in_flight:
+            write_oldest()
+    while pending:
+        write_oldest()
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m djeocoder', description='Geocode one location per line.')
+    parser.add_argument('input', nargs='?', help='input file, optionally gzipped (default: stdin)')
+    parser.add_argument('-o', '--output', help='output file (default: stdout)')
+    parser.add_argument('--dsn', default='dbname=openblock', help='psycopg2 connection string')
+    parser.add_argument('-j', '--workers', type=int, default=multiprocessing.cpu_count(), help='worker processes; 0 geocodes in-process')
+    parser.add_argument('--batch-size', type=int, default=100, help='lines per worker task')
+    parser.add_argument('--max-in-flight', type=int, default=None, help='batches queued at once (default: 4 per worker)')
+    parser.add_argument('--checkpoint', help='file recording how many input lines have been written')
+    parser.add_argument('--resume', action='store_true', help='skip the input lines recorded in the checkpoint and continue the output from there')
+    parser.add_argument('--progress-interval', type=float, default=10.0, help='seconds between throughput reports on stderr')
+    args = parser.parse_args(argv)
+
+    if args.resume and not args.checkpoint:
+        parser.error('--resume requires --checkpoint')
+    start_offset, position = args.resume and read_checkpoint(args.checkpoint) or (0, None)
+
+    if args.output:
+        out = open_output(args.output, args.resume, position)
+    else:
+        out = sys.stdout
+    inf = open_input(args.input)
+    progress = Progress(sys.stderr, args.progress_interval)
+    batches = read_batches(inf, args.batch_size, start_offset)
+
+    if args.workers > 0:
+        # Fail fast on a bad DSN: a pool whose workers can't connect just
+        # keeps restarting them.
+        psycopg2.connect(args.dsn).close()
+        pool = multiprocessing.Pool(args.workers, init_worker, (args.dsn,))
+        try:
+            geocode_stream(batches, out, pool=pool, max_in_flight=args.max_in_flight or 4 * args.workers,
+                           checkpoint=args.checkpoint, progress=progress)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        pool.join()
+    else:
+        cxn = psycopg2.connect(args.dsn)
+        try:
+            geocode_stream(batches, out, geocoder=LocalGeocoder(cxn), max_in_flight=1,
+                           checkpoint=args.checkpoint, progress=progress)
+        finally:
+            cxn.close()
+
+    progress.report()
+    if out is not sys.stdout:
+        out.close()
+    if inf is not sys.stdin:
+        inf.close()
@@ -1,12 +1,16 @@
 from exceptions import Exception
-from parser.parsing import normalize, parse, ParsingError
+from parser.parsing import normalize, parse, iter_parse, ParsingError
 
 import re
+import logging
+from itertools import izip
 
 # from streets import Block, StreetMisspelling, Intersection
 # from geocoder_models import GeocoderCache
 
-from postgis import PostgisBlockSearcher, PostgisIntersectionSearcher, SpellingCorrector
+from postgis import PostgisBlockSearcher, PostgisIntersectionSearcher, SpellingCorrector, PreparedStatements, PAIR_BATCH_SIZES, interpolation_fraction, INTERSECTION_FIELDS, STREET_QUERY
+from pool import ConnectionPool
+from results import BlockResult
 
 class GeocoderException(Exception):
     def __init__(self, msg):
@@ -20,45 +24,228 @@ class DoesNotExist(GeocoderException):
     def __init__(self, msg):
         GeocoderException.__init__(self, msg)
 
+class AmbiguousResult(GeocoderException):
+    def __init__(self, choices, msg=None):
+        self.choices = choices
+        if msg is None:
+            msg = 'Geocoder db returned %s results' % len(choices)
+        GeocoderException.__init__(self, msg)
+
+class Return(Exception):
+    """
+    Raised by a geocoding coroutine to finish with a value.
+    """
+    def __init__(self, value):
+        Exception.__init__(self)
+        self.value = value
+
+def _run_lookups(coroutine, lookup):
+    # Runs a geocoding coroutine to its end, answering each lookup it yields
+    # with lookup(request), and returns the value it finishes with.
+    try:
+        request = coroutine.next()
+        while True:
+            request = coroutine.send(lookup(request))
+    except Return, r:
+        return r.value
+
+log = logging.getLogger(__name__)
+
 block_re = re.compile(r'^(\d+)[-\s]+(?:blk|block)\s+(?:of\s+)?(.*)$', re.IGNORECASE)
 intersection_re = re.compile(r'(?<=.) (?:and|\&|at|near|@|around|towards?|off|/|(?:just )?(?:north|south|east|west) of|(?:just )?past) (?=.)', re.IGNORECASE)
 
 class LocalGeocoder:
-    def __init__(self, cxn):
+    """
+    Geocodes addresses, blocks and intersections against the Postgis tables.
+
+    cxn is either a psycopg2 connection, which every lookup shares, or a
+    pool.ConnectionPool, which each lookup borrows a connection from; only the
+    latter is safe to use from several threads at once.
+
+    If a cache.GeocoderCache is given, locations are looked up in it before
+    the database, and their results (or failures) stored in it after.
+
+    With whole_streets, addresses are geocoded with a StreetAddressGeocoder,
+    which makes one query per street that an address might be on rather than
+    up to four, at the cost of fetching every block on the street.
+
+    With prepared, the searchers' queries are run as prepared statements
+    (see postgis.PreparedStatements), which Postgres plans once per
+    connection; call warm_up() at startup to prepare the common ones before
+    the first lookup.
+
+    spelling is the postgis.SpellingCorrector that misspelled streets are
+    corrected with, such as a spelling.StreetSpellingCorrector; by default,
+    nothing is corrected.
+
+    With street_pair_key, intersections are looked up by the street pair
+    key that the intersections_street_pair migration adds (see
+    migrations.py), which must have been applied.
+    """
+    def __init__(self, cxn, cache=None, whole_streets=False, prepared=False, spelling=None, street_pair_key=False):
         self.cxn = cxn
+        self.cache = cache
+        self.whole_streets = whole_streets
+        self.statements = prepared and PreparedStatements() or None
+        self.spelling = spelling
+        self.street_pair_key = street_pair_key
+
+    # The optional filters of the block lookups that warm_up() prepares: the
+    # exact lookup and its fallbacks, with and without a pre_dir.
+    WARM_BLOCK_FILTERS = (('pre_dir', 'suffix'), ('suffix',), ('pre_dir',), ())
+
+    def warm_up(self):
+        """
+        Prepares the statements of the common lookups on every connection
+        (each of the pool's min_size connections, if cxn is a pool), so that
+        the first lookups don't pay for planning them. Does nothing unless
+        the geocoder was made with prepared.
+        """
+        if self.statements is None:
+            return
+        blocks = PostgisBlockSearcher(None)
+        # Only the shapes of the queries matter, not the values.
+        queries = [blocks._block_query(street='X', number='1', **dict([(k, 'X') for k in filters]))[0]
+                   for filters in self.WARM_BLOCK_FILTERS]
+        queries.append(blocks._block_query(street='X', city='X')[0])
+        # The intersection lookups' VALUES queries, padded to each batch size.
+        intersections = PostgisIntersectionSearcher(None, street_pair_key=self.street_pair_key)
+        queries.extend([intersections._pairs_query([{'street_a': 'X', 'street_b': 'X'}], size)[0] for size in PAIR_BATCH_SIZES])
+        queries.append(STREET_QUERY)
+
+        if isinstance(self.cxn, ConnectionPool):
+            conns = [self.cxn.getconn() for i in range(max(self.cxn.min_size, 1))]
+        else:
+            conns = [self.cxn]
+        try:
+            for conn in conns:
+                cursor = conn.cursor()
+                for query in queries:
+                    self.statements.prepare(conn, cursor, query)
+                cursor.close()
+        finally:
+            # Prepared statements last for the session, whatever becomes of
+            # the transaction, so the pool rolling these back is harmless.
+            if isinstance(self.cxn, ConnectionPool):
+                for conn in conns:
+                    self.cxn.putconn(conn)
+
     def geocode(self, location):
+        if self.cache is None:
+            return self._geocode(location)
+        outcome = self.cache.lookup(location)
+        if outcome is not None:
+            result, error = outcome
+            if error is not None:
+                raise error
+            return result
+        try:
+            result = self._geocode(location)
+        except (GeocoderException, ParsingError), e:
+            self.cache.put_error(location, e)
+            raise
+        self.cache.put(location, result)
+        return result
+
+    def _geocode(self, location):
         if intersection_re.search(location):
             #raise GeocoderException('Intersection geocoding not implemented')
-            geocoder = PostgisIntersectionGeocoder(self.cxn)
+            geocoder = PostgisIntersectionGeocoder(self.cxn, self.statements, self.spelling, self.street_pair_key)
 
         elif block_re.search(location):
             #raise GeocoderException('Block geocoding not implemented')
-            geocoder = PostgisBlockGeocoder(self.cxn)
+            geocoder = PostgisBlockGeocoder(self.cxn, self.statements, self.spelling)
+
+        elif self.whole_streets:
+            geocoder = StreetAddressGeocoder(self.cxn, self.statements, self.spelling)
 
         else:
-            geocoder = PostgisAddressGeocoder(self.cxn)
+            geocoder = PostgisAddressGeocoder(self.cxn, self.statements, self.spelling)
 
         return geocoder.geocode(location)
 
+    def _is_address(self, location):
+        return not (intersection_re.search(location) or block_re.search(location))
+
+    def geocode_many(self, locations):
+        """
+        Geocodes a list of location strings, returning a (result, error) pair
+        for each, in order: the PostgisResult that geocode() would return and
+        None, or None and the GeocoderException or ParsingError it would raise.
+
+        Locations are geocoded once per normalized form (and looked up in the
+        cache first, if there is one), and addresses with a
+        BatchAddressGeocoder, which makes about one query per distinct street
+        rather than several per location.
+        """
+        batch = BatchAddressGeocoder(self.cxn, self.statements, self.spelling)
+        outcomes = {}
+        keys = []
+        geocoded = []
+        for location in locations:
+            is_address = self._is_address(location)
+            key = (is_address, normalize(location))
+            keys.append(key)
+            if key in outcomes:
+                continue
+            if self.cache is not None:
+                outcome = self.cache.lookup(location)
+                if outcome is not None:
+                    outcomes[key] = outcome
+                    continue
+            try:
+                if is_address:
+                    outcomes[key] = (batch.geocode(location), None)
+                else:
+                    outcomes[key] = (self._geocode(location), None)
+            except (GeocoderException, ParsingError), e:
+                outcomes[key] = (None, e)
+            geocoded.append((key, location))
+        batch.resolve()
+        if self.cache is not None:
+            # Only now do the batch geocoder's results have their points.
+            for key, location in geocoded:
+                result, error = outcomes[key]
+                if error is None:
+                    self.cache.put(location, result)
+                else:
+                    self.cache.put_error(location, error)
+        return [outcomes[key] for key in keys]
+
 class PostgisAddressGeocoder:
     """
     A replacement for AddressGeocoder from Openblock
     """
-    def __init__(self, cxn):
+    def __init__(self, cxn, statements=None, spelling=None):
         self.connection = cxn
-        self.spelling = SpellingCorrector()
+        self.statements = statements
+        self.spelling = spelling or SpellingCorrector()
 
     def geocode(self, location_string):
-        # Parse the address.
-        try:
-            locations = parse(location_string)
-        except ParsingError, e:
-            raise
+        return _run_lookups(self._geocoding(location_string), self._lookup)
+
+    def _lookup(self, request):
+        # Answers a lookup that _geocoding() yields.
+        if request[0] == 'addresses':
+            return self._db_lookup(request[1])
+        return self._street_lookup(**request[1])
 
+    def _geocoding(self, location_string):
+        """
+        The geocoding of location_string, as a coroutine that yields each
+        lookup it needs and is sent back its outcome, so that geocode() can
+        run the lookups one after another and async_geocoder.AsyncGeocoder
+        on a backend. A lookup is either ('addresses', location), for the
+        results of _db_lookup(location), or ('street', kwargs), for the blocks
+        of _street_lookup(**kwargs). It raises Return with the result.
+        """
+        # Parse the address. The candidates come most plausible first, so we
+        # stop at the first one that the database knows about. (ParsingError
+        # is raised when the loop starts.)
         all_results = []
-        for loc in locations:
-            loc_results = self._db_lookup(loc)
-            print 'Initial loc_results: %s -> %s' % (str(loc), str(loc_results))
+        for loc in iter_parse(location_string):
+            loc_results = yield ('addresses', loc)
+            log.debug('Initial loc_results: %s -> %s', loc, loc_results)
 
             # If none were found, maybe the street was misspelled. Check that.
             if (not loc_results) and loc['street']:
@@ -71,15 +258,15 @@ class PostgisAddressGeocoder:
                     misspelling = self.spelling.correct(incorrect=loc['street'])
                     loc['street'] = misspelling.correct
                     
-                except StreetMisspelling.DoesNotExist:
+                except SpellingCorrector.DoesNotExist:
                     pass
                 else:
-                    loc_results = self._db_lookup(loc)
+                    loc_results = yield ('addresses', loc)
                 
                 # Next, try removing the street suffix, in case an incorrect
                 # one was given.
                 if (not loc_results) and loc['suffix']:
-                    loc_results = self._db_lookup(dict(loc, suffix=None))
+                    loc_results = yield ('addresses', dict(loc, suffix=None))
                 
                 # Next, try looking for the street, in case the street
                 # exists but the address doesn't.
@@ -95,18 +282,18 @@ class PostgisAddressGeocoder:
                         # DJANGOism: replace
                         # b_list = Block.objects.filter(*sided_filters, **kwargs).order_by('predir', 'from_num', 'to_num')
                         
-                        searcher = PostgisBlockSearcher(self.connection)
-                        b_list = searcher.search(**kwargs)
-                        searcher.close()
+                        b_list = yield ('street', kwargs)
 
                         if b_list: raise InvalidBlockButValidStreet(loc['number'], b_list[0].pretty_name, b_list)
 
-            all_results.extend(loc_results)
+            if loc_results:
+                all_results = loc_results
+                break
 
         if not all_results:
             raise DoesNotExist("Geocoder db couldn't find this location: %r" % location_string)
         elif len(all_results) == 1:
-            return all_results[0]
+            raise Return(all_results[0])
         else:
             raise AmbiguousResult(all_results)
 
@@ -120,30 +307,116 @@ class PostgisAddressGeocoder:
             return []
 
         # Query the blocks table in the database.
-        searcher = PostgisBlockSearcher(self.connection)
+        searcher = PostgisBlockSearcher(self.connection, self.statements)
         # print location.keys()
         blocks = searcher.search(**location)
         searcher.close()
         
         return [self._build_result(location, block_result) for block_result in blocks]
 
+    def _street_lookup(self, street, city):
+        """
+        Returns the blocks of a street in a city, whatever their numbers.
+        """
+        searcher = PostgisBlockSearcher(self.connection, self.statements)
+        b_list = searcher.search(street=street, city=city)
+        searcher.close()
+        return b_list
+
     def _build_result(self, location, block):
         # In Django, this used to be Address(...)
         # TODO : also in the original, a lot of these location['...'] fields were specified
         # by values returned from the DB itself (normalization).  We should probably add that
         # back in here.
         return PostgisResult(**{
-            'address': unicode(" ".join([str(s) for s in [location['number'], location['predir'], block.pretty_name, location['postdir']] if s])),
+            'address': unicode(" ".join([str(s) for s in [location['number'], location['pre_dir'], block.pretty_name, location['post_dir']] if s])),
             'city': location['city'],
             'state': location['state'],
             'zip': location['zip'],
             # 'block': block,
             # 'intersection_id': None,
             'point': block.location,
+            'streets': (location['street'],),
             # 'url': block.url(),
             # 'wkt': str(block.location),
         })
 
+class _UninterpolatedBlock:
+    """
+    Stands in for a BlockResult whose point hasn't been interpolated yet.
+    """
+    def __init__(self, row):
+        self.pretty_name = row[1]
+        self.location = None
+
+class StreetAddressGeocoder(PostgisAddressGeocoder):
+    """
+    Geocodes addresses like PostgisAddressGeocoder, but rather than making a
+    query for each lookup in its chain of fallbacks (exact, after spelling
+    correction, without the suffix, and the street in any block), fetches
+    every block on a street at once, the first time the street comes up,
+    and evaluates every lookup on it against those blocks in memory.
+    """
+    def __init__(self, cxn, statements=None, spelling=None):
+        PostgisAddressGeocoder.__init__(self, cxn, statements, spelling)
+        self.searcher = PostgisBlockSearcher(cxn, statements)
+        self.streets = {}
+
+    def _street_blocks(self, street):
+        if street not in self.streets:
+            self.streets[street] = self.searcher.fetch_street(street)
+        return self.streets[street]
+
+    def _matching_blocks(self, location):
+        if not location['number']:
+            return []
+        filters = dict(location.items())
+        street = filters.pop('street')
+        return self.searcher.filter_blocks(self._street_blocks(street), **filters)
+
+    def _db_lookup(self, location):
+        blocks = self._matching_blocks(location)
+        points = self.searcher.interpolate([(row[8], interpolation_fraction(location['number'], from_num, to_num))
+                                            for row, from_num, to_num in blocks])
+        return [self._build_result(location, BlockResult(row, point)) for (row, from_num, to_num), point in izip(blocks, points)]
+
+    def _street_lookup(self, street, city):
+        # Only needed for the message of InvalidBlockButValidStreet, but that
+        # wants the blocks' midpoints, as search() would give them.
+        blocks = self.searcher.filter_blocks(self._street_blocks(street), city=city)
+        points = self.searcher.interpolate([(row[8], 0.5) for row, from_num, to_num in blocks])
+        return [BlockResult(row, point) for (row, from_num, to_num), point in izip(blocks, points)]
+
+class BatchAddressGeocoder(StreetAddressGeocoder):
+    """
+    Geocodes addresses with as few queries as possible, for
+    LocalGeocoder.geocode_many(): like StreetAddressGeocoder, it fetches the
+    blocks of each street once (for all the addresses it's given), and it
+    leaves the points of the results unset until resolve() interpolates all
+    of them at once.
+    """
+    def __init__(self, cxn, statements=None, spelling=None):
+        StreetAddressGeocoder.__init__(self, cxn, statements, spelling)
+        # (result, line, fraction) for each result that needs its point.
+        self.pending = []
+
+    def _db_lookup(self, location):
+        results = []
+        for row, from_num, to_num in self._matching_blocks(location):
+            result = self._build_result(location, _UninterpolatedBlock(row))
+            self.pending.append((result, row[8], interpolation_fraction(location['number'], from_num, to_num)))
+            results.append(result)
+        return results
+
+    def resolve(self):
+        """
+        Sets the points of all the results given out so far.
+        """
+        pending, self.pending = self.pending, []
+        points = self.searcher.interpolate([(line, fraction) for result, line, fraction in pending])
+        for (result, line, fraction), point in izip(pending, points):
+            result.point = point
+
 class PostgisBlockGeocoder(PostgisAddressGeocoder):
     """
     Copied from ebpub.base.BlockGeocoder
@@ -160,11 +433,21 @@ class PostgisIntersectionGeocoder:
     """
     A replacement for ebpub.base.IntersectionGeocoder
     """
-    def __init__(self, cxn):
+    def __init__(self, cxn, statements=None, spelling=None, street_pair_key=False):
         self.connection = cxn
-        self.spelling = SpellingCorrector()
+        self.statements = statements
+        self.spelling = spelling or SpellingCorrector()
+        self.street_pair_key = street_pair_key
 
     def geocode(self, location_string):
+        return _run_lookups(self._geocoding(location_string), lambda request: self._db_lookup(request[1]))
+
+    def _geocoding(self, location_string):
+        """
+        The geocoding of location_string, as a coroutine like
+        PostgisAddressGeocoder._geocoding(). It yields a single lookup,
+        ('intersections', pairs), for the results of _db_lookup(pairs).
+        """
         sides = intersection_re.split(location_string)
         if len(sides) != 2:
             raise ParsingError("Couldn't parse intersection: %r" % location_string)
@@ -174,55 +457,70 @@ class PostgisIntersectionGeocoder:
         left_side = parse(sides[0])
         right_side = parse(sides[1])
 
+        # Correct each street once, however many pairs it's in.
+        corrections = {}
+        for street in left_side + right_side:
+            if street['street'] not in corrections:
+                corrections[street['street']] = self.spelling.spell(street['street'])
+            street['street'] = corrections[street['street']]
+
         all_results = []
         seen_intersections = set()
-        for street_a in left_side:
-            street_a['street'] = self.spelling.correct(street_a['street'])
-            for street_b in right_side:
-                street_b['street'] = self.spelling.correct(street_b['street'])
-                for result in self._db_lookup(street_a, street_b):
-                    if result["intersection_id"] not in seen_intersections:
-                        seen_intersections.add(result["intersection_id"])
-                        all_results.append(result)
+        for result in (yield ('intersections', [(street_a, street_b) for street_a in left_side for street_b in right_side])):
+            if result.intersection_id not in seen_intersections:
+                seen_intersections.add(result.intersection_id)
+                all_results.append(result)
 
         if not all_results:
             raise DoesNotExist("Geocoder db couldn't find this intersection: %r" % location_string)
         elif len(all_results) == 1:
-            return all_results.pop()
+            raise Return(all_results.pop())
         else:
             raise AmbiguousResult(list(all_results), "Intersections DB returned %s results" % len(all_results))
 
-    def _db_lookup(self, street_a, street_b):
-        try:
-            searcher = PostgisIntersectionSearcher(self.connection)
-            intersections = searcher.search(
-                predir_a=street_a['pre_dir'],
-                street_a=street_a['street'],
-                suffix_a=street_a['suffix'],
-                postdir_a=street_a['post_dir'],
-                predir_b=street_b['pre_dir'],
-                street_b=street_b['street'],
-                suffix_b=street_b['suffix'],
-                postdir_b=street_b['post_dir'],
-            )
-            searcher.close()
-        # except Exception, e:
-        except DoesNotExist, e:
-            raise DoesNotExist("Intersection db query failed: %r" % e)
-        return [self._build_result(i) for i in intersections]
-
-    def _build_result(self, intersection):
+    def _db_lookup(self, pairs):
+        """
+        Looks up every (street_a, street_b) pair of parsed locations in one
+        query, returning the results of each pair in turn. Pairs that differ
+        only in fields the intersections table doesn't have are looked up
+        once.
+        """
+        filters = self._pair_filters(pairs)
+        searcher = PostgisIntersectionSearcher(self.connection, self.statements, self.street_pair_key)
+        intersections = searcher.search_pairs(filters)
+        searcher.close()
+        return self._pair_results(filters, intersections)
+
+    def _pair_filters(self, pairs):
+        # The distinct search_pairs() arguments of the pairs.
+        filters = []
+        seen_pairs = set()
+        for street_a, street_b in pairs:
+            pair = (street_a['pre_dir'], street_a['street'], street_a['suffix'], street_a['post_dir'],
+                    street_b['pre_dir'], street_b['street'], street_b['suffix'], street_b['post_dir'])
+            if pair not in seen_pairs:
+                seen_pairs.add(pair)
+                filters.append(dict(izip(INTERSECTION_FIELDS, pair)))
+        return filters
+
+    def _pair_results(self, filters, intersections):
+        results = []
+        for pair, found in izip(filters, intersections):
+            results.extend([self._build_result(i, (pair['street_a'], pair['street_b'])) for i in found])
+        return results
+
+    def _build_result(self, intersection, streets=()):
+        # The intersections table has no city, state or zip columns.
         return PostgisResult(**{
             'address': intersection.pretty_name,
-            'city': intersection.city,
-            'state': intersection.state,
-            'zip': intersection.zip,
+            'city': None,
+            'state': None,
+            'zip': None,
             'intersection_id': intersection.id,
             'intersection': intersection,
             'block': None,
             'point': intersection.location,
-            'url': intersection.url(),
-            'wkt': str(intersection.location),
+            'streets': tuple(streets),
         })
 
 class PostgisResult(object): 
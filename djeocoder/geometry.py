@@ -0,0 +1,120 @@
+"""
+Planar geometry on the block lines, done in Python rather than by PostGIS,
+so that a block lookup doesn't need a second query to place its point.
+
+The searchers fetch the lines as WKB (with ST_AsBinary()), which is decoded
+with a single struct call per line; lines given as (E)WKT, such as those
+from the pipe files, are parsed as text.
+"""
+import re
+import math
+import struct
+
+linestring_pattern = re.compile(r'LINESTRING\s*(?:ZM|Z|M)?\s*\(([^)]*)\)', re.IGNORECASE)
+
+class GeometryParsingException(Exception):
+    pass
+
+# The WKB geometry type of a LINESTRING.
+WKB_LINESTRING = 2
+
+# The flags of the EWKB geometry type, which PostGIS's own binary output
+# (rather than ST_AsBinary()) sets.
+EWKB_Z = 0x80000000
+EWKB_M = 0x40000000
+EWKB_SRID = 0x20000000
+
+def parse_line(ewkt):
+    """
+    Returns the (x, y) vertices of a LINESTRING, given as (E)WKT. Any Z and
+    M values are dropped, as line_interpolate_point() ignores them.
+
+    >>> parse_line('SRID=4326;LINESTRING(-87.6 41,-87.6 41.1)')
+    [(-87.6, 41.0), (-87.6, 41.1)]
+    """
+    matcher = linestring_pattern.search(ewkt)
+    if matcher is None:
+        raise GeometryParsingException('Not a LINESTRING: %r' % ewkt)
+    try:
+        vertices = []
+        for vertex in matcher.group(1).split(','):
+            ordinates = vertex.split()
+            vertices.append((float(ordinates[0]), float(ordinates[1])))
+    except (ValueError, IndexError):
+        raise GeometryParsingException('Bad LINESTRING: %r' % ewkt)
+    return vertices
+
+def parse_wkb_line(wkb):
+    """
+    Returns the (x, y) vertices of a LINESTRING, given as WKB or EWKB (a
+    str or buffer). Any Z and M values are dropped.
+
+    >>> parse_wkb_line(struct.pack('<BII4d', 1, WKB_LINESTRING, 2, -87.6, 41, -87.6, 41.1))
+    [(-87.6, 41.0), (-87.6, 41.1)]
+    """
+    try:
+        order = wkb[0] == '\x01' and '<' or '>'
+        (kind,) = struct.unpack_from(order + 'I', wkb, 1)
+        offset = 5
+        dimensions = 2
+        if kind & EWKB_SRID:
+            offset += 4
+        if kind & EWKB_Z:
+            dimensions += 1
+        if kind & EWKB_M:
+            dimensions += 1
+        kind &= 0x0fffffff
+        # ISO WKB adds 1000 for Z, 2000 for M and 3000 for both.
+        dimensions += (0, 1, 1, 2)[kind // 1000]
+        kind %= 1000
+        if kind != WKB_LINESTRING:
+            raise GeometryParsingException('Not a LINESTRING: WKB geometry type %d' % kind)
+        (count,) = struct.unpack_from(order + 'I', wkb, offset)
+        ordinates = struct.unpack_from('%s%dd' % (order, count * dimensions), wkb, offset + 4)
+    except (struct.error, IndexError):
+        raise GeometryParsingException('Bad WKB LINESTRING: %r' % str(wkb))
+    return zip(ordinates[0::dimensions], ordinates[1::dimensions])
+
+def line_vertices(line):
+    """
+    Returns the (x, y) vertices of a LINESTRING, given either as WKB or as
+    (E)WKT text.
+    """
+    if isinstance(line, basestring) and line[:1] not in ('\x00', '\x01'):
+        return parse_line(line)
+    return parse_wkb_line(line)
+
+def interpolate_point(vertices, fraction):
+    """
+    Returns the point that fraction (clamped to between 0 and 1) of the way
+    along a line's length, as PostGIS's line_interpolate_point() does: the
+    length is measured in the plane of the coordinates, and the point
+    placed linearly along the segment it falls on.
+
+    >>> interpolate_point([(0.0, 0.0), (3.0, 4.0), (3.0, 10.0)], 0.5)
+    (3.0, 4.5)
+    """
+    if fraction <= 0 or len(vertices) == 1:
+        return vertices[0]
+    if fraction >= 1:
+        return vertices[-1]
+    lengths = [math.hypot(x2 - x1, y2 - y1) for (x1, y1), (x2, y2) in zip(vertices, vertices[1:])]
+    target = sum(lengths) * fraction
+    walked = 0.0
+    for (x1, y1), (x2, y2), length in zip(vertices, vertices[1:], lengths):
+        if length and target < walked + length:
+            along = (target - walked) / length
+            return (x1 + (x2 - x1) * along, y1 + (y2 - y1) * along)
+        walked += length
+    return vertices[-1]
+
+def line_interpolate_point(line, fraction):
+    """
+    Returns the (x, y) point that fraction of the way along a LINESTRING,
+    given as WKB or (E)WKT.
+    """
+    return interpolate_point(line_vertices(line), fraction)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
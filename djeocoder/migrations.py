@@ -0,0 +1,92 @@
+"""
+Changes to the OpenBlock tables that the geocoder can take advantage of.
+Apply the ones that haven't been applied yet with:
+
+    python migrations.py [dsn]
+
+Each migration is recorded by name in the djeocoder_migrations table once
+it has run, in the same transaction as its changes.
+"""
+import sys
+
+# Adds the columns street_lo and street_hi to intersections: the lesser and
+# greater (by street, then suffix) of its two streets, kept up to date by a
+# trigger, with an index on the pair. An intersection of two streets can then
+# be found with
+#
+#     street_lo=least(%s, %s) and street_hi=greatest(%s, %s)
+#
+# from one index lookup, whichever street was given first, rather than with
+# (street_a=%s OR street_b=%s) for each street, which the planner can only
+# answer by scanning every intersection of the more common one.
+STREET_PAIR_KEY = (
+    'ALTER TABLE intersections ADD COLUMN street_lo varchar, ADD COLUMN street_hi varchar',
+    """
+    CREATE OR REPLACE FUNCTION intersections_street_pair() RETURNS trigger AS $$
+    BEGIN
+        IF (NEW.street_a, coalesce(NEW.suffix_a, '')) <= (NEW.street_b, coalesce(NEW.suffix_b, '')) THEN
+            NEW.street_lo := NEW.street_a;
+            NEW.street_hi := NEW.street_b;
+        ELSE
+            NEW.street_lo := NEW.street_b;
+            NEW.street_hi := NEW.street_a;
+        END IF;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    'CREATE TRIGGER intersections_street_pair BEFORE INSERT OR UPDATE ON intersections '
+    'FOR EACH ROW EXECUTE PROCEDURE intersections_street_pair()',
+    # Fires the trigger on the rows already there.
+    'UPDATE intersections SET street_a=street_a',
+    'CREATE INDEX intersections_street_pair ON intersections (street_lo, street_hi)',
+    'ANALYZE intersections',
+)
+
+# (name, statements), in the order they're applied.
+MIGRATIONS = (
+    ('intersections_street_pair', STREET_PAIR_KEY),
+)
+
+def applied(conn):
+    """
+    Returns the set of the names of the migrations applied to the database.
+    """
+    cursor = conn.cursor()
+    cursor.execute('CREATE TABLE IF NOT EXISTS djeocoder_migrations (name varchar PRIMARY KEY)')
+    cursor.execute('SELECT name FROM djeocoder_migrations')
+    names = set([name for (name,) in cursor.fetchall()])
+    cursor.close()
+    conn.commit()
+    return names
+
+def migrate(conn, migrations=MIGRATIONS):
+    """
+    Applies the migrations that haven't been applied yet, returning their
+    names. If one fails, its changes are rolled back and the exception
+    raised, leaving the ones before it applied.
+    """
+    done = applied(conn)
+    names = []
+    for name, statements in migrations:
+        if name in done:
+            continue
+        cursor = conn.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute('INSERT INTO djeocoder_migrations (name) VALUES (%s)', (name,))
+            cursor.close()
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        names.append(name)
+    return names
+
+if __name__ == "__main__":
+    import psycopg2
+    conn = psycopg2.connect(len(sys.argv) > 1 and sys.argv[1] or 'dbname=openblock')
+    for name in migrate(conn):
+        print "Applied %s" % name
+    conn.close()
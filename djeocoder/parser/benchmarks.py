@@ -0,0 +1,238 @@
+"""
+Benchmarks for the address parser. They need no database.
+
+    python benchmarks.py [--cf-log LOG] [--output results.json]
+    python benchmarks.py --compare old.json new.json
+    python benchmarks.py --suffixes
+
+The suite replays two corpora through normalize(), strip_unit() and parse():
+the auto-generated cases of tests.py, and the location strings that
+make_cf_tests.extract_tests() finds in a Civic Footprint log (by default,
+the sample log in make_cf_tests' docstring). It reports per-call latency
+percentiles, throughput and allocations, and can save the results as JSON so
+that two runs can be compared.
+"""
+import gc
+import re
+import math
+import sys
+import json
+import time
+import timeit
+import argparse
+
+import make_cf_tests
+from parsing import abbrev_regex, suffix_standardizer, normalize, strip_unit, parse, ParsingError
+from suffixes import suffixes
+
+def auto_corpus():
+    """
+    Returns the location strings of the auto-generated test cases in tests.py.
+    """
+    # Imported here, since tests imports this module.
+    from tests import auto_location_cases
+    return [location for token_types, location, expected in auto_location_cases()]
+
+def cf_corpus(filename=None):
+    """
+    Returns the location strings that make_cf_tests.extract_tests() finds in
+    the given Civic Footprint log, or in the sample log in its docstring.
+    """
+    if filename is None:
+        return [input for input, output in make_cf_tests.extract_tests(iter(make_cf_tests.__doc__.splitlines()))]
+    f = open(filename, 'r')
+    try:
+        return [input for input, output in make_cf_tests.extract_tests(f)]
+    finally:
+        f.close()
+
+def percentile(sorted_values, p):
+    """
+    Returns the p-th percentile (0 <= p <= 100) of a sorted list, by the
+    nearest-rank method.
+
+    >>> percentile(range(1, 101), 90)
+    90
+    """
+    if not sorted_values:
+        return 0.0
+    rank = int(math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[max(0, min(rank, len(sorted_values)) - 1)]
+
+def benchmark(func, inputs, repeat=3):
+    """
+    Calls func once on every input, repeat times over, and returns a dict of
+    per-call latency statistics (in microseconds), the throughput in calls per
+    second, the number of inputs func raised ParsingError on, and the number
+    of objects each call allocated.
+
+    Python 2 has no allocation tracer, so the allocation count comes from the
+    garbage collector's generation-0 counter (with collection switched off),
+    which rises on every container allocation and falls on every
+    deallocation. It's read while the call's result is still alive, so it
+    counts the objects that make up the result, not temporaries.
+    """
+    timer = timeit.default_timer
+    latencies = []
+    failures = 0
+    allocations = 0
+    total = 0.0
+    gc_was_enabled = gc.isenabled()
+    try:
+        for i in range(repeat):
+            gc.collect()
+            gc.disable()
+            for input in inputs:
+                before = gc.get_count()[0]
+                start = timer()
+                try:
+                    result = func(input)
+                except ParsingError:
+                    result = None
+                    if i == 0:
+                        failures += 1
+                elapsed = timer() - start
+                allocations += gc.get_count()[0] - before
+                del result
+                latencies.append(elapsed)
+                total += elapsed
+            gc.enable()
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+        else:
+            gc.disable()
+
+    latencies.sort()
+    calls = len(latencies)
+    return {
+        'calls': calls,
+        'failures': failures,
+        'mean_us': calls and total / calls * 1e6 or 0.0,
+        'p50_us': percentile(latencies, 50) * 1e6,
+        'p90_us': percentile(latencies, 90) * 1e6,
+        'p99_us': percentile(latencies, 99) * 1e6,
+        'max_us': calls and latencies[-1] * 1e6 or 0.0,
+        'calls_per_second': total and calls / total or 0.0,
+        'allocations_per_call': calls and float(allocations) / calls or 0.0,
+    }
+
+def run_suite(corpora, repeat=3):
+    """
+    Benchmarks normalize(), strip_unit() and parse() on each corpus (a dict of
+    corpus name to list of location strings). strip_unit() is given
+    normalized strings, as it is in parse().
+    """
+    results = {}
+    for name, locations in sorted(corpora.items()):
+        normalized = [normalize(location) for location in locations]
+        results[name] = {
+            'normalize': benchmark(normalize, locations, repeat),
+            'strip_unit': benchmark(strip_unit, normalized, repeat),
+            'parse': benchmark(parse, locations, repeat),
+        }
+    return {
+        'python': sys.version.split()[0],
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': repeat,
+        'results': results,
+    }
+
+COMPARED_STATS = ('p50_us', 'p90_us', 'p99_us', 'calls_per_second', 'allocations_per_call')
+
+def compare(old, new):
+    """
+    Returns report lines comparing two run_suite() results: each statistic in
+    COMPARED_STATS, for every corpus and function present in both, with its
+    relative change.
+    """
+    lines = []
+    for corpus in sorted(set(old['results']) & set(new['results'])):
+        for func in sorted(set(old['results'][corpus]) & set(new['results'][corpus])):
+            o, n = old['results'][corpus][func], new['results'][corpus][func]
+            for stat in COMPARED_STATS:
+                change = o[stat] and '%+.1f%%' % ((n[stat] - o[stat]) / o[stat] * 100) or 'n/a'
+                lines.append('%-8s %-11s %-21s %12.2f %12.2f %9s' % (corpus, func, stat, o[stat], n[stat], change))
+    return lines
+
+def format_results(suite):
+    lines = []
+    for corpus, funcs in sorted(suite['results'].items()):
+        for func, stats in sorted(funcs.items()):
+            lines.append('%-8s %-11s %6d calls  p50 %8.1fus  p90 %8.1fus  p99 %8.1fus  %10.0f calls/s  %6.1f allocs/call' % (
+                corpus, func, stats['calls'], stats['p50_us'], stats['p90_us'], stats['p99_us'],
+                stats['calls_per_second'], stats['allocations_per_call']))
+    return lines
+
+def suffix_tokens():
+    """
+    Returns every suffix spelling in suffixes.py, in mixed case, followed by
+    as many street-name tokens that aren't suffixes.
+    """
+    spellings = set()
+    for standard, options in suffixes.items():
+        spellings.add(standard)
+        spellings.update(options)
+    tokens = sorted([s.capitalize() for s in spellings])
+    misses = ['BROADWAY', 'DAMEN', 'VASSAR', 'MALVERN', 'KIMBALL', 'DIVERSEY', 'TOBIN', 'LOUIS']
+    return tokens + [misses[i % len(misses)] for i in range(len(tokens))]
+
+def benchmark_suffix_matching(repeat=5, number=20):
+    """
+    Times recognizing and standardizing every token from suffix_tokens(),
+    first with the abbrev_regex() alternation of suffixes.py and a
+    Standardizer that uppercases twice per lookup (the regex path parse()
+    used to take), then with suffix_standardizer alone. Returns a dict of the
+    best per-token times, in microseconds.
+    """
+    tokens = suffix_tokens()
+    regex = re.compile(abbrev_regex(suffixes))
+    replacement = suffix_standardizer.replacement
+
+    def regex_path():
+        for token in tokens:
+            if regex.match(token):
+                if token.upper() in replacement:
+                    replacement[token.upper()]
+
+    def table_path():
+        for token in tokens:
+            if suffix_standardizer.match(token):
+                suffix_standardizer(token)
+
+    results = {}
+    for name, func in (('regex', regex_path), ('table', table_path)):
+        best = min(timeit.repeat(func, repeat=repeat, number=number))
+        results[name] = best / (number * len(tokens)) * 1e6
+    return results
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the address parser.')
+    parser.add_argument('--cf-log', help='Civic Footprint log to take locations from (default: the sample in make_cf_tests)')
+    parser.add_argument('--repeat', type=int, default=3, help='passes over each corpus')
+    parser.add_argument('-o', '--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved results')
+    parser.add_argument('--suffixes', action='store_true', help='run the suffix matching micro-benchmark instead')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        old, new = [json.load(open(filename)) for filename in args.compare]
+        print '\n'.join(compare(old, new))
+    elif args.suffixes:
+        results = benchmark_suffix_matching()
+        print "Suffix matching, %d tokens:" % len(suffix_tokens())
+        for name in ('regex', 'table'):
+            print "  %-6s %.3f us/token" % (name, results[name])
+        print "  speedup %.1fx" % (results['regex'] / results['table'])
+    else:
+        suite = run_suite({'auto': auto_corpus(), 'cf': cf_corpus(args.cf_log)}, args.repeat)
+        print '\n'.join(format_results(suite))
+        if args.output:
+            f = open(args.output, 'w')
+            try:
+                json.dump(suite, f, indent=2, sort_keys=True)
+            finally:
+                f.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
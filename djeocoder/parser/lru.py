@@ -0,0 +1,149 @@
+import sys
+import threading
+from collections import OrderedDict
+
+def approximate_size(value):
+    """
+    Returns a rough count of the bytes held by a value, following lists,
+    tuples, dicts and the slots of objects that have them (such as Location
+    objects) down to their contents.
+
+    >>> approximate_size('ABC') > approximate_size('A')
+    True
+    >>> approximate_size(['ABC']) > approximate_size('ABC')
+    True
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.iteritems():
+            size += approximate_size(k) + approximate_size(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            size += approximate_size(v)
+    else:
+        for slot in getattr(type(value), '__slots__', ()):
+            size += approximate_size(getattr(value, slot, None))
+    return size
+
+class LRUCache(object):
+    """
+    A thread-safe mapping that holds at most max_entries items, and at most
+    max_bytes bytes of keys and values (as measured by sizeof), evicting the
+    least recently used items once either budget is exceeded. A budget of
+    None is unbounded.
+
+    >>> cache = LRUCache(max_entries=2)
+    >>> cache.put('a', 1); cache.put('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3)
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.stats().items())
+    [('bytes', 0), ('entries', 2), ('evictions', 1), ('hits', 1), ('misses', 1)]
+    """
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        if sizeof is None:
+            if max_bytes is None:
+                sizeof = lambda key, value: 0
+            else:
+                sizeof = lambda key, value: approximate_size(key) + approximate_size(value)
+        self.sizeof = sizeof
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """
+        Empties the cache and resets its counters.
+        """
+        self.items = OrderedDict() # key -> (value, size), oldest first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for key (marking it as most recently used),
+        or default if there isn't one.
+        """
+        with self.lock:
+            try:
+                entry = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.items[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Caches value under key, evicting older items as needed. A value that
+        alone exceeds max_bytes isn't cached.
+        """
+        size = self.sizeof(key, value)
+        with self.lock:
+            if key in self.items:
+                self.bytes -= self.items.pop(key)[1]
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self.items[key] = (value, size)
+            self.bytes += size
+            while (self.max_entries is not None and len(self.items) > self.max_entries) or \
+                  (self.max_bytes is not None and self.bytes > self.max_bytes):
+                oldest_value, oldest_size = self.items.popitem(last=False)[1]
+                self.bytes -= oldest_size
+                self.evictions += 1
+
+    def discard(self, key):
+        """
+        Removes key from the cache, if it's there.
+        """
+        with self.lock:
+            if key in self.items:
+                self.bytes -= self.items.pop(key)[1]
+
+    def discard_matching(self, predicate):
+        """
+        Removes every item for which predicate(key, value) is true, returning
+        how many there were.
+
+        >>> cache = LRUCache()
+        >>> cache.put('a', 1); cache.put('b', 2)
+        >>> cache.discard_matching(lambda key, value: value > 1)
+        1
+        >>> 'b' in cache
+        False
+        """
+        with self.lock:
+            matching = [key for key, (value, size) in self.items.iteritems() if predicate(key, value)]
+            for key in matching:
+                self.bytes -= self.items.pop(key)[1]
+            return len(matching)
+
+    def stats(self):
+        """
+        Returns the cache's hit, miss and eviction counters and its current
+        number of entries and bytes, as a dict.
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.items),
+                'bytes': self.bytes,
+            }
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
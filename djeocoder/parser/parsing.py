@@ -3,10 +3,7 @@ import string
 from itertools import izip
 
 # The following are all relative imports
-from suffixes import suffixes
-from states import states
-from cities import cities
-from numbered_streets import numbered_streets
+import tables
 
 class ParsingError(Exception):
     pass
@@ -31,6 +28,7 @@ class Standardizer(object):
 
     For example, given the text "avenu" for suffixes, returns "AVE".
 
+    >>> from suffixes import suffixes
     >>> suff_standardizer = Standardizer(suffixes)
     >>> suff_standardizer("avenu")
     'AVE'
@@ -39,6 +37,12 @@ class Standardizer(object):
     'N'
     >>> dir_standardizer("n")
     'N'
+
+    A Standardizer can also stand in for an abbrev_regex() of the same dict,
+    as a whole-token, case-insensitive matcher that costs one hash lookup:
+
+    >>> bool(suff_standardizer.match("Ave")), bool(suff_standardizer.match("Ave S"))
+    (True, False)
     """
     def __init__(self, d):
         self.replacement = {}
@@ -51,11 +55,23 @@ class Standardizer(object):
             # Also map the standard to itself.
             self.replacement[standard] = standard
 
+    @classmethod
+    def from_replacement(cls, replacement):
+        """
+        Creates a Standardizer from another one's replacement table.
+        """
+        standardizer = cls.__new__(cls)
+        standardizer.replacement = replacement
+        return standardizer
+
     def __call__(self, s):
-        if s.upper() in self.replacement:
-            return self.replacement[s.upper()]
-        else:
-            return s
+        return self.replacement.get(s.upper(), s)
+
+    def match(self, s):
+        """
+        Returns True if s is one of the forms this Standardizer knows.
+        """
+        return s.upper() in self.replacement
 
 def number_standardizer(s):
     """
@@ -69,16 +85,35 @@ def number_standardizer(s):
         return s
     return m.group(1)
 
-dir_standardizer = Standardizer(DIRECTIONALS)
+# The dicts of standard forms that Standardizers are built from. Apart from
+# DIRECTIONALS, each comes from the module of the same name.
+STANDARD_FORMS = ('directionals', 'suffixes', 'numbered_streets', 'cities', 'states')
+
+def standard_forms(name):
+    if name == 'directionals':
+        return DIRECTIONALS
+    return getattr(__import__(name, globals(), locals(), [name]), name)
+
+# The precompiled tables (see build_tables()), or None if they haven't been
+# built or are out of date, in which case everything is built from scratch.
+_tables = tables.load()
+
+def load_standardizer(name):
+    if _tables is not None:
+        return Standardizer.from_replacement(_tables['standardizers'][name])
+    return Standardizer(standard_forms(name))
+
+dir_standardizer = load_standardizer('directionals')
+suffix_standardizer = load_standardizer('suffixes')
 
 STANDARDIZERS = {
     'number': number_standardizer,
     'pre_dir': dir_standardizer,
-    'street': Standardizer(numbered_streets),
-    'suffix': Standardizer(suffixes),
+    'street': load_standardizer('numbered_streets'),
+    'suffix': suffix_standardizer,
     'post_dir': dir_standardizer,
-    'city': Standardizer(cities),
-    'state': Standardizer(states),
+    'city': load_standardizer('cities'),
+    'state': load_standardizer('states'),
 }
 
 # Regex which matches all punctuation, except for dashes (which
@@ -88,7 +123,93 @@ punct = re.compile(r'[%s]' % re.escape("".join(set(string.punctuation) - set(pre
 
 half_addresses_re = re.compile(r'(?<=\s)[I1]/2(?=\s)')
 multi_dash_re = re.compile(r'(?<=\d)\s*-+\s*(?=\d)')
+whitespace_re = re.compile(r'\s+')
 zip_plus_4_re = re.compile(r'(?<=^\d{5})-\d{4}$')
+unit_re = re.compile(r'(?i)(\s*,)?\s*(?:space\s+|suite\s+|ste\.?\s+|unit:?\s+|apt\.?\s+|\#\s*)[-\#0-9a-z]*$')
+
+# The stages of normalize(). Each one checks whether it could apply to the
+# string at all before running its regex, since most addresses have no
+# slashes, dashes or ZIP+4 codes.
+
+def uppercase(location):
+    return location.upper()
+
+def strip_half_addresses(location):
+    """
+    Strips the "1/2" from half addresses such as "123 1/2 MAIN ST".
+    """
+    if '/' in location:
+        return half_addresses_re.sub('', location)
+    return location
+
+def join_dashed_numbers(location):
+    """
+    Joins the numbers of address ranges such as "123 - 125" with a single
+    dash.
+    """
+    if '-' in location:
+        return multi_dash_re.sub('-', location)
+    return location
+
+_punct_chars = "".join(set(string.punctuation) - set(preserved_puncts))
+_unicode_punct_table = dict((ord(c), None) for c in _punct_chars)
+
+def remove_punctuation(location):
+    """
+    Removes all punctuation except dashes and ampersands.
+    """
+    if isinstance(location, unicode):
+        return location.translate(_unicode_punct_table)
+    return location.translate(None, _punct_chars)
+
+def collapse_whitespace(location):
+    """
+    Strips leading and trailing whitespace, and replaces every other run of
+    whitespace with a single space.
+    """
+    if isinstance(location, unicode):
+        # unicode.split() would also split on non-ASCII spaces, which \s
+        # doesn't match in a non-Unicode regex.
+        return whitespace_re.sub(' ', location.strip())
+    return ' '.join(location.split())
+
+def strip_zip_plus_4(location):
+    """
+    Strips the +4 part of a location that is only a ZIP+4.
+    """
+    if len(location) == 10 and location[5] == '-':
+        return zip_plus_4_re.sub('', location)
+    return location
+
+class Normalizer(object):
+    """
+    A normalization pipeline, which passes a string through each of a list
+    of stages (functions from string to string) in turn.
+
+    >>> Normalizer([uppercase, collapse_whitespace])(" 1972  n. dawson ")
+    '1972 N. DAWSON'
+    """
+    def __init__(self, stages):
+        self.stages = tuple(stages)
+
+    def __call__(self, location):
+        for stage in self.stages:
+            location = stage(location)
+        return location
+
+NORMALIZE_STAGES = (
+    uppercase,
+    strip_half_addresses,
+    join_dashed_numbers,
+    remove_punctuation,
+    collapse_whitespace,
+    strip_zip_plus_4,
+)
+
+# The pipeline normalize() runs. It can be replaced with a Normalizer of
+# other stages (before enabling the parse cache, which would otherwise hold
+# on to the old results).
+normalizer = Normalizer(NORMALIZE_STAGES)
 
 def normalize(location):
     """
@@ -101,19 +222,25 @@ def normalize(location):
     >>> normalize(u"n kimball ave & w diversey ave")
     u'N KIMBALL AVE & W DIVERSEY AVE'
     """
-    location = location.upper()
-    location = half_addresses_re.sub('', location) # Strip "1/2" addresses.
-    location = multi_dash_re.sub('-', location)
-    location = punct.sub('', location) # Remove all punctuation except dashes, and ampersands.
-    location = re.sub(r'\s+', ' ', location.strip()) # Strip/normalize whitespace.
-    location = zip_plus_4_re.sub('', location) # Strip the +4 part of a ZIP+4.
-    return location
+    if _cache is not None:
+        return _cache.normalize(location)
+    return normalizer(location)
+
+# Every string unit_re matches contains one of these (ignoring case).
+_unit_markers = ('#', 'SPACE', 'SUITE', 'STE', 'UNIT', 'APT')
 
 def strip_unit(location):
     """
     Given an address string, strips the apartment number, suite number, etc.
+
+    >>> strip_unit("1972 N DAWSON AVE APT 3B")
+    '1972 N DAWSON AVE'
     """
-    return re.sub(r'(?i)(\s*,)?\s*(?:space\s+|suite\s+|ste\.?\s+|unit:?\s+|apt\.?\s+|\#\s*)[-\#0-9a-z]*$', '', location)
+    upper = location.upper()
+    for marker in _unit_markers:
+        if marker in upper:
+            return unit_re.sub('', location)
+    return location
 
 ###########
 # PARSING #
@@ -155,14 +282,17 @@ def abbrev_regex(d, case_insensitive=True, matches_entirely=True):
         pattern = "(?i)" + pattern
     return pattern
 
-directional_re = re.compile(abbrev_regex(DIRECTIONALS))
-
-TOKEN_REGEXES = {
+# What each token type can look like: anything with a match() method that
+# takes a token and returns whether it's of that type, which is mostly
+# compiled regexes. Directionals and suffixes are matched by their
+# Standardizers' lookup tables rather than by the equivalent (but much
+# slower) abbrev_regex() alternations.
+TOKEN_MATCHERS = {
     'number': re.compile(r'^\d+[A-Z]?(?:-\d+[A-Z]?)?$'),
-    'pre_dir': directional_re,
+    'pre_dir': dir_standardizer,
     'street': re.compile(r'^[0-9]{1,3}(?:ST|ND|RD|TH)|[A-Z]{1,25}|[0-9]{1,3}$'),
-    'suffix': re.compile(abbrev_regex(suffixes)),
-    'post_dir': directional_re,
+    'suffix': suffix_standardizer,
+    'post_dir': dir_standardizer,
 
     # Cities are assumed to have at least three letters and at most 25 letters.
     # This is a safe assumption that comes from this page:
@@ -177,22 +307,168 @@ TOKEN_REGEXES = {
     'zip': re.compile(r'^\d{5}(?:-\d{4})?$'),
 }
 
-class Location(dict):
+# The name TOKEN_MATCHERS had when its values were all regexes.
+TOKEN_REGEXES = TOKEN_MATCHERS
+
+# The order of the token types determines their bit in a classification mask.
+TOKEN_TYPES = ('number', 'pre_dir', 'street', 'suffix', 'post_dir', 'city', 'state', 'zip')
+TOKEN_TYPE_BITS = dict((token_type, 1 << i) for i, token_type in enumerate(TOKEN_TYPES))
+
+# Token types that share a matcher (pre_dir and post_dir) are tested together.
+_token_classifiers = []
+for _token_type in TOKEN_TYPES:
+    for _i, (_matcher, _bits) in enumerate(_token_classifiers):
+        if _matcher is TOKEN_MATCHERS[_token_type]:
+            _token_classifiers[_i] = (_matcher, _bits | TOKEN_TYPE_BITS[_token_type])
+            break
+    else:
+        _token_classifiers.append((TOKEN_MATCHERS[_token_type], TOKEN_TYPE_BITS[_token_type]))
+del _token_type, _i, _matcher, _bits
+
+def classify_token(token):
+    """
+    Returns a bitmask of every token type (see TOKEN_TYPE_BITS) whose matcher
+    matches the given token.
+
+    >>> mask = classify_token('AVE')
+    >>> bool(mask & TOKEN_TYPE_BITS['suffix']), bool(mask & TOKEN_TYPE_BITS['number'])
+    (True, False)
+    """
+    mask = 0
+    for matcher, bits in _token_classifiers:
+        if matcher.match(token):
+            mask |= bits
+    return mask
+
+def classify_tokens(tokens):
+    """
+    Classifies each of the given tokens, testing each one against each token
+    type exactly once. Returns a list of bitmasks, one per token.
+
+    >>> [mask_token_types(mask) for mask in classify_tokens(['228', 'S'])]
+    [('number', 'street'), ('pre_dir', 'street', 'post_dir')]
+    """
+    return [classify_token(token) for token in tokens]
+
+def mask_token_types(mask):
+    """
+    Returns the tuple of token types set in a classification bitmask.
+    """
+    return tuple([token_type for token_type in TOKEN_TYPES if mask & TOKEN_TYPE_BITS[token_type]])
+
+class Location(object):
+    """
+    A parsed location: a fixed record of the token types in location_keys,
+    each None or a string. It behaves like a dict of those keys (which it
+    used to be), so loc['street'], dict(loc) and **loc all work, but it
+    stores its values in slots, making it much smaller and quicker to create.
+
+    >>> loc = Location({'number': '228', 'street': 'BROADWAY'})
+    >>> loc['pre_dir'] = 'S'
+    >>> loc
+    {'number': '228', 'pre_dir': 'S', 'street': 'BROADWAY', 'suffix': None, 'post_dir': None, 'city': None, 'state': None, 'zip': None}
+    >>> dict(loc) == loc
+    True
+    >>> loc['apt'] = '3'
+    Traceback (most recent call last):
+    ...
+    AttributeError: 'apt'
+    """
     location_keys = ('number', 'pre_dir', 'street', 'suffix', 'post_dir', 'city', 'state', 'zip')
+    __slots__ = location_keys
 
-    def __init__(self, *args):
-        super(Location, self).__init__(*args)
+    def __init__(self, *args, **kwargs):
         for location_key in self.location_keys:
-            if location_key not in self:
-                self[location_key] = None
+            setattr(self, location_key, None)
+        if args or kwargs:
+            self.update(*args, **kwargs)
 
     def __repr__(self):
-        return "{%s}" % ", ".join(["%r: %r" % (k, self[k]) for k in self.location_keys])
+        return "{%s}" % ", ".join(["%r: %r" % (k, getattr(self, k)) for k in self.location_keys])
+
+    def __getitem__(self, name):
+        if name not in _location_key_set:
+            raise KeyError(name)
+        return getattr(self, name)
 
     def __setitem__(self, name, value):
-        if name not in self.location_keys:
+        if name not in _location_key_set:
             raise AttributeError(repr(name))
-        super(Location, self).__setitem__(name, value)
+        setattr(self, name, value)
+
+    def __contains__(self, name):
+        return name in _location_key_set
+
+    def __iter__(self):
+        return iter(self.location_keys)
+
+    def __len__(self):
+        return len(self.location_keys)
+
+    def __eq__(self, other):
+        if isinstance(other, Location):
+            return self.values() == other.values()
+        elif isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return self.values()
+
+    def __setstate__(self, state):
+        for location_key, value in izip(self.location_keys, state):
+            setattr(self, location_key, value)
+
+    def keys(self):
+        return list(self.location_keys)
+
+    def values(self):
+        return [getattr(self, k) for k in self.location_keys]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.location_keys]
+
+    def iterkeys(self):
+        return iter(self.location_keys)
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def get(self, name, default=None):
+        if name in _location_key_set:
+            return getattr(self, name)
+        return default
+
+    def update(self, *args, **kwargs):
+        if args:
+            other = args[0]
+            if hasattr(other, 'keys'):
+                for k in other.keys():
+                    self[k] = other[k]
+            else:
+                for k, v in other:
+                    self[k] = v
+        for k, v in kwargs.items():
+            self[k] = v
+
+    def copy(self):
+        result = Location.__new__(Location)
+        for location_key in self.location_keys:
+            setattr(result, location_key, getattr(self, location_key))
+        return result
+
+_location_key_set = frozenset(Location.location_keys)
 
 def address_combinations():
     """
@@ -212,43 +488,326 @@ def address_combinations():
                                 for zip_times in (0, 1):
                                     yield ['number'] * number_times + ['pre_dir'] * pre_dir_times + ['street'] * street_times + ['suffix'] * suffix_times + ['post_dir'] * post_dir_times + ['city'] * city_times + ['state'] * state_times + ['zip'] * zip_times
 
-punc_split = re.compile(r"\S+").findall
+def build_combination_index(combinations):
+    """
+    Indexes a sequence of token-type lists (as yielded by
+    address_combinations()) by their length.
+
+    Returns a dict mapping each token count to a prefix tree over the
+    token types of every combination with that many tokens. A tree node is a
+    list of (token_type, child) pairs in the order the combinations were
+    given; the node reached after the last token type is the combination
+    itself, as a tuple.
+
+    >>> index = build_combination_index([['street'], ['street', 'suffix'], ['street', 'city']])
+    >>> index[1]
+    [('street', ('street',))]
+    >>> index[2]
+    [('street', [('suffix', ('street', 'suffix')), ('city', ('street', 'city'))])]
+    """
+    index = {}
+    for token_types in combinations:
+        token_types = tuple(token_types)
+        node = index.setdefault(len(token_types), [])
+        for depth, token_type in enumerate(token_types):
+            if depth == len(token_types) - 1:
+                node.append((token_type, token_types))
+                break
+            for child_type, child in node:
+                if child_type == token_type:
+                    node = child
+                    break
+            else:
+                child = []
+                node.append((token_type, child))
+                node = child
+    return index
+
+# Every address combination, enumerated once and indexed by token count, so
+# that parse() only ever walks the combinations that could fit its input.
+if _tables is not None:
+    COMBINATION_INDEX = _tables['combination_index']
+else:
+    COMBINATION_INDEX = build_combination_index(address_combinations())
+
+def build_tables():
+    """
+    Builds the lookup tables that are otherwise constructed on every import,
+    for tables.save() to write to the precompiled tables file.
+    """
+    return {
+        'standardizers': dict([(name, Standardizer(standard_forms(name)).replacement) for name in STANDARD_FORMS]),
+        'combination_index': build_combination_index(address_combinations()),
+    }
 
-def parse(location):
-    s = strip_unit(normalize(location))
-    tokens = punc_split(s)
-    len_tokens = len(tokens)
+def matching_combinations(tokens, masks=None):
+    """
+    Returns the token-type tuple of every address combination that matches
+    the given list of tokens, in address_combinations() order.
+
+    Combinations are validated against the tokens' classification bitmasks
+    (as returned by classify_tokens(), which is called if masks isn't given),
+    and a token that doesn't have a token type prunes every combination
+    sharing that prefix.
+
+    >>> matching_combinations(['228', 'BROADWAY'])
+    [('street', 'city'), ('street', 'street'), ('number', 'street')]
+    """
+    if masks is None:
+        masks = classify_tokens(tokens)
     result_list = []
+    tree = COMBINATION_INDEX.get(len(masks))
+    if tree is not None and all(masks):
+        _collect_combinations(tree, masks, 0, result_list)
+    return result_list
+
+def _collect_combinations(node, masks, depth, result_list):
+    mask = masks[depth]
+    last = depth == len(masks) - 1
+    for token_type, child in node:
+        if mask & TOKEN_TYPE_BITS[token_type]:
+            if last:
+                result_list.append(child)
+            else:
+                _collect_combinations(child, masks, depth + 1, result_list)
+
+punc_split = re.compile(r"\S+").findall
+
+def tokenize(location):
+    """
+    Normalizes the given location string, strips any unit from it and splits
+    it into the tokens that parse() classifies.
+
+    >>> tokenize(u"1972 n. dawson ave., apt 3")
+    [u'1972', u'N', u'DAWSON', u'AVE']
+    """
+    return punc_split(strip_unit(normalize(location)))
+
+def build_location(tokens, token_types):
+    """
+    Creates the standardized Location for a list of tokens and the
+    combination of token types they matched.
+    """
+    values = {}
+    for token, token_type in izip(tokens, token_types):
+        if token_type in values:
+            values[token_type] += ' ' + token
+        else:
+            values[token_type] = token
+
+    # Standardize all values.
+    result = Location()
+    for key, value in values.iteritems():
+        if key in STANDARDIZERS:
+            value = STANDARDIZERS[key](value)
+        setattr(result, key, value)
+    return result
 
-    for token_types in address_combinations():
-        if len(token_types) == len_tokens:
-            try:
-                for token, token_type in izip(tokens, token_types):
-                    if not TOKEN_REGEXES[token_type].match(token):
-                        raise StopIteration() # Token regex didn't match.
-            except StopIteration:
-                continue
-
-            # If we made it this far, then all of the tokens are valid.
-            # Create the Location object.
-            result = Location()
-            for token, token_type in izip(tokens, token_types):
-                if result[token_type]:
-                    result[token_type] += ' ' + token
-                else:
-                    result[token_type] = token
-
-            # Standardize all values.
-            for key, value in result.items():
-                if value and key in STANDARDIZERS:
-                    result[key] = STANDARDIZERS[key](value)
-
-            result_list.append(result)
+def parse_tokens(tokens):
+    """
+    Returns a Location for every address combination that matches the given
+    tokens (as returned by tokenize()), or an empty list if none do.
+    """
+    # If a combination matched, then all of the tokens are valid.
+    return [build_location(tokens, token_types) for token_types in matching_combinations(tokens)]
 
+def parse(location):
+    if _cache is not None:
+        return _cache.parse(location)
+    result_list = parse_tokens(tokenize(location))
     if not result_list:
         raise ParsingError("Failed to parse location %r" % location)
     return result_list
 
+def candidate_rank(tokens, token_types):
+    """
+    Returns a sort key ranking how plausible it is that the tokens have the
+    given token types (lower is more plausible). In order, it prefers:
+
+    * interpretations with a house number,
+    * then ones whose state (if any) is a known state,
+    * then ones with fewer words that can't be checked against a table --
+      the street name, plus the city if it isn't a known city,
+    * then ones with an explicit suffix.
+    """
+    words = {}
+    for token, token_type in izip(tokens, token_types):
+        words.setdefault(token_type, []).append(token)
+    free_words = len(words.get('street', ()))
+    if 'city' in words and not STANDARDIZERS['city'].match(' '.join(words['city'])):
+        free_words += len(words['city'])
+    unknown_state = 'state' in words and not STANDARDIZERS['state'].match(' '.join(words['state']))
+    return ('number' not in words, unknown_state, free_words, 'suffix' not in words)
+
+def iter_parse(location):
+    """
+    Yields the same Locations as parse(), but lazily and most plausible first
+    (see candidate_rank()), so that a caller can stop at the first one that
+    checks out. Raises ParsingError, before yielding anything, if the
+    location can't be parsed.
+
+    >>> candidates = iter_parse('228 S Broadway Ave S Chicago IL')
+    >>> candidates.next()
+    {'number': '228', 'pre_dir': 'S', 'street': 'BROADWAY', 'suffix': 'AVE', 'post_dir': 'S', 'city': 'CHICAGO', 'state': 'IL', 'zip': None}
+    """
+    tokens = tokenize(location)
+    combinations = matching_combinations(tokens)
+    if not combinations:
+        raise ParsingError("Failed to parse location %r" % location)
+    # sorted() is stable, so equally plausible candidates keep parse() order.
+    for token_types in sorted(combinations, key=lambda token_types: candidate_rank(tokens, token_types)):
+        yield build_location(tokens, token_types)
+
+###########
+# CACHING #
+###########
+
+class ParseCache(object):
+    """
+    Memoizes normalize() and parse() in two LRU tiers: normalized strings
+    keyed on the raw location string, and parse results keyed on the
+    normalized string (so differently-punctuated spellings of an address
+    share one entry). Failed parses are cached too.
+
+    max_entries and max_bytes bound each tier separately. Every call to
+    parse() returns fresh copies of the cached Locations, so callers are free
+    to modify them.
+
+    >>> cache = ParseCache(max_entries=100)
+    >>> cache.parse('228 S. Broadway')[-1]['street']
+    'BROADWAY'
+    >>> cache.parse('228 s broadway')[-1]['street']
+    'BROADWAY'
+    >>> cache.stats()['parse']['hits']
+    1
+    """
+    def __init__(self, max_entries=10000, max_bytes=None):
+        # Imported here so that parse-only users don't pay for threading.
+        from lru import LRUCache
+        self.normalized = LRUCache(max_entries, max_bytes)
+        self.parsed = LRUCache(max_entries, max_bytes)
+
+    def normalize(self, location):
+        normalized = self.normalized.get(location)
+        if normalized is None:
+            normalized = normalizer(location)
+            self.normalized.put(location, normalized)
+        return normalized
+
+    def parse(self, location):
+        normalized = self.normalize(location)
+        result_list = self.parsed.get(normalized)
+        if result_list is None:
+            result_list = tuple(parse_tokens(punc_split(strip_unit(normalized))))
+            self.parsed.put(normalized, result_list)
+        if not result_list:
+            raise ParsingError("Failed to parse location %r" % location)
+        return [result.copy() for result in result_list]
+
+    def clear(self):
+        self.normalized.clear()
+        self.parsed.clear()
+
+    def stats(self):
+        """
+        Returns the hit, miss and eviction counters of the 'normalize' and
+        'parse' tiers.
+        """
+        return {'normalize': self.normalized.stats(), 'parse': self.parsed.stats()}
+
+# The ParseCache used by normalize() and parse(), if caching is enabled.
+_cache = None
+
+def enable_cache(max_entries=10000, max_bytes=None):
+    """
+    Makes normalize() and parse() memoize their results in a new ParseCache
+    with the given budgets, and returns it.
+    """
+    global _cache
+    _cache = ParseCache(max_entries, max_bytes)
+    return _cache
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+def cache_stats():
+    """
+    Returns the counters of the cache used by normalize() and parse(), or None
+    if caching isn't enabled.
+    """
+    if _cache is None:
+        return None
+    return _cache.stats()
+
+def combinations_of_length(length):
+    """
+    Returns the token-type tuple of every address combination with the given
+    number of tokens, in address_combinations() order.
+    """
+    result_list = []
+    stack = [COMBINATION_INDEX.get(length, [])]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, tuple):
+            result_list.append(node)
+        else:
+            stack.extend([child for token_type, child in reversed(node)])
+    return result_list
+
+# Lazily-built NumPy tables for parse_many(), keyed by token count: one row
+# per combination, holding the TOKEN_TYPES index of each token's type.
+_combination_tables = {}
+
+def _combination_table(length):
+    import numpy
+    if length not in _combination_tables:
+        combinations = combinations_of_length(length)
+        table = numpy.array([[TOKEN_TYPES.index(t) for t in token_types] for token_types in combinations], dtype=numpy.intp)
+        _combination_tables[length] = (combinations, table.reshape(len(combinations), length))
+    return _combination_tables[length]
+
+def parse_many(locations):
+    """
+    Parses a batch of location strings. Returns a list holding, for each
+    location, the same list of Locations that parse() returns for it -- or an
+    empty list where parse() would raise ParsingError.
+
+    Each distinct token in the batch is classified once, and the locations
+    are matched against the combination table of their token count all at
+    once, as a (locations x tokens x token types) boolean matrix.
+
+    >>> parse_many(['228 S Broadway', '#']) == [parse('228 S Broadway'), []]
+    True
+    """
+    # NumPy is only needed for batch parsing.
+    import numpy
+
+    token_lists = [tokenize(location) for location in locations]
+    masks = {}
+    rows_by_length = {}
+    for row, tokens in enumerate(token_lists):
+        for token in tokens:
+            if token not in masks:
+                masks[token] = classify_token(token)
+        rows_by_length.setdefault(len(tokens), []).append(row)
+
+    result_lists = [[] for tokens in token_lists]
+    type_bits = numpy.array([TOKEN_TYPE_BITS[t] for t in TOKEN_TYPES])
+    for length, rows in rows_by_length.items():
+        combinations, table = _combination_table(length)
+        if not combinations:
+            continue
+        token_masks = numpy.array([[masks[token] for token in token_lists[row]] for row in rows]).reshape(len(rows), length)
+        type_matrix = (token_masks[:, :, numpy.newaxis] & type_bits) != 0
+        # valid[i, c] is set when every token of row i has the type that
+        # combination c gives it.
+        valid = type_matrix[:, numpy.arange(length), table].all(axis=2)
+        for i, c in zip(*numpy.nonzero(valid)):
+            row = rows[i]
+            result_lists[row].append(build_location(token_lists[row], combinations[c]))
+    return result_lists
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod(optionflags=doctest.ELLIPSIS)
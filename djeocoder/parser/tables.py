@@ -0,0 +1,83 @@
+"""
+A cache file of the lookup tables that parsing.py otherwise builds on every
+import (the standardizers' replacement tables and the address combination
+index), so that short-lived processes can load them with a single read.
+
+Build (or rebuild) it with:
+
+    python tables.py
+
+The tables are stored with marshal, which loads plain lists, tuples and dicts
+several times faster than cPickle. The file records TABLES_VERSION, the
+marshal format version, and the modification time and size of each of the
+modules the tables are built from; if any of those has changed, the file is
+ignored and parsing.py builds the tables itself.
+"""
+import os
+import marshal
+
+TABLES_VERSION = 1
+
+TABLES_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+TABLES_FILENAME = os.path.join(TABLES_DIRECTORY, 'tables.cache')
+
+# The modules whose contents the tables are built from.
+TABLE_SOURCES = ('parsing.py', 'suffixes.py', 'states.py', 'cities.py', 'numbered_streets.py')
+
+def fingerprint(directory=TABLES_DIRECTORY):
+    """
+    Returns the version stamp that a cache file built from the sources in
+    directory must have, or None if any of them is missing.
+    """
+    stamps = []
+    for source in TABLE_SOURCES:
+        try:
+            st = os.stat(os.path.join(directory, source))
+        except OSError:
+            return None
+        stamps.append((source, int(st.st_mtime), st.st_size))
+    return (TABLES_VERSION, marshal.version, tuple(stamps))
+
+def load(filename=TABLES_FILENAME):
+    """
+    Returns the tables saved in filename, or None if there's no such file or
+    it's out of date.
+    """
+    expected = fingerprint()
+    if expected is None:
+        return None
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    try:
+        stamp, tables = marshal.loads(data)
+    except Exception:
+        # A truncated file, or one written by an incompatible version.
+        return None
+    if stamp != expected:
+        return None
+    return tables
+
+def save(tables, filename=TABLES_FILENAME):
+    """
+    Saves tables (as returned by parsing.build_tables()) to filename.
+    """
+    data = marshal.dumps((fingerprint(), tables))
+    # Write-and-rename, so a concurrent import never reads a partial file.
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    f = open(tmp, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp, filename)
+
+if __name__ == "__main__":
+    import parsing
+    save(parsing.build_tables())
+    print "Wrote %s" % TABLES_FILENAME
@@ -10,41 +10,67 @@ from parsing import parse
 from parsing import address_combinations
 from parsing import ParsingError 
 from parsing import Location
+from parsing import TOKEN_MATCHERS
+from parsing import TOKEN_TYPES
+from parsing import TOKEN_TYPE_BITS
+from parsing import classify_tokens
+from parsing import parse_many
+from parsing import iter_parse
+from parsing import normalize, strip_unit
+from parsing import ParseCache
+from parsing import abbrev_regex, suffix_standardizer, DIRECTIONALS, dir_standardizer
+from lru import LRUCache
+from suffixes import suffixes
+from benchmarks import suffix_tokens, run_suite, compare, cf_corpus
+import re
+import os
+import tempfile
+import tables
+from parsing import build_tables, COMBINATION_INDEX, STANDARDIZERS
+from parsing import matching_combinations
 
 import unittest
 
+# token type, (one-word sample, two-word sample, three-word sample, ...)
+TEST_DATA = (
+    ('number', ('228',)),
+    ('pre_dir', ('S',)),
+    ('street', ('BROADWAY', 'OLD MILL', 'MARTIN LUTHER KING', 'MARTIN LUTHER KING JR', 'DR MARTIN LUTHER KING JR')),
+    ('suffix', ('AVE',)),
+    ('post_dir', ('S',)),
+    ('city', ('CHICAGO', 'SAN FRANCISCO', 'NEW YORK CITY', 'OLD NEW YORK CITY')),
+    ('state', ('IL', 'NEW HAMPSHIRE')),
+    ('zip', ('60604',)),
+)
+
+def auto_location_cases():
+    """
+    Yields a (token_types, location string, expected Location) triple for
+    every combination of test data (defined in TEST_DATA).
+    """
+    for token_types in address_combinations():
+        test_input = []
+        expected = Location()
+        for t_type, samples in TEST_DATA:
+            count = token_types.count(t_type)
+            if count:
+                test_input.append(samples[count-1])
+                expected[t_type] = samples[count-1]
+
+        # Take the normalization into account.
+        if expected['state'] == 'NEW HAMPSHIRE':
+            expected['state'] = 'NH'
+
+        yield token_types, ' '.join(test_input), expected
+
 class AutoLocationMetaclass(type):
     """
     Metaclass that adds a test method for every combination of test data
-    (defined in TEST_DATA).
+    (see auto_location_cases()).
     """
     def __new__(cls, name, bases, attrs):
-        TEST_DATA = (
-            # token type, (one-word sample, two-word sample, three-word sample, ...)
-            ('number', ('228',)),
-            ('pre_dir', ('S',)),
-            ('street', ('BROADWAY', 'OLD MILL', 'MARTIN LUTHER KING', 'MARTIN LUTHER KING JR', 'DR MARTIN LUTHER KING JR')),
-            ('suffix', ('AVE',)),
-            ('post_dir', ('S',)),
-            ('city', ('CHICAGO', 'SAN FRANCISCO', 'NEW YORK CITY', 'OLD NEW YORK CITY')),
-            ('state', ('IL', 'NEW HAMPSHIRE')),
-            ('zip', ('60604',)),
-        )
-        for token_types in address_combinations():
-            test_input = []
-            expected = Location()
-            for t_type, samples in TEST_DATA:
-                count = token_types.count(t_type)
-                if count:
-                    test_input.append(samples[count-1])
-                    expected[t_type] = samples[count-1]
-
-            # Take the normalization into account.
-            if expected['state'] == 'NEW HAMPSHIRE':
-                expected['state'] = 'NH'
-
-            location = ' '.join(test_input)
-            func = lambda self: self.assertParseContains(location, expected)
+        for token_types, location, expected in auto_location_cases():
+            func = lambda self, location=location, expected=expected: self.assertParseContains(location, expected)
             func.__doc__ = location
             attrs['test_%s' % '_'.join(token_types)] = func
 
@@ -265,5 +291,191 @@ class LocationTestCase(unittest.TestCase):
             {'number': '1110', 'pre_dir': None, 'street': 'BRONX RIVER', 'suffix': 'AVE', 'post_dir': None, 'city': 'THE BRONX', 'state': None, 'zip': None},
         )
 
+class LocationRecordTestCase(unittest.TestCase):
+    def test_mapping_compatibility(self):
+        loc = parse('11466 S Saint Louis Ave, Chicago, IL, 60655')[-1]
+        kwargs = (lambda **kwargs: kwargs)(**loc)
+        self.assertEqual(kwargs, dict(loc))
+        self.assertEqual(dict(loc, suffix=None)['suffix'], None)
+        self.assertEqual(sorted(loc.keys()), sorted(Location.location_keys))
+        self.assertRaises(KeyError, lambda: loc['apt'])
+
+    def test_copy_is_independent(self):
+        loc = Location(street='MAIN')
+        copy = loc.copy()
+        copy['street'] = 'ELM'
+        self.assertEqual((loc['street'], copy['street']), ('MAIN', 'ELM'))
+        self.assertNotEqual(loc, copy)
+
+class CombinationIndexTestCase(unittest.TestCase):
+    def test_matches_full_enumeration(self):
+        # The indexed walk must find exactly the combinations (and in the same
+        # order) that a scan over every address_combinations() entry would.
+        tokens = ['228', 'S', 'BROADWAY', 'AVE', 'CHICAGO', 'IL']
+        expected = [tuple(token_types) for token_types in address_combinations()
+                    if len(token_types) == len(tokens)
+                    and all(TOKEN_MATCHERS[t].match(token) for token, t in zip(tokens, token_types))]
+        self.assertEqual(matching_combinations(tokens), expected)
+
+    def test_no_combination_of_that_length(self):
+        self.assertEqual(matching_combinations(['1'] * 30), [])
+
+class ClassifyTokensTestCase(unittest.TestCase):
+    def test_masks_agree_with_matchers(self):
+        tokens = ['228', 'S', 'BROADWAY', 'AVE', '60604', 'IL', '25-82', '5TH', 'NEW']
+        for token, mask in zip(tokens, classify_tokens(tokens)):
+            for token_type in TOKEN_TYPES:
+                self.assertEqual(bool(mask & TOKEN_TYPE_BITS[token_type]),
+                                 bool(TOKEN_MATCHERS[token_type].match(token)),
+                                 '%r as %s' % (token, token_type))
+
+    def test_unclassifiable_token(self):
+        self.assertEqual(classify_tokens(['#']), [0])
+        self.assertEqual(matching_combinations(['123', '#', 'MAIN']), [])
+
+class ParseManyTestCase(unittest.TestCase):
+    def assertParsesSame(self, locations):
+        expected = []
+        for location in locations:
+            try:
+                expected.append(parse(location))
+            except ParsingError:
+                expected.append([])
+        self.assertEqual(parse_many(locations), expected)
+
+    def test_auto_location_cases(self):
+        self.assertParsesSame([location for token_types, location, expected in auto_location_cases()])
+
+    def test_mixed_batch(self):
+        self.assertParsesSame(['11466 S Saint Louis Ave, Chicago, IL, 60655', '', '#', '123 1/2 MAIN ST',
+                               '2833A-2835A W CHICAGO AVE', ' '.join(['MAIN'] * 30), '123 Main St Bronx'])
+
+class StandardizerMatchTestCase(unittest.TestCase):
+    def test_agrees_with_abbrev_regex(self):
+        for d, standardizer in ((suffixes, suffix_standardizer), (DIRECTIONALS, dir_standardizer)):
+            regex = re.compile(abbrev_regex(d))
+            for token in suffix_tokens() + ['n', 'Northeast', 'SOUTHWEST', 'AVE S', '']:
+                self.assertEqual(bool(standardizer.match(token)), bool(regex.match(token)), repr(token))
+
+class IterParseTestCase(unittest.TestCase):
+    def test_same_candidates_as_parse(self):
+        for location in ['228 S BROADWAY AVE S CHICAGO IL', '1401 Grand Concourse, The Bronx', '123 Main St Bronx']:
+            self.assertEqual(sorted(map(repr, iter_parse(location))), sorted(map(repr, parse(location))))
+
+    def test_most_plausible_first(self):
+        self.assertEqual(iter_parse('329 50 ST, MANHATTAN').next(),
+            {'number': '329', 'pre_dir': None, 'street': '50TH', 'suffix': 'ST', 'post_dir': None, 'city': 'MANHATTAN', 'state': None, 'zip': None})
+
+    def test_parsing_error(self):
+        self.assertRaises(ParsingError, list, iter_parse('#'))
+
+def reference_normalize(location):
+    # normalize() as it was before it became a Normalizer pipeline.
+    import string
+    punct = re.compile(r'[%s]' % re.escape("".join(set(string.punctuation) - set("-&"))))
+    location = location.upper()
+    location = re.sub(r'(?<=\s)[I1]/2(?=\s)', '', location)
+    location = re.sub(r'(?<=\d)\s*-+\s*(?=\d)', '-', location)
+    location = punct.sub('', location)
+    location = re.sub(r'\s+', ' ', location.strip())
+    location = re.sub(r'(?<=^\d{5})-\d{4}$', '', location)
+    return location
+
+def reference_strip_unit(location):
+    return re.sub(r'(?i)(\s*,)?\s*(?:space\s+|suite\s+|ste\.?\s+|unit:?\s+|apt\.?\s+|\#\s*)[-\#0-9a-z]*$', '', location)
+
+class NormalizerTestCase(unittest.TestCase):
+    locations = [
+        u"1972 n. dawson ave. chicago il", u"1972 n. dawson ave., chicago il", u"n kimball ave & w diversey ave",
+        '11466 S Saint Louis Ave, Chicago, IL, 60655', '123 1/2 MAIN ST', '123 I/2 MAIN ST', '123 - 125 MAIN ST',
+        '123- 125 MAIN ST', '123 -125 MAIN ST', '123--125 MAIN ST', '2833A-2835A W CHICAGO AVE', '25-82 MAIN ST, QUEENS',
+        '3624 S. John Hancock Jr. Road', '60604-1234', ' 60604 - 1234 ', '\t12 Main St\n', u'12\xa0Main St',
+        '12 Main St Apt. 3', '12 Main St, Suite 100', '12 Main St #3-B', '12 Main St unit: 7', '12 Main St ste 2',
+    ]
+
+    def test_same_as_reference(self):
+        locations = self.locations + [location for token_types, location, expected in auto_location_cases()]
+        for location in locations:
+            for expected, actual in ((reference_normalize(location), normalize(location)),
+                                     (reference_strip_unit(location), strip_unit(location))):
+                self.assertEqual(actual, expected)
+                self.assertEqual(type(actual), type(expected))
+
+class TablesTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def test_round_trip(self):
+        tables.save(build_tables(), self.filename)
+        loaded = tables.load(self.filename)
+        self.assertEqual(loaded['combination_index'], COMBINATION_INDEX)
+        self.assertEqual(loaded['standardizers']['states'], STANDARDIZERS['state'].replacement)
+
+    def test_stale_or_corrupt_file_ignored(self):
+        open(self.filename, 'wb').write('not a table file')
+        self.assertEqual(tables.load(self.filename), None)
+        tables.save(build_tables(), self.filename)
+        original = tables.TABLES_VERSION
+        tables.TABLES_VERSION = original + 1
+        try:
+            self.assertEqual(tables.load(self.filename), None)
+        finally:
+            tables.TABLES_VERSION = original
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_entry_budget_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assert_('a' in cache and 'c' in cache and 'b' not in cache)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_byte_budget(self):
+        cache = LRUCache(max_bytes=100, sizeof=lambda key, value: value)
+        cache.put('a', 60)
+        cache.put('b', 30)
+        cache.put('c', 30)
+        self.assertEqual(sorted(cache.items.keys()), ['b', 'c'])
+        self.assertEqual(cache.stats()['bytes'], 60)
+        cache.put('d', 500)
+        self.assert_('d' not in cache)
+
+class ParseCacheTestCase(unittest.TestCase):
+    def test_returns_copies(self):
+        cache = ParseCache()
+        first = cache.parse('123 Main St Bronx')
+        first[0]['street'] = 'CHANGED'
+        self.assertEqual(cache.parse('123 Main St Bronx'), parse('123 Main St Bronx'))
+
+    def test_normalized_tier_shared(self):
+        cache = ParseCache()
+        cache.parse('123 Main St., Bronx')
+        cache.parse('123 main st bronx')
+        stats = cache.stats()
+        self.assertEqual(stats['normalize']['misses'], 2)
+        self.assertEqual(stats['parse']['hits'], 1)
+
+    def test_failures_cached(self):
+        cache = ParseCache()
+        for i in range(2):
+            self.assertRaises(ParsingError, cache.parse, '#')
+        self.assertEqual(cache.stats()['parse']['hits'], 1)
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_suite_and_compare(self):
+        suite = run_suite({'cf': cf_corpus()}, repeat=1)
+        stats = suite['results']['cf']['parse']
+        self.assertEqual(stats['calls'], len(cf_corpus()))
+        self.assert_(stats['p50_us'] <= stats['p99_us'])
+        lines = compare(suite, suite)
+        self.assertEqual(len(lines), 3 * 5)
+        self.assert_(all(line.endswith('+0.0%') or line.endswith('n/a') for line in lines), lines)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,196 @@
+import time
+import threading
+from contextlib import contextmanager
+
+class PoolError(Exception):
+    pass
+
+class PoolTimeout(PoolError):
+    pass
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of database connections, for the geocoder and the
+    Postgis searchers to borrow one from per lookup instead of sharing a
+    single connection.
+
+    connect is a function of no arguments that opens a new DB-API connection,
+    e.g. lambda: psycopg2.connect('dbname=openblock'). The pool opens
+    min_size connections up front and never holds more than max_size; a
+    checkout that finds them all in use waits up to timeout seconds (forever,
+    if timeout is None) before raising PoolTimeout. Connections that are
+    discarded aren't replaced until a checkout needs them, so the pool may
+    hold fewer than min_size.
+
+    Each idle connection is checked on checkout by running health_check (a
+    query), and replaced with a new one if that fails, so a dropped
+    connection is reconnected rather than handed out.
+
+        pool = ConnectionPool(lambda: psycopg2.connect(dsn), max_size=10, timeout=5)
+        geocoder = LocalGeocoder(pool)
+    """
+    def __init__(self, connect, min_size=1, max_size=5, timeout=None, health_check='SELECT 1'):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('Need 0 <= min_size <= max_size and max_size >= 1')
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check = health_check
+        self.idle = []
+        self.size = 0 # Connections open, idle or checked out.
+        self.closed = False
+        self.condition = threading.Condition()
+        for i in range(min_size):
+            self.idle.append(self.connect())
+            self.size += 1
+
+    def getconn(self, timeout=None):
+        """
+        Checks out a healthy connection. It must be given back with putconn().
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = timeout is not None and time.time() + timeout or None
+        self.condition.acquire()
+        try:
+            while True:
+                if self.closed:
+                    raise PoolError('Connection pool is closed')
+                if self.idle:
+                    conn = self.idle.pop()
+                    break
+                if self.size < self.max_size:
+                    # Reserve the slot now, and connect outside the lock.
+                    self.size += 1
+                    conn = None
+                    break
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeout('No connection available within %s seconds' % timeout)
+                    self.condition.wait(remaining)
+        finally:
+            self.condition.release()
+
+        if conn is not None and self._healthy(conn):
+            return conn
+        if conn is not None:
+            self._close(conn)
+        try:
+            return self.connect()
+        except:
+            self._release_slot()
+            raise
+
+    def putconn(self, conn, discard=False):
+        """
+        Gives back a connection from getconn(). It's closed instead of kept if
+        discard is true, or if it's broken.
+        """
+        if not discard:
+            try:
+                # End whatever transaction the lookup left open.
+                conn.rollback()
+            except Exception:
+                discard = True
+        if discard or getattr(conn, 'closed', False):
+            self._close(conn)
+            self._release_slot()
+            return
+        self.condition.acquire()
+        try:
+            if self.closed:
+                self._close(conn)
+                self.size -= 1
+            else:
+                self.idle.append(conn)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        A context manager that checks out a connection for the duration of a
+        with block. If the block raises, the connection is rolled back (or
+        closed, if that fails) before going back to the pool.
+        """
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        except:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def closeall(self):
+        """
+        Closes the idle connections, and the checked-out ones as they're given
+        back. The pool can't be used after this.
+        """
+        self.condition.acquire()
+        try:
+            self.closed = True
+            for conn in self.idle:
+                self._close(conn)
+            self.size -= len(self.idle)
+            self.idle = []
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def _healthy(self, conn):
+        if getattr(conn, 'closed', False):
+            return False
+        if not self.health_check:
+            return True
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(self.health_check)
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            conn.rollback()
+        except Exception:
+            return False
+        return True
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _release_slot(self):
+        self.condition.acquire()
+        try:
+            self.size -= 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+class _Unpooled(object):
+    """
+    Lends out a single, shared connection.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+    def __enter__(self):
+        return self.conn
+    def __exit__(self, *exc_info):
+        return False
+
+def borrow(source):
+    """
+    Returns a context manager that lends out a connection from source, which
+    is either a ConnectionPool or a plain connection (which is lent as it is,
+    and left open).
+    """
+    if isinstance(source, ConnectionPool):
+        return source.connection()
+    return _Unpooled(source)
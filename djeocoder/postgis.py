@@ -1,7 +1,24 @@
-import psycopg2
+import re
+import hashlib
+import weakref
+import threading
+from itertools import izip
 
 from parser.parsing import normalize, parse, ParsingError
-from results import BlockResult, IntersectionResult, parse_point
+from results import BlockResult, IntersectionResult
+# PointParsingException was defined here before results.py raised it, and is
+# still importable from here for code that catches postgis.PointParsingException.
+from results import PointParsingException
+from geometry import line_vertices, interpolate_point
+from pool import borrow
+
+# TODO: There's also a GeocoderException class in djeocoder.py
+# -- these should probably be merged.
+class GeocodingException(Exception):
+    pass
+
+class DoesNotExist(GeocodingException):
+    pass
 
 class Correction:
     def __init__(self, incorrect, correct):
@@ -9,33 +26,124 @@ class Correction:
         self.correct = correct
 
 class SpellingCorrector: 
+    # Raised by correct() for a street it has no correction for, as
+    # StreetMisspelling.DoesNotExist was in Openblock.
+    DoesNotExist = DoesNotExist
+
     def correct(self, incorrect):
         # by default, correct nothing.
         return Correction(incorrect, incorrect)
 
-# TODO: There's also a GeocoderException class in djeocoder.py
-# -- these should probably be merged.
-class GeocodingException(Exception):
-    pass
+    def spell(self, street):
+        """
+        Returns the correct spelling of street: its correction, or street
+        itself if there's none.
+        """
+        try:
+            return self.correct(street).correct
+        except DoesNotExist:
+            return street
 
-class DoesNotExist(GeocodingException):
-    pass
+def interpolation_fraction(number, from_num, to_num):
+    """
+    Returns how far along a block numbered from from_num to to_num the given
+    house number lies, between 0 and 1.
+    """
+    try:
+        return (float(number) - from_num) / (to_num - from_num)
+    except TypeError:
+        # TODO: revisit this clause.  We're getting here because the 'number' field was zero.  What do
+        # we do in this case?  What does the original code do? 
+        return 0.5
+    except ZeroDivisionError:
+        return 0.5
+
+# The columns of the rows that PostgisBlockSearcher.fetch_street() returns.
+STREET_COLUMNS = ('id', 'pretty_name', 'from_num', 'to_num', 'left_from_num', 'left_to_num', 'right_from_num', 'right_to_num',
+                  'ST_AsBinary(geom)', 'predir', 'suffix', 'postdir', 'left_city', 'right_city', 'left_state', 'right_state',
+                  'left_zip', 'right_zip')
+
+# The SQLSTATE of a PREPARE of a name that's taken.
+DUPLICATE_PREPARED_STATEMENT = '42P05'
+
+class PreparedStatements(object):
+    """
+    Runs queries as server-side prepared statements, so that Postgres plans
+    each of them once per connection rather than on every lookup. Each
+    distinct query text (such as each combination of the optional filters of
+    PostgisBlockSearcher.search()) is PREPAREd, under a name of its own, the
+    first time it's run on a connection, and EXECUTEd from then on.
+
+    A statement is named by a hash of its query, so instances that share a
+    connection agree on the names: one that finds its statement already
+    prepared (by another) rolls back the failed PREPARE and EXECUTEs it. It's
+    still best to share one instance, which prepares each statement once.
+    """
+    def __init__(self, prefix='djeocoder'):
+        self.prefix = prefix
+        self.names = {} # query -> statement name, memoized
+        self.prepared = weakref.WeakKeyDictionary() # connection -> set of statement names
+        self.lock = threading.Lock()
+
+    def name(self, query):
+        with self.lock:
+            if query not in self.names:
+                digest = hashlib.sha1(isinstance(query, unicode) and query.encode('utf-8') or query).hexdigest()
+                self.names[query] = '%s_%s' % (self.prefix, digest[:16])
+            return self.names[query]
+
+    def prepare(self, conn, cursor, query):
+        """
+        Prepares query on conn, if it isn't already, returning its name.
+        """
+        name = self.name(query)
+        with self.lock:
+            prepared = self.prepared.setdefault(conn, set())
+            if name in prepared:
+                return name
+        # Number the placeholders, $1, $2 and so on.
+        numbers = iter(range(1, query.count('%s') + 1))
+        try:
+            cursor.execute('PREPARE %s AS %s' % (name, re.sub('%s', lambda m: '$%d' % numbers.next(), query)))
+        except Exception, e:
+            if getattr(e, 'pgcode', None) != DUPLICATE_PREPARED_STATEMENT:
+                raise
+            # Prepared by another instance, under the same name and so for
+            # the same query; the error aborted the transaction, though.
+            conn.rollback()
+        with self.lock:
+            prepared.add(name)
+        return name
+
+    def execute(self, conn, cursor, query, params=()):
+        name = self.prepare(conn, cursor, query)
+        if params:
+            cursor.execute('EXECUTE %s (%s)' % (name, ', '.join(['%s'] * len(params))), params)
+        else:
+            cursor.execute('EXECUTE %s' % name)
 
-class PointParsingException(Exception):
-    def __init__(self, str):
-        self.str = str
-    def __repr__(self):
-        return 'String \'%s\' could not be parsed into points.' % self.str
+def _execute(statements, conn, cursor, query, params):
+    if statements is None:
+        cursor.execute(query, params)
+    else:
+        statements.execute(conn, cursor, query, params)
 
+# The query of PostgisBlockSearcher.fetch_street().
+STREET_QUERY = 'select %s from blocks where street=%%s' % ', '.join(STREET_COLUMNS)
 
 class PostgisBlockSearcher:
     """
     Replaces the everyblock class \"BlockManager\".
     Handles interaction with the underlying database, taking a call to the search() method, converting it into a query,
     and then forming the response rows into BlockResult objects.
+
+    conn is either a connection or a pool.ConnectionPool, which search()
+    borrows a connection from for each lookup. Queries are run as prepared
+    statements if a PreparedStatements is given.
     """
-    def __init__(self, conn): 
+    def __init__(self, conn, statements=None): 
         self.conn =conn
+        self.statements = statements
         
     def close(self):
         # self.conn.close()
@@ -52,7 +160,10 @@ class PostgisBlockSearcher:
         """
         if not number: return True, from_num, to_num
         
-        parity = int(number) % 2
+        # parse() gives the number as a string, which would compare greater
+        # than every int below.
+        number = int(number)
+        parity = number % 2
         if left_from_num and right_from_num:
             left_parity = left_from_num % 2
             # If this block's left side has the same parity as the right side,
@@ -79,12 +190,12 @@ class PostgisBlockSearcher:
                     return False, from_num, to_num
         return (from_num <= number <= to_num), from_num, to_num
 
-    def search(self,street,number=None,pre_dir=None,suffix=None,post_dir=None,city=None,state=None,zip=None,left_city=None,right_city=None):
-        query = 'select id, pretty_name, from_num, to_num, left_from_num, left_to_num, right_from_num, right_to_num, ST_AsEWKT(geom) from blocks where street=%s' 
+    def _block_query(self, street, number=None, pre_dir=None, suffix=None, post_dir=None, city=None, state=None, zip=None):
+        query = 'select id, pretty_name, from_num, to_num, left_from_num, left_to_num, right_from_num, right_to_num, ST_AsBinary(geom) from blocks where street=%s' 
         params = [street.upper()]
         if pre_dir: 
             query += ' and predir=%s' 
-            params.apepnd(pre_dir.upper())
+            params.append(pre_dir.upper())
         if suffix: 
             query += ' and suffix=%s' 
             params.append(suffix.upper())
@@ -105,12 +216,19 @@ class PostgisBlockSearcher:
         if number: 
             query += ' and from_num <= %s and to_num >= %s' 
             params.extend([number, number])
+        return query, params
+
+    def search(self,street,number=None,pre_dir=None,suffix=None,post_dir=None,city=None,state=None,zip=None,left_city=None,right_city=None):
+        query, params = self._block_query(street, number, pre_dir, suffix, post_dir, city, state, zip)
 
-        cursor = self.conn.cursor()
-        cursor.execute(query, tuple(params))
+        with borrow(self.conn) as conn:
+            cursor = conn.cursor()
+            _execute(self.statements, conn, cursor, query, tuple(params))
+            rows = cursor.fetchall()
+            cursor.close()
 
         blocks = []
-        for block in cursor.fetchall(): 
+        for block in rows: 
             containment = self.contains_number(number, block[2], block[3], block[4], block[5], block[6], block[7])
             if containment[0]: blocks.append([block, containment[1], containment[2]])
             
@@ -118,43 +236,95 @@ class PostgisBlockSearcher:
         
         for b in blocks: 
             block = b[0]
-            from_num = b[1]
-            to_num = b[2]
-            try:
-                fraction = (float(number) - from_num) / (to_num - from_num)
-            except TypeError:
-                # TODO: revisit this clause.  We're getting here because the 'number' field was zero.  What do
-                # we do in this case?  What does the original code do? 
-                fraction = 0.5
-            except ZeroDivisionError:
-                fraction = 0.5
-
-            # TODO: when we want to extract the geocoder from dependence on
-            # Postgis, this is one of the main dependencies: we'll need to introduce
-            # a new GIS library, so that we can do this interpolation "in code" -TWD
-            cursor.execute('SELECT ST_AsEWKT(line_interpolate_point(%s, %s))', [block[8], fraction])
-            wkt_str = cursor.fetchone()[0]
-            
-            x,y = parse_point(wkt_str)
-            final_blocks.append(BlockResult(block, wkt_str))
+            fraction = interpolation_fraction(number, b[1], b[2])
+            # Interpolated here, as line_interpolate_point() would, rather
+            # than with a query per block.
+            final_blocks.append(BlockResult(block, interpolate_point(line_vertices(block[8]), fraction)))
             
-        cursor.close()
         return final_blocks
 
+    def fetch_street(self, street):
+        """
+        Returns the rows of every block on a street, whatever their other
+        fields, without interpolating any points: the columns that search()
+        selects, followed by those it filters on (see STREET_COLUMNS). Any
+        number of lookups on the street can then be evaluated against them in
+        memory with filter_blocks().
+        """
+        with borrow(self.conn) as conn:
+            cursor = conn.cursor()
+            _execute(self.statements, conn, cursor, STREET_QUERY, (street.upper(),))
+            rows = cursor.fetchall()
+            cursor.close()
+        return rows
+
+    def filter_blocks(self, rows, number=None, pre_dir=None, suffix=None, post_dir=None, city=None, state=None, zip=None):
+        """
+        Returns the rows from fetch_street() that search() would find with the
+        same arguments, as (row, from_num, to_num) triples giving the range of
+        numbers to interpolate the house number along.
+        """
+        if number:
+            number = int(number)
+        pre_dir = pre_dir and pre_dir.upper()
+        suffix = suffix and suffix.upper()
+        post_dir = post_dir and post_dir.upper()
+        city = city and city.upper()
+        state = state and state.upper()
+        blocks = []
+        for row in rows:
+            if (pre_dir and row[9] != pre_dir) or (suffix and row[10] != suffix) or (post_dir and row[11] != post_dir):
+                continue
+            if (city and city not in row[12:14]) or (state and state not in row[14:16]) or (zip and zip not in row[16:18]):
+                continue
+            if number and not (row[2] is not None and row[3] is not None and row[2] <= number <= row[3]):
+                continue
+            containment = self.contains_number(number, *row[2:8])
+            if containment[0]:
+                blocks.append((row, containment[1], containment[2]))
+        return blocks
+
+    def interpolate(self, lines):
+        """
+        Given a list of (line, fraction) pairs, with the lines as WKB (as
+        fetch_street() gives them) or EWKT, returns the (x, y) point that
+        fraction of the way along each line, as search() places each block it
+        finds.
+        """
+        return [interpolate_point(line_vertices(line), fraction) for line, fraction in lines]
+
+# The numbers of pairs that search_pairs() runs prepared VALUES queries for:
+# a lookup of fewer pairs is padded to the next of them.
+PAIR_BATCH_SIZES = (1, 2, 4, 8, 16)
+
+# The filters of PostgisIntersectionSearcher.search(), in the order of the
+# VALUES columns of search_pairs().
+INTERSECTION_FIELDS = ('predir_a', 'street_a', 'suffix_a', 'postdir_a', 'predir_b', 'street_b', 'suffix_b', 'postdir_b')
+
 class PostgisIntersectionSearcher:
     """
     Replaces the IntersectionManager clmass.
+
+    conn is either a connection or a pool.ConnectionPool, and statements a
+    PreparedStatements or None, as for PostgisBlockSearcher.
+
+    With street_pair_key, a lookup of both streets of an intersection
+    matches them against the street_lo and street_hi columns that the
+    intersections_street_pair migration adds (see migrations.py), with one
+    index lookup whichever order they're given in, rather than against
+    street_a or street_b in turn.
     """
-    def __init__(self,conn):
+    def __init__(self,conn, statements=None, street_pair_key=False):
         self.connection = conn
+        self.statements = statements
+        self.street_pair_key = street_pair_key
 
     def close(self):
         # self.connection.close()
         pass
     
-    def search(self, predir_a=None, street_a=None, suffix_a=None, postdir_a=None, predir_b=None, street_b=None, suffix_b=None, postdir_b=None):
-        cursor = self.connection.cursor()
-        query = 'select id, pretty_name, ST_AsEWKT(location) from intersections'
+    def _intersection_query(self, predir_a=None, street_a=None, suffix_a=None, postdir_a=None, predir_b=None, street_b=None, suffix_b=None, postdir_b=None):
+        query = 'select id, pretty_name, ST_X(location), ST_Y(location) from intersections'
         filters = []
         params = []
         if predir_a: 
@@ -163,12 +333,16 @@ class PostgisIntersectionSearcher:
         if predir_b: 
             filters.append('(predir_a=%s OR predir_b=%s)')
             params.extend([predir_b, predir_b])
-        if street_a: 
-            filters.append('(street_a=%s OR street_b=%s)')
-            params.extend([street_a, street_a])
-        if street_b: 
-            filters.append('(street_a=%s OR street_b=%s)')
-            params.extend([street_b, street_b])
+        if street_a and street_b and self.street_pair_key:
+            filters.append('street_lo=least(%s, %s) and street_hi=greatest(%s, %s)')
+            params.extend([street_a, street_b, street_a, street_b])
+        else:
+            if street_a: 
+                filters.append('(street_a=%s OR street_b=%s)')
+                params.extend([street_a, street_a])
+            if street_b: 
+                filters.append('(street_a=%s OR street_b=%s)')
+                params.extend([street_b, street_b])
         if suffix_a: 
             filters.append('(suffix_a=%s OR suffix_b=%s)')
             params.extend([suffix_a, suffix_a])
@@ -184,6 +358,10 @@ class PostgisIntersectionSearcher:
         if len(filters) > 0:
             wherestr = ' where %s' % reduce(lambda x, y: '%s and %s' % (x, y), filters)
             query += wherestr
+        return query, params
+
+    def search(self, predir_a=None, street_a=None, suffix_a=None, postdir_a=None, predir_b=None, street_b=None, suffix_b=None, postdir_b=None):
+        query, params = self._intersection_query(predir_a, street_a, suffix_a, postdir_a, predir_b, street_b, suffix_b, postdir_b)
 
         # This line is in IntersectionManager
         #   qs = qs.extra(select={"point": "AsText(location)"})
@@ -195,8 +373,71 @@ class PostgisIntersectionSearcher:
         # print query
         # print filters
 
-        cursor.execute(query, params)
-        results = cursor.fetchall()
-        cursor.close()
+        with borrow(self.connection) as conn:
+            cursor = conn.cursor()
+            _execute(self.statements, conn, cursor, query, params)
+            results = cursor.fetchall()
+            cursor.close()
+
+        return [IntersectionResult((res[0], res[1], (res[2], res[3]))) for res in results]
+
+    def _pairs_query(self, pairs, size=None):
+        # The VALUES list has size rows (len(pairs), by default), the ones
+        # past the pairs being padding: all nulls, which v.n is not null
+        # drops before the join.
+        size = size or len(pairs)
+        params = []
+        for i, pair in enumerate(pairs):
+            params.append(i)
+            params.extend([pair.get(field) or None for field in INTERSECTION_FIELDS])
+        params.extend([None] * ((len(INTERSECTION_FIELDS) + 1) * (size - len(pairs))))
+        # As in search(), a field that isn't given matches anything, and one
+        # that is matches either side of an intersection.
+        conditions = ['(v.%s is null OR i.%s_a=v.%s OR i.%s_b=v.%s)' % (field, field[:-2], field, field[:-2], field)
+                      for field in INTERSECTION_FIELDS]
+        if self.street_pair_key and all([pair.get('street_a') and pair.get('street_b') for pair in pairs]):
+            # Every pair has both streets, so they can all be matched on the
+            # street pair key.
+            conditions = ['i.street_lo=least(v.street_a, v.street_b) and i.street_hi=greatest(v.street_a, v.street_b)'] + \
+                         [condition for field, condition in izip(INTERSECTION_FIELDS, conditions) if not field.startswith('street_')]
+        # n is cast, as a prepared statement would otherwise take it as text.
+        query = ('select v.n, i.id, i.pretty_name, ST_X(i.location), ST_Y(i.location) from intersections i '
+                 'join (values %s) as v(n, %s) on v.n is not null and %s order by v.n, i.id' % (
+                     ', '.join(['(%%s::int, %s)' % ', '.join(['%s'] * len(INTERSECTION_FIELDS))] * size),
+                     ', '.join(INTERSECTION_FIELDS),
+                     ' and '.join(conditions)))
+        return query, params
+
+    def search_pairs(self, pairs):
+        """
+        Looks up many pairs of streets at once. pairs is a list of dicts of
+        the keyword arguments of search(); returns the list that search()
+        would return for each of them, with a single query that joins the
+        intersections table to a VALUES list of the pairs.
+
+        With prepared statements, the VALUES list is padded to the next of
+        PAIR_BATCH_SIZES, so that there are only a few queries to prepare;
+        a lookup of more pairs than that isn't prepared.
+        """
+        if not pairs:
+            return []
+        statements = self.statements
+        size = len(pairs)
+        if statements is not None:
+            sizes = [n for n in PAIR_BATCH_SIZES if n >= len(pairs)]
+            if sizes:
+                size = sizes[0]
+            else:
+                statements = None
+        query, params = self._pairs_query(pairs, size)
+
+        with borrow(self.connection) as conn:
+            cursor = conn.cursor()
+            _execute(statements, conn, cursor, query, params)
+            rows = cursor.fetchall()
+            cursor.close()
 
-        return [IntersectionResult(res) for res in results]
+        results = [[] for pair in pairs]
+        for row in rows:
+            results[row[0]].append(IntersectionResult((row[1], row[2], (row[3], row[4]))))
+        return results
@@ -1,9 +1,25 @@
 
 import re
 
-point_pattern = re.compile('POINT\((-?\d+\.\d+)\s+(-?\d+\.\d+)\)')
+# The SRID of the geometries in the blocks and intersections tables.
+SRID = 4326
+
+_number = r'(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)'
+point_pattern = re.compile(r'POINT\s*(?:ZM|Z|M)?\s*\(\s*%s\s+%s' % (_number, _number), re.IGNORECASE)
+
+class PointParsingException(Exception):
+    def __init__(self, str):
+        self.str = str
+    def __repr__(self):
+        return 'String \'%s\' could not be parsed into points.' % self.str
 
 def parse_point(wkt_str):
+    """
+    Returns the (x, y) of a POINT, given as (E)WKT.
+
+    >>> parse_point('SRID=4326;POINT(-87 41.5)')
+    (-87.0, 41.5)
+    """
     matcher = point_pattern.search(wkt_str)
     if matcher==None: raise PointParsingException(wkt_str)
     x = float(matcher.group(1))
@@ -14,10 +30,25 @@ def parse_point(wkt_str):
 # rather than raw tuples from the database.
 class LocatableResult:
     def __init__(self, location):
-        self.location = parse_point(location)
+        # Either the EWKT of a point, or an (x, y) pair that's already been
+        # parsed (or computed, as the points of blocks are).
+        if isinstance(location, tuple):
+            self.location = location
+        else:
+            self.location = parse_point(location)
     def __repr__(self):
         return '(%.5f,%.5f)' % (self.location[0], self.location[1])
 
+    @property
+    def ewkt(self):
+        """
+        The EWKT of the point, written as PostGIS writes it.
+
+        >>> LocatableResult((-87.6, 41.0)).ewkt
+        'SRID=4326;POINT(-87.6 41)'
+        """
+        return 'SRID=%d;POINT(%.15g %.15g)' % (SRID, self.location[0], self.location[1])
+
 class BlockResult(LocatableResult):
     """
     Objects of this class are returned by the PostgisBlockSearcher.search() method. 
@@ -81,3 +112,7 @@ class IntersectionResult(LocatableResult):
         self.pretty_name = intersection_tuple[1]
     def __repr__(self):
         return '%s %s' % (self.pretty_name, LocatableResult.__repr__(self))
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
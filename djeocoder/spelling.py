@@ -0,0 +1,165 @@
+"""
+Corrects misspelled street names against the streets in the blocks table,
+for the misspelling fallback of the address and intersection geocoders.
+
+    spelling = StreetSpellingCorrector.from_connection(cxn)
+    geocoder = LocalGeocoder(cxn, spelling=spelling)
+
+The streets are indexed by symmetric deletion: every string that can be made
+from a street by deleting up to max_distance letters maps back to the
+street. The streets within max_distance edits of a misspelling all share at
+least one such string with it, so a lookup only generates the misspelling's
+own deletions, and measures the distance to the few streets they lead to,
+rather than to every street in the city.
+"""
+import re
+
+from parser.lru import LRUCache
+from postgis import Correction, SpellingCorrector, DoesNotExist
+from pool import borrow
+from textfiles import BlockFileLoader
+
+def edit_distance(a, b):
+    """
+    Returns the number of insertions, deletions, substitutions and
+    transpositions of adjacent letters that turn a into b (the optimal
+    string alignment distance).
+
+    >>> edit_distance('BROADWAY', 'BRAODWAY')
+    1
+    >>> edit_distance('BROADWAY', 'BRODWY')
+    2
+    """
+    previous = None
+    row = range(len(b) + 1)
+    for i in range(1, len(a) + 1):
+        previous, row = row, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1] and 1 or 0
+            row[j] = min(previous[j] + 1, row[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], before[j - 2] + 1)
+        before = previous
+    return row[len(b)]
+
+def deletions(word, distance):
+    """
+    Returns the set of strings made by deleting up to distance letters from
+    word, including word itself.
+
+    >>> sorted(deletions('ELM', 1))
+    ['EL', 'ELM', 'EM', 'LM']
+    """
+    found = set([word])
+    edge = [word]
+    for d in range(distance):
+        next_edge = []
+        for w in edge:
+            for i in range(len(w)):
+                shorter = w[:i] + w[i + 1:]
+                if shorter not in found:
+                    found.add(shorter)
+                    next_edge.append(shorter)
+        edge = next_edge
+    return found
+
+def _digits(street):
+    return re.sub(r'\D', '', street)
+
+# Marks a memoized lookup that found no correction.
+_NO_CORRECTION = object()
+
+class StreetSpellingCorrector(SpellingCorrector):
+    """
+    Corrects a street name to the known street within max_distance edits of
+    it (see edit_distance()), preferring the closest, then the one with the
+    most blocks, then the first alphabetically. correct() raises
+    DoesNotExist for a street that's known already, or that has no street
+    within reach.
+
+    Short names allow fewer edits (one per three letters past the first), so
+    that 'ELM' isn't corrected to 'ASH'; and a correction must have the same
+    digits, so that '22ND' isn't corrected to '2ND'. The outcomes of the last
+    max_entries lookups are memoized.
+
+    streets is a sequence of (street, blocks) pairs, naming the streets as
+    the blocks table does (such as 'BROADWAY') with their number of blocks.
+    """
+    def __init__(self, streets, max_distance=2, max_entries=10000):
+        self.max_distance = max_distance
+        self.blocks = {}
+        for street, count in streets:
+            street = street.upper()
+            self.blocks[street] = self.blocks.get(street, 0) + count
+        # deletion -> streets it can be made from
+        self.index = {}
+        for street in self.blocks:
+            for deletion in deletions(street, max_distance):
+                self.index.setdefault(deletion, []).append(street)
+        self.memo = LRUCache(max_entries)
+
+    @classmethod
+    def from_connection(cls, conn, **kwargs):
+        """
+        Returns a corrector of the streets in the blocks table. conn is
+        either a connection or a pool.ConnectionPool.
+        """
+        with borrow(conn) as c:
+            cursor = c.cursor()
+            cursor.execute('select street, count(*) from blocks group by street')
+            rows = cursor.fetchall()
+            cursor.close()
+        return cls(rows, **kwargs)
+
+    @classmethod
+    def from_pipe_file(cls, filename, **kwargs):
+        """
+        Returns a corrector of the streets in a blocks pipe file, such as
+        blocks.txt.gz.
+        """
+        loader = BlockFileLoader(filename)
+        column = loader.columns['street']
+        counts = {}
+        for row in loader.rows:
+            if len(row) > column and row[column]:
+                counts[row[column]] = counts.get(row[column], 0) + 1
+        return cls(counts.items(), **kwargs)
+
+    def correct(self, incorrect):
+        street = incorrect.upper()
+        corrected = self.memo.get(street, None)
+        if corrected is None:
+            corrected = self._lookup(street)
+            self.memo.put(street, corrected)
+        if corrected is _NO_CORRECTION:
+            raise DoesNotExist('No correction for street %r' % incorrect)
+        return Correction(incorrect, corrected)
+
+    def _lookup(self, street):
+        if street in self.blocks:
+            return _NO_CORRECTION
+        limit = min(self.max_distance, (len(street) - 1) // 3)
+        if limit < 1:
+            return _NO_CORRECTION
+        digits = _digits(street)
+        best = None
+        seen = set()
+        for deletion in deletions(street, limit):
+            for candidate in self.index.get(deletion, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                if abs(len(candidate) - len(street)) > limit or _digits(candidate) != digits:
+                    continue
+                distance = edit_distance(street, candidate)
+                if distance <= limit:
+                    key = (distance, -self.blocks[candidate], candidate)
+                    if best is None or key < best:
+                        best = key
+        if best is None:
+            return _NO_CORRECTION
+        return best[2]
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,1071 @@
+"""
+Tests for the parts of the geocoder that don't need a database. The checks
+that run against a live PostGIS database are in test.py.
+"""
+import os
+import logging
+import re
+import struct
+import time
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+import cli
+import advisor
+import migrations
+from cache import GeocoderCache
+from async_geocoder import AsyncGeocoder, Future, MemoryBackend, ThreadPoolBackend, GeocoderBackend, GeocodeTimeout
+from djeocoder import LocalGeocoder, PostgisResult, PostgisAddressGeocoder, PostgisIntersectionGeocoder, StreetAddressGeocoder, DoesNotExist, InvalidBlockButValidStreet, AmbiguousResult
+from results import BlockResult, IntersectionResult, parse_point
+from parser.parsing import parse, ParsingError
+from pool import ConnectionPool, PoolTimeout, borrow
+from spelling import StreetSpellingCorrector
+from autocomplete import StreetAutocomplete
+from geometry import parse_line, parse_wkb_line, interpolate_point, line_interpolate_point, GeometryParsingException
+from postgis import PostgisBlockSearcher, PostgisIntersectionSearcher, SpellingCorrector, PreparedStatements, INTERSECTION_FIELDS
+
+class FakeGeocoder:
+    def geocode(self, location):
+        if location == 'NOWHERE':
+            raise DoesNotExist(location)
+        return PostgisResult(address=location, city='CHICAGO', state='IL', zip=None, point=(-87.5, 41.75))
+    def geocode_many(self, locations):
+        outcomes = []
+        for location in locations:
+            try:
+                outcomes.append((self.geocode(location), None))
+            except DoesNotExist, e:
+                outcomes.append((None, e))
+        return outcomes
+
+class CliTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.checkpoint = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.checkpoint)
+
+    def tearDown(self):
+        if os.path.exists(self.checkpoint):
+            os.unlink(self.checkpoint)
+
+    def geocode(self, lines, start_offset=0, **kwargs):
+        out = StringIO()
+        batches = cli.read_batches(lines, 2, start_offset)
+        cli.geocode_stream(batches, out, geocoder=FakeGeocoder(), checkpoint=self.checkpoint, **kwargs)
+        return [row.split('\t') for row in out.getvalue().splitlines()]
+
+    def test_rows_in_input_order(self):
+        rows = self.geocode(['1 MAIN ST\n', 'NOWHERE\n', '3 MAIN ST\n'], max_in_flight=1)
+        self.assertEqual([row[:3] for row in rows],
+                         [['0', '1 MAIN ST', 'OK'], ['1', 'NOWHERE', 'DoesNotExist'], ['2', '3 MAIN ST', 'OK']])
+        self.assertEqual(rows[0][3:], ['1 MAIN ST', 'CHICAGO', 'IL', '', '-87.500000', '41.750000'])
+
+    def test_checkpoint_and_resume(self):
+        lines = ['%d MAIN ST\n' % i for i in range(5)]
+        self.geocode(lines[:3])
+        self.assertEqual(cli.read_checkpoint(self.checkpoint)[0], 3)
+        rows = self.geocode(lines, start_offset=cli.read_checkpoint(self.checkpoint)[0])
+        self.assertEqual([row[0] for row in rows], ['3', '4'])
+        self.assertEqual(cli.read_checkpoint(self.checkpoint)[0], 5)
+
+    def test_resume_drops_rows_after_checkpoint(self):
+        fd, output = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, output)
+        lines = ['%d MAIN ST\n' % i for i in range(5)]
+        out = cli.open_output(output)
+        cli.geocode_stream(cli.read_batches(lines[:2], 2), out, geocoder=FakeGeocoder(), checkpoint=self.checkpoint)
+        # A crash after the next batch was written, but before its checkpoint.
+        out.write('2\t2 MAIN ST\tOK\n')
+        out.close()
+        offset, position = cli.read_checkpoint(self.checkpoint)
+        self.assertEqual((offset, position), (2, os.path.getsize(output) - len('2\t2 MAIN ST\tOK\n')))
+        out = cli.open_output(output, resume=True, position=position)
+        cli.geocode_stream(cli.read_batches(lines, 2, offset), out, geocoder=FakeGeocoder(), checkpoint=self.checkpoint)
+        out.close()
+        self.assertEqual([row.split('\t')[0] for row in open(output).read().splitlines()], ['0', '1', '2', '3', '4'])
+
+    def test_old_checkpoint(self):
+        cli.write_checkpoint(self.checkpoint, 3)
+        self.assertEqual(cli.read_checkpoint(self.checkpoint), (3, None))
+
+class RecordingAddressGeocoder(PostgisAddressGeocoder):
+    """
+    Answers block lookups from a dict of street name to results, recording
+    every location it's asked about.
+    """
+    def __init__(self, streets):
+        PostgisAddressGeocoder.__init__(self, None)
+        self.streets = streets
+        self.lookups = []
+
+    def _db_lookup(self, location):
+        self.lookups.append(location.copy())
+        return self.streets.get((location['pre_dir'], location['street']), [])
+
+class AddressGeocoderTestCase(unittest.TestCase):
+    def test_stops_at_first_hit(self):
+        result = PostgisResult(address='228 S BROADWAY AVE', point=(0.0, 0.0))
+        geocoder = RecordingAddressGeocoder({('S', 'BROADWAY'): [result]})
+        self.assertEqual(geocoder.geocode('228 S BROADWAY AVE S CHICAGO IL'), result)
+        self.assertEqual(len(geocoder.lookups), 1)
+
+    def test_does_not_exist(self):
+        geocoder = RecordingAddressGeocoder({})
+        self.assertRaises(DoesNotExist, geocoder.geocode, '228 BROADWAY')
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+    def execute(self, query, params=None):
+        if self.conn.broken:
+            raise IOError('server closed the connection unexpectedly')
+        self.conn.queries.append(query)
+    def fetchall(self):
+        return self.conn.rows
+    def close(self):
+        pass
+
+class FakeConnection:
+    """
+    Records the queries run on it, and answers every one with the same rows.
+    Once broken, every query fails.
+    """
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.queries = []
+        self.broken = False
+        self.closed = 0
+        self.rollbacks = 0
+    def cursor(self):
+        return FakeCursor(self)
+    def rollback(self):
+        self.rollbacks += 1
+    def commit(self):
+        pass
+    def close(self):
+        self.closed = 1
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.opened = []
+
+    def connect(self):
+        conn = FakeConnection([(1, 'N DAMEN AVE & W DIVERSEY PKWY', -87.68, 41.93)])
+        self.opened.append(conn)
+        return conn
+
+    def test_min_size_opened_up_front(self):
+        pool = ConnectionPool(self.connect, min_size=2, max_size=4)
+        self.assertEqual(len(self.opened), 2)
+        self.assertEqual(pool.size, 2)
+
+    def test_sizes_checked(self):
+        for min_size, max_size in ((-1, 2), (3, 2), (0, 0)):
+            self.assertRaises(ValueError, ConnectionPool, self.connect, min_size=min_size, max_size=max_size)
+
+    def test_reuses_returned_connection(self):
+        pool = ConnectionPool(self.connect, min_size=0, max_size=2)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.assertTrue(pool.getconn() is conn)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_checkout_timeout(self):
+        pool = ConnectionPool(self.connect, min_size=0, max_size=1, timeout=0.05)
+        conn = pool.getconn()
+        self.assertRaises(PoolTimeout, pool.getconn)
+        pool.putconn(conn)
+        self.assertTrue(pool.getconn() is conn)
+
+    def test_waits_for_returned_connection(self):
+        pool = ConnectionPool(self.connect, min_size=1, max_size=1, timeout=5)
+        conn = pool.getconn()
+        timer = threading.Timer(0.05, pool.putconn, (conn,))
+        timer.start()
+        self.assertTrue(pool.getconn() is conn)
+        timer.join()
+
+    def test_reconnects_dropped_connection(self):
+        pool = ConnectionPool(self.connect, min_size=1, max_size=1)
+        dropped = self.opened[0]
+        dropped.broken = True
+        conn = pool.getconn()
+        self.assertTrue(conn is not dropped)
+        self.assertEqual(dropped.closed, 1)
+        self.assertEqual(pool.size, 1)
+
+    def test_discard(self):
+        pool = ConnectionPool(self.connect, min_size=1, max_size=1)
+        conn = pool.getconn()
+        pool.putconn(conn, discard=True)
+        self.assertEqual(pool.size, 0)
+        self.assertTrue(pool.getconn() is not conn)
+
+    def test_connection_returned_on_error(self):
+        pool = ConnectionPool(self.connect, min_size=0, max_size=1, timeout=0.05)
+        def fail():
+            with pool.connection() as conn:
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(len(pool.idle), 1)
+
+    def test_searcher_borrows_per_lookup(self):
+        pool = ConnectionPool(self.connect, min_size=0, max_size=1, timeout=0.05)
+        searcher = PostgisIntersectionSearcher(pool)
+        for i in range(3):
+            results = searcher.search(street_a='DAMEN', street_b='DIVERSEY')
+            self.assertEqual(results[0].pretty_name, 'N DAMEN AVE & W DIVERSEY PKWY')
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(pool.idle, self.opened)
+
+    def test_borrow_plain_connection(self):
+        conn = FakeConnection()
+        with borrow(conn) as borrowed:
+            self.assertTrue(borrowed is conn)
+        self.assertEqual(conn.closed, 0)
+
+# The predir, suffix, postdir, cities, states and zips of the blocks of S
+# BROADWAY AVE, in the order of postgis.STREET_COLUMNS.
+BROADWAY = ('S', 'AVE', None, 'CHICAGO', 'CHICAGO', 'IL', 'IL', '60604', '60604')
+
+# The filters that PostgisBlockSearcher.search() may add to its query, in
+# order, with the number of parameters each takes and a test of a
+# fetch_street() row against the first.
+BLOCK_FILTERS = (
+    (' and predir=', 1, lambda row, value: row[9] == value),
+    (' and suffix=', 1, lambda row, value: row[10] == value),
+    (' and postdir=', 1, lambda row, value: row[11] == value),
+    (' and (left_city=', 2, lambda row, value: value in row[12:14]),
+    (' and (left_state=', 2, lambda row, value: value in row[14:16]),
+    (' and (left_zip=', 2, lambda row, value: value in row[16:18]),
+    (' and from_num <=', 2, lambda row, value: row[2] <= int(value) <= row[3]),
+)
+
+class FakeBlocksCursor(FakeCursor):
+    """
+    Answers block queries from the connection's blocks (a dict of street
+    name to fetch_street() rows).
+    """
+    def execute(self, query, params=None):
+        self.conn.queries.append(query)
+        if 'from blocks' in query:
+            self.rows = self.conn.blocks.get(params[0], [])
+            params = list(params[1:])
+            for clause, count, test in BLOCK_FILTERS:
+                if clause in query:
+                    self.rows = [row for row in self.rows if test(row, params[0])]
+                    params = params[count:]
+    def fetchall(self):
+        return self.rows
+    def fetchone(self):
+        return self.rows[0]
+
+class FakeBlocksConnection(FakeConnection):
+    def __init__(self, blocks):
+        FakeConnection.__init__(self)
+        self.blocks = blocks
+    def cursor(self):
+        return FakeBlocksCursor(self)
+
+class GeocodeManyTestCase(unittest.TestCase):
+    def setUp(self):
+        line = 'SRID=4326;LINESTRING(-87.6 41.0,-87.6 41.1)'
+        self.conn = FakeBlocksConnection({'BROADWAY': [
+            (1, 'BROADWAY AVE', 200, 298, 200, 298, 201, 299, line) + BROADWAY,
+            (2, 'BROADWAY AVE', 300, 398, 300, 398, 301, 399, line) + BROADWAY,
+        ]})
+        self.geocoder = LocalGeocoder(self.conn)
+
+    def queries(self, table):
+        return [q for q in self.conn.queries if table in q]
+
+    def test_one_query_per_street(self):
+        locations = ['228 S BROADWAY AVE', '326 S BROADWAY AVE', '230 S BROADWAY AVE']
+        outcomes = self.geocoder.geocode_many(locations)
+        self.assertEqual([result.address for result, error in outcomes], locations)
+        self.assertEqual([error for result, error in outcomes], [None, None, None])
+        self.assertAlmostEqual(outcomes[0][0].point[1], 41.0 + 0.1 * 28 / 98.0, 9)
+        self.assertAlmostEqual(outcomes[1][0].point[1], 41.0 + 0.1 * 26 / 98.0, 9)
+        self.assertEqual(len(self.queries('from blocks')), 1)
+        self.assertEqual(len(self.conn.queries), 1)
+        for location, (result, error) in zip(locations, outcomes):
+            self.assertEqual(self.geocoder.geocode(location).point, result.point)
+
+    def test_dedupes_by_normalized_form(self):
+        outcomes = self.geocoder.geocode_many(['228 S BROADWAY AVE', '228 s. Broadway  Ave', '228 S BROADWAY AVE'])
+        self.assertTrue(outcomes[0][0] is outcomes[1][0] is outcomes[2][0])
+        self.assertEqual(len(self.conn.queries), 1)
+
+    def test_errors_in_place(self):
+        outcomes = self.geocoder.geocode_many(['9999 S BROADWAY AVE CHICAGO', '228 S BROADWAY AVE', '', '9999 S BROADWAY AVE'])
+        self.assertEqual(outcomes[0][0], None)
+        self.assertTrue(isinstance(outcomes[0][1], InvalidBlockButValidStreet))
+        self.assertRaises(InvalidBlockButValidStreet, self.geocoder.geocode, '9999 S BROADWAY AVE CHICAGO')
+        self.assertEqual(outcomes[1][0].address, '228 S BROADWAY AVE')
+        self.assertTrue(isinstance(outcomes[2][1], ParsingError))
+        self.assertTrue(isinstance(outcomes[3][1], DoesNotExist))
+
+class FakeDatabaseError(Exception):
+    def __init__(self, pgcode):
+        Exception.__init__(self, pgcode)
+        self.pgcode = pgcode
+
+class FakePreparingCursor(FakeBlocksCursor):
+    """
+    Answers PREPARE and EXECUTE as Postgres would, running the prepared
+    query as a FakeBlocksCursor.
+    """
+    def execute(self, query, params=None):
+        words = query.split(None, 3)
+        if words[0] == 'PREPARE':
+            if words[1] in self.conn.prepared:
+                raise FakeDatabaseError('42P05')
+            self.conn.prepared[words[1]] = re.sub(r'\$\d+', '%s', words[3])
+            self.conn.queries.append(query)
+        elif words[0] == 'EXECUTE':
+            FakeBlocksCursor.execute(self, self.conn.prepared[words[1]], params)
+        else:
+            FakeBlocksCursor.execute(self, query, params)
+
+class FakePreparingConnection(FakeBlocksConnection):
+    def __init__(self, blocks):
+        FakeBlocksConnection.__init__(self, blocks)
+        self.prepared = {}
+    def cursor(self):
+        return FakePreparingCursor(self)
+
+class PreparedStatementsTestCase(unittest.TestCase):
+    def setUp(self):
+        line = 'SRID=4326;LINESTRING(-87.6 41.0,-87.6 41.1)'
+        self.blocks = {'BROADWAY': [(1, 'BROADWAY AVE', 200, 298, 200, 298, 201, 299, line) + BROADWAY]}
+
+    def prepares(self, conn):
+        return [q for q in conn.queries if q.startswith('PREPARE')]
+
+    def test_numbers_placeholders(self):
+        conn = FakePreparingConnection(self.blocks)
+        PreparedStatements().execute(conn, conn.cursor(), 'select %s from blocks where street=%s and predir=%s', (1, 'X', 'Y'))
+        self.assertEqual([re.sub(r'_\w+', '_N', q, 1) for q in self.prepares(conn)],
+                         ['PREPARE djeocoder_N AS select $1 from blocks where street=$2 and predir=$3'])
+
+    def test_geocoders_share_connection(self):
+        # Each has its own PreparedStatements, which agree on the names.
+        conn = FakePreparingConnection(self.blocks)
+        first, second = LocalGeocoder(conn, prepared=True), LocalGeocoder(conn, prepared=True)
+        self.assertEqual(first.geocode('228 S BROADWAY AVE').address, '228 S BROADWAY AVE')
+        rollbacks = conn.rollbacks
+        self.assertEqual(second.geocode('230 S BROADWAY AVE').address, '230 S BROADWAY AVE')
+        self.assertTrue(conn.rollbacks > rollbacks)
+        self.assertEqual(len(self.prepares(conn)), len(conn.prepared))
+
+    def test_prepares_once_per_connection(self):
+        conn = FakePreparingConnection(self.blocks)
+        geocoder = LocalGeocoder(conn, prepared=True)
+        first = geocoder.geocode('228 S BROADWAY AVE')
+        prepared = len(self.prepares(conn))
+        self.assertTrue(prepared)
+        second = geocoder.geocode('230 S Broadway Ave')
+        self.assertEqual(len(self.prepares(conn)), prepared)
+        self.assertEqual(first.address, LocalGeocoder(FakeBlocksConnection(self.blocks)).geocode('228 S BROADWAY AVE').address)
+        self.assertEqual(second.address, '230 S BROADWAY AVE')
+
+        other = FakePreparingConnection(self.blocks)
+        geocoder.cxn = other
+        geocoder.geocode('228 S BROADWAY AVE')
+        self.assertEqual(len(self.prepares(other)), prepared)
+
+    def test_warm_up(self):
+        conns = []
+        def connect():
+            conns.append(FakePreparingConnection(self.blocks))
+            return conns[-1]
+        pool = ConnectionPool(connect, min_size=2, max_size=2, health_check=None)
+        geocoder = LocalGeocoder(pool, prepared=True)
+        geocoder.warm_up()
+        self.assertEqual(len(conns), 2)
+        warmed = len(self.prepares(conns[0]))
+        self.assertEqual(len(self.prepares(conns[1])), warmed)
+        self.assertEqual(geocoder.geocode('228 S BROADWAY AVE').address, '228 S BROADWAY AVE')
+        self.assertEqual(len(self.prepares(conns[0])) + len(self.prepares(conns[1])), 2 * warmed)
+        self.assertEqual(pool.idle and len(pool.idle), 2)
+
+    def test_warm_up_unprepared(self):
+        conn = FakePreparingConnection(self.blocks)
+        LocalGeocoder(conn).warm_up()
+        self.assertEqual(conn.queries, [])
+
+class StreetSpellingCorrectorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.spelling = StreetSpellingCorrector([('BROADWAY', 12), ('BROADWELL', 1), ('ELM', 3), ('2ND', 4), ('22ND', 2), ('MADISON', 5)])
+
+    def test_corrects(self):
+        self.assertEqual(self.spelling.correct('Brodway').correct, 'BROADWAY')
+        self.assertEqual(self.spelling.correct('BRAODWAY').correct, 'BROADWAY')
+        self.assertEqual(self.spelling.correct('MADSION').incorrect, 'MADSION')
+
+    def test_prefers_closest_then_most_blocks(self):
+        self.assertEqual(self.spelling.correct('BROADWEL').correct, 'BROADWELL')
+        self.assertEqual(StreetSpellingCorrector([('AB', 1), ('ABCDEFX', 1), ('ABCDEFY', 3)]).correct('ABCDEFZ').correct, 'ABCDEFY')
+
+    def test_no_correction(self):
+        self.assertRaises(SpellingCorrector.DoesNotExist, self.spelling.correct, 'BROADWAY')
+        self.assertRaises(SpellingCorrector.DoesNotExist, self.spelling.correct, 'STATE')
+        self.assertRaises(SpellingCorrector.DoesNotExist, self.spelling.correct, 'ELK')
+        self.assertRaises(SpellingCorrector.DoesNotExist, self.spelling.correct, '32ND')
+        self.assertEqual(self.spelling.spell('STATE'), 'STATE')
+
+    def test_memoized(self):
+        self.spelling.correct('BRODWAY')
+        self.spelling.index = {}
+        self.assertEqual(self.spelling.correct('BRODWAY').correct, 'BROADWAY')
+        self.assertRaises(SpellingCorrector.DoesNotExist, self.spelling.correct, 'STATE')
+
+    def test_from_connection(self):
+        conn = FakeConnection([('BROADWAY', 12), ('ELM', 3)])
+        self.assertEqual(StreetSpellingCorrector.from_connection(conn).correct('BROADWYA').correct, 'BROADWAY')
+
+    def test_from_pipe_file(self):
+        spelling = StreetSpellingCorrector.from_pipe_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blocks.txt.gz'))
+        self.assertEqual(spelling.correct('WASHINGTN').correct, 'WASHINGTON')
+
+    def test_geocoder_fallback(self):
+        line = 'SRID=4326;LINESTRING(-87.6 41.0,-87.6 41.1)'
+        conn = FakeBlocksConnection({'BROADWAY': [(1, 'BROADWAY AVE', 200, 298, 200, 298, 201, 299, line) + BROADWAY]})
+        self.assertRaises(DoesNotExist, LocalGeocoder(conn).geocode, '228 S BRODWAY AVE')
+        for whole_streets in (False, True):
+            geocoder = LocalGeocoder(conn, whole_streets=whole_streets, spelling=self.spelling)
+            self.assertEqual(geocoder.geocode('228 S BRODWAY AVE').address, '228 S BROADWAY AVE')
+
+class StreetAutocompleteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.streets = StreetAutocomplete([
+            ('S', 'BROADWAY', 'AVE', None, 12),
+            ('N', 'BROADWAY', 'AVE', None, 4),
+            (None, 'BROADWELL', 'ST', None, 1),
+            ('', 'BROAD', 'ST', '', 7),
+            (None, 'BROAD', 'ST', None, 1),
+            (None, 'MADISON', 'ST', 'W', 3),
+        ], top_k=3)
+
+    def test_most_blocks_first(self):
+        self.assertEqual(self.streets.complete('broa'), ['S BROADWAY AVE', 'BROAD ST', 'N BROADWAY AVE'])
+        self.assertEqual(self.streets.complete('broa', limit=1), ['S BROADWAY AVE'])
+        self.assertEqual(self.streets.complete('BROADW'), ['S BROADWAY AVE', 'N BROADWAY AVE', 'BROADWELL ST'])
+
+    def test_variants(self):
+        self.assertEqual(self.streets.complete('South Broad'), ['S BROADWAY AVE'])
+        self.assertEqual(self.streets.complete('s. broadway avenu'), ['S BROADWAY AVE'])
+        self.assertEqual(self.streets.complete('madison street west'), ['MADISON ST W'])
+        self.assertEqual(self.streets.complete('broadway av'), ['S BROADWAY AVE', 'N BROADWAY AVE'])
+
+    def test_no_completions(self):
+        self.assertEqual(self.streets.complete('BROADX'), [])
+        self.assertEqual(self.streets.complete('STATE'), [])
+        self.assertEqual(self.streets.complete('BROAD ST X'), [])
+
+    def test_finished_word(self):
+        self.assertEqual(self.streets.complete('broad '), ['BROAD ST'])
+
+    def test_from_connection(self):
+        conn = FakeConnection([('S', 'BROADWAY', 'AVE', None, 12)])
+        self.assertEqual(StreetAutocomplete.from_connection(conn).complete('BRO'), ['S BROADWAY AVE'])
+        self.assertTrue('group by' in conn.queries[0])
+
+    def test_from_pipe_file(self):
+        streets = StreetAutocomplete.from_pipe_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blocks.txt.gz'))
+        self.assertEqual(streets.complete('washington st', limit=1), ['WASHINGTON ST'])
+
+class GeometryTestCase(unittest.TestCase):
+    def test_matches_postgis(self):
+        # The example of ST_LineInterpolatePoint() in the PostGIS manual.
+        x, y = line_interpolate_point('LINESTRING(25 50, 100 125, 150 190)', 0.2)
+        self.assertAlmostEqual(x, 51.5974135047432, 9)
+        self.assertAlmostEqual(y, 76.5974135047432, 9)
+
+    def test_ends(self):
+        line = [(0.0, 0.0), (3.0, 4.0)]
+        self.assertEqual(interpolate_point(line, 0), (0.0, 0.0))
+        self.assertEqual(interpolate_point(line, 1), (3.0, 4.0))
+        self.assertEqual(interpolate_point(line, -0.5), (0.0, 0.0))
+        self.assertEqual(interpolate_point(line, 1.5), (3.0, 4.0))
+        self.assertEqual(interpolate_point([(1.0, 2.0)], 0.5), (1.0, 2.0))
+
+    def test_repeated_vertices(self):
+        self.assertEqual(interpolate_point([(0.0, 0.0), (0.0, 0.0), (0.0, 10.0), (0.0, 10.0)], 0.5), (0.0, 5.0))
+        self.assertEqual(interpolate_point([(1.0, 1.0), (1.0, 1.0)], 0.5), (1.0, 1.0))
+
+    def test_parse_line(self):
+        self.assertEqual(parse_line('SRID=4326;LINESTRING Z (1 2 3, 4 5 6)'), [(1.0, 2.0), (4.0, 5.0)])
+        self.assertRaises(GeometryParsingException, parse_line, 'SRID=4326;POINT(1 2)')
+        self.assertRaises(GeometryParsingException, parse_line, 'LINESTRING(1, 2 3)')
+
+    def test_search_interpolates_without_a_query(self):
+        line = 'SRID=4326;LINESTRING(-87.6 41.0,-87.6 41.1)'
+        conn = FakeBlocksConnection({'BROADWAY': [(1, 'BROADWAY AVE', 200, 300, 200, 300, 201, 299, line) + BROADWAY]})
+        blocks = PostgisBlockSearcher(conn).search(street='BROADWAY', number='250')
+        self.assertEqual(len(conn.queries), 1)
+        self.assertAlmostEqual(blocks[0].location[0], -87.6, 9)
+        self.assertAlmostEqual(blocks[0].location[1], 41.05, 9)
+
+class GeometryTransferTestCase(unittest.TestCase):
+    line = [(-87.6, 41.0), (-87.6, 41.1)]
+
+    def test_wkb(self):
+        self.assertEqual(parse_wkb_line(buffer(struct.pack('<BII4d', 1, 2, 2, -87.6, 41.0, -87.6, 41.1))), self.line)
+        self.assertEqual(parse_wkb_line(struct.pack('>BII4d', 0, 2, 2, -87.6, 41.0, -87.6, 41.1)), self.line)
+
+    def test_wkb_z_and_srid(self):
+        # EWKB, with an SRID and Z values.
+        ewkb = struct.pack('<BIII6d', 1, 0xA0000002, 4326, 2, -87.6, 41.0, 180.0, -87.6, 41.1, 181.0)
+        self.assertEqual(parse_wkb_line(ewkb), self.line)
+        # ISO WKB, with Z and M values.
+        iso = struct.pack('<BII8d', 1, 3002, 2, -87.6, 41.0, 180.0, 0.0, -87.6, 41.1, 181.0, 1.0)
+        self.assertEqual(parse_wkb_line(iso), self.line)
+
+    def test_bad_wkb(self):
+        self.assertRaises(GeometryParsingException, parse_wkb_line, struct.pack('<BI2d', 1, 1, -87.6, 41.0))
+        self.assertRaises(GeometryParsingException, parse_wkb_line, struct.pack('<BII2d', 1, 2, 2, -87.6, 41.0))
+
+    def test_search_decodes_wkb(self):
+        wkb = buffer(struct.pack('<BII4d', 1, 2, 2, -87.6, 41.0, -87.6, 41.1))
+        conn = FakeBlocksConnection({'BROADWAY': [(1, 'BROADWAY AVE', 200, 300, 200, 300, 201, 299, wkb) + BROADWAY]})
+        block, = PostgisBlockSearcher(conn).search(street='BROADWAY', number='250')
+        self.assertTrue('ST_AsBinary(geom)' in conn.queries[0])
+        self.assertAlmostEqual(block.location[1], 41.05, 9)
+        geocoder = LocalGeocoder(conn, whole_streets=True)
+        self.assertAlmostEqual(geocoder.geocode('250 S BROADWAY AVE').point[1], 41.05, 9)
+
+    def test_intersection_coordinates(self):
+        conn = FakeConnection([(7, 'N DAMEN AVE & W DIVERSEY PKWY', -87.68, 41.93)])
+        intersection, = PostgisIntersectionSearcher(conn).search(street_a='DAMEN', street_b='DIVERSEY')
+        self.assertTrue('ST_X(location), ST_Y(location)' in conn.queries[0])
+        self.assertEqual(intersection.location, (-87.68, 41.93))
+        self.assertEqual(intersection.ewkt, 'SRID=4326;POINT(-87.68 41.93)')
+
+    def test_parse_point(self):
+        self.assertEqual(parse_point('SRID=4326;POINT(-87 41)'), (-87.0, 41.0))
+        self.assertEqual(parse_point('POINT Z (1e-3 2.5 7)'), (0.001, 2.5))
+        self.assertEqual(IntersectionResult((1, 'X', 'SRID=4326;POINT(-87 41)')).ewkt, 'SRID=4326;POINT(-87 41)')
+
+    def test_point_parsing_exception_from_postgis(self):
+        import postgis, results
+        self.assertTrue(postgis.PointParsingException is results.PointParsingException)
+        self.assertRaises(postgis.PointParsingException, parse_point, 'LINESTRING(1 2,3 4)')
+
+class HeldBackend(GeocoderBackend):
+    """
+    Holds on to every lookup until release() is called.
+    """
+    def __init__(self):
+        self.held = []
+    def search_blocks(self, filters, callback):
+        self.held.append(callback)
+    def release(self):
+        held, self.held = self.held, []
+        for callback in held:
+            callback([], None)
+
+class RaisingBackend(GeocoderBackend):
+    """
+    Fails to start every lookup, as a ThreadPoolBackend does once it's closed.
+    """
+    def search_blocks(self, filters, callback):
+        raise RuntimeError('Backend is closed')
+
+class AsyncGeocoderTestCase(unittest.TestCase):
+    line = 'SRID=4326;LINESTRING(-87.6 41.0,-87.6 41.1)'
+
+    def setUp(self):
+        block = (1, 'BROADWAY AVE', 200, 298, 200, 298, 201, 299)
+        self.backend = MemoryBackend(
+            blocks={'BROADWAY': [BlockResult(block, 'SRID=4326;POINT(-87.6 41.05)')]},
+            intersections={frozenset(['DAMEN', 'DIVERSEY']): [
+                IntersectionResult((7, 'N DAMEN AVE & W DIVERSEY PKWY', 'SRID=4326;POINT(-87.68 41.93)')),
+                IntersectionResult((7, 'N DAMEN AVE & W DIVERSEY PKWY', 'SRID=4326;POINT(-87.68 41.93)')),
+            ]})
+        self.geocoder = AsyncGeocoder(self.backend)
+
+    def test_address(self):
+        result = self.geocoder.geocode('228 S BROADWAY AVE').get(1)
+        self.assertEqual(result.address, '228 S BROADWAY AVE')
+        self.assertEqual(result.point, (-87.6, 41.05))
+        self.assertEqual(self.backend.lookups, 1)
+
+    def test_intersection(self):
+        result = self.geocoder.geocode('DAMEN AVE & DIVERSEY PKWY').get(1)
+        self.assertEqual(result.intersection_id, 7)
+        self.assertEqual(result.point, (-87.68, 41.93))
+        # Every pair of candidate streets, in one lookup.
+        self.assertEqual(self.backend.lookups, 1)
+
+    def test_errors(self):
+        self.assertRaises(DoesNotExist, self.geocoder.geocode('228 MAIN ST').get, 1)
+        self.assertRaises(ParsingError, self.geocoder.geocode('').get, 1)
+
+    def test_geocode_many(self):
+        outcomes = self.geocoder.geocode_many(['228 S BROADWAY AVE', '228 s broadway ave', '228 MAIN ST']).get(1)
+        self.assertTrue(outcomes[0][0] is outcomes[1][0])
+        self.assertTrue(isinstance(outcomes[2][1], DoesNotExist))
+
+    def test_concurrency_limit(self):
+        backend = HeldBackend()
+        geocoder = AsyncGeocoder(backend, max_concurrency=2)
+        futures = [geocoder.geocode('%d MAIN ST' % i) for i in range(3)]
+        self.assertEqual(len(backend.held), 2)
+        while backend.held:
+            backend.release()
+        for future in futures:
+            self.assertRaises(DoesNotExist, future.get, 1)
+
+    def test_timeout(self):
+        backend = HeldBackend()
+        geocoder = AsyncGeocoder(backend, timeout=0.01)
+        future = geocoder.geocode('228 MAIN ST')
+        self.assertRaises(GeocodeTimeout, future.get, 0.01)
+        time.sleep(0.02)
+        backend.release()
+        self.assertRaises(GeocodeTimeout, future.get, 1)
+        self.assertEqual(geocoder.running, 0)
+
+    def test_stalled_lookup_times_out(self):
+        backend = HeldBackend()
+        geocoder = AsyncGeocoder(backend, max_concurrency=1, timeout=0.05)
+        first = geocoder.geocode('228 MAIN ST')
+        queued = geocoder.geocode('230 MAIN ST')
+        # Neither waits on the stalled lookup past the deadline.
+        self.assertRaises(GeocodeTimeout, first.get, 5)
+        self.assertRaises(GeocodeTimeout, queued.get, 5)
+        self.assertEqual(geocoder.running, 0)
+        # So the next call gets a slot right away.
+        held = len(backend.held)
+        geocoder.geocode('232 MAIN ST')
+        self.assertEqual(geocoder.running, 1)
+        self.assertEqual(len(backend.held), held + 1)
+        # Late outcomes are ignored.
+        backend.release()
+        self.assertTrue(isinstance(first.error, GeocodeTimeout))
+
+    def test_backend_raises(self):
+        geocoder = AsyncGeocoder(RaisingBackend(), max_concurrency=1)
+        first = geocoder.geocode('228 MAIN ST')
+        self.assertRaises(RuntimeError, first.get, 1)
+        self.assertEqual(geocoder.running, 0)
+        # The slot was freed, so a later call runs rather than waiting.
+        self.assertRaises(RuntimeError, geocoder.geocode('230 MAIN ST').get, 1)
+        self.assertEqual(geocoder.running, 0)
+
+    def test_failing_done_callback(self):
+        logging.getLogger('async_geocoder').disabled = True
+        self.addCleanup(setattr, logging.getLogger('async_geocoder'), 'disabled', False)
+        called = []
+        def fail(f):
+            raise ValueError()
+        future = Future()
+        future.add_done_callback(fail)
+        future.add_done_callback(called.append)
+        future._finish('done')
+        self.assertEqual(called, [future])
+
+    def test_closed_thread_pool_backend(self):
+        pool = ConnectionPool(lambda: FakeBlocksConnection({}), min_size=0, max_size=1)
+        geocoder = AsyncGeocoder(ThreadPoolBackend(pool, workers=1), max_concurrency=1)
+        geocoder.close()
+        # Python 2.7's ThreadPool asserts it's running; later versions raise ValueError.
+        self.assertRaises(Exception, geocoder.geocode('228 S BROADWAY AVE').get, 1)
+        self.assertRaises(Exception, geocoder.geocode('230 S BROADWAY AVE').get, 1)
+        self.assertEqual(geocoder.running, 0)
+
+    def test_thread_pool_backend_intersection(self):
+        intersection = {'id': 3, 'pretty_name': 'N DAMEN AVE & W DIVERSEY PKWY', 'location': 'SRID=4326;POINT(-87.6785 41.9322)',
+                        'predir_a': 'N', 'street_a': 'DAMEN', 'suffix_a': 'AVE', 'postdir_a': None,
+                        'predir_b': 'W', 'street_b': 'DIVERSEY', 'suffix_b': 'PKWY', 'postdir_b': None}
+        conns = []
+        def connect():
+            conns.append(FakeIntersectionsConnection([intersection]))
+            return conns[-1]
+        geocoder = AsyncGeocoder(ThreadPoolBackend(ConnectionPool(connect, min_size=0, max_size=1), workers=1))
+        try:
+            result = geocoder.geocode('DAMEN AVE & DIVERSEY PKWY').get(5)
+            self.assertEqual((result.intersection_id, result.point), (3, (-87.6785, 41.9322)))
+            self.assertEqual(len(conns[0].queries), 1)
+        finally:
+            geocoder.close()
+
+    def test_thread_pool_backend(self):
+        pool = ConnectionPool(lambda: FakeBlocksConnection({'BROADWAY': [
+            (1, 'BROADWAY AVE', 200, 298, 200, 298, 201, 299, self.line) + BROADWAY]}), min_size=0, max_size=2)
+        geocoder = AsyncGeocoder(ThreadPoolBackend(pool, workers=2))
+        try:
+            futures = [geocoder.geocode('%d S BROADWAY AVE CHICAGO' % number) for number in (228, 230, 9999)]
+            self.assertEqual(futures[0].get(5).address, '228 S BROADWAY AVE')
+            self.assertEqual(futures[0].get(5).point, LocalGeocoder(pool).geocode('228 S BROADWAY AVE CHICAGO').point)
+            self.assertEqual(futures[1].get(5).address, '230 S BROADWAY AVE')
+            self.assertRaises(InvalidBlockButValidStreet, futures[2].get, 5)
+        finally:
+            geocoder.close()
+
+class StreetAddressGeocoderTestCase(unittest.TestCase):
+    def setUp(self):
+        line = 'SRID=4326;LINESTRING(-87.6 41.0,-87.6 41.1)'
+        self.conn = FakeBlocksConnection({'BROADWAY': [
+            (1, 'BROADWAY AVE', 200, 298, 200, 298, 201, 299, line) + BROADWAY,
+            (2, 'BROADWAY AVE', 300, 398, 300, 398, 301, 399, line) + BROADWAY,
+            (3, 'BROADWAY ST', 400, 498, 400, 498, 401, 499, line) + ('N', 'ST', None, 'EVANSTON', 'EVANSTON', 'IL', 'IL', '60201', '60201'),
+        ]})
+
+    def outcome(self, geocoder, location):
+        try:
+            result = geocoder.geocode(location)
+        except Exception, e:
+            return e.__class__.__name__, str(e)
+        return result.address, result.point
+
+    def test_same_outcomes(self):
+        for location in ('228 S BROADWAY AVE', '301 S BROADWAY AVE CHICAGO IL', '228 BROADWAY', '410 N BROADWAY ST',
+                         '410 N BROADWAY AVE', '9999 S BROADWAY AVE', '9999 S BROADWAY AVE CHICAGO', '228 MAIN ST'):
+            self.assertEqual(self.outcome(StreetAddressGeocoder(self.conn), location),
+                             self.outcome(PostgisAddressGeocoder(self.conn), location))
+
+    def test_one_query_per_street(self):
+        geocoder = LocalGeocoder(self.conn, whole_streets=True)
+        self.assertRaises(DoesNotExist, geocoder.geocode, '9999 S BROADWAY AVE')
+        self.assertEqual(len(self.conn.queries), len(set(loc['street'] for loc in parse('9999 S BROADWAY AVE') if loc['number'])))
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+
+class GeocoderCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.clock = Clock()
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def cache(self, **kwargs):
+        return GeocoderCache(self.filename, clock=self.clock, **kwargs)
+
+    def result(self, address, street='BROADWAY'):
+        return PostgisResult(address=address, city=None, state=None, zip=None,
+                             point=(-87.62451234567891, 41.87561234567891), streets=(street,))
+
+    def test_normalized_key(self):
+        cache = GeocoderCache()
+        result = self.result(u'228 S BROADWAY AVE')
+        cache.put('228 S. Broadway Ave', result)
+        self.assertTrue(cache.get('228 s broadway ave') is result)
+        self.assertEqual(cache.get('230 S BROADWAY AVE'), None)
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 1))
+
+    def test_persistent_round_trip(self):
+        cache = self.cache()
+        cache.put('228 S BROADWAY AVE', self.result(u'228 S BROADWAY AVE'))
+        cache.close()
+        result = self.cache().get('228 S BROADWAY AVE')
+        self.assertEqual(result.address, u'228 S BROADWAY AVE')
+        self.assertEqual(result.point, (-87.62451234567891, 41.87561234567891))
+        self.assertEqual(result.streets, (u'BROADWAY',))
+
+    def test_unstored_fields(self):
+        cache = self.cache()
+        result = self.result(u'228 S BROADWAY AVE')
+        result.block = result.intersection = object()
+        cache.put('228 S BROADWAY AVE', result)
+        result = self.cache().get('228 S BROADWAY AVE')
+        self.assertEqual((result.block, result.intersection), (None, None))
+
+    def test_used_interval(self):
+        cache = self.cache(used_interval=60)
+        cache.put('228 S BROADWAY AVE', self.result(u'228 S BROADWAY AVE'))
+        stored = self.clock.now
+        used = lambda: cache.db.execute('select used from geocoder_cache').fetchone()[0]
+        self.clock.now += 30
+        self.assertNotEqual(self.cache(used_interval=60).get('228 S BROADWAY AVE'), None)
+        self.assertEqual(used(), stored)
+        self.clock.now += 31
+        self.assertNotEqual(self.cache(used_interval=60).get('228 S BROADWAY AVE'), None)
+        self.assertEqual(used(), self.clock.now)
+
+    def test_ttl(self):
+        cache = self.cache(ttl=60)
+        cache.put('228 S BROADWAY AVE', self.result(u'228 S BROADWAY AVE'))
+        cache.put('230 S BROADWAY AVE', self.result(u'230 S BROADWAY AVE'), ttl=600)
+        self.clock.now += 61
+        self.assertEqual(cache.get('228 S BROADWAY AVE'), None)
+        self.assertEqual(self.cache().get('228 S BROADWAY AVE'), None)
+        self.assertNotEqual(cache.get('230 S BROADWAY AVE'), None)
+
+    def test_max_rows(self):
+        cache = self.cache(max_entries=1, max_rows=2)
+        for number in (1, 2, 3):
+            cache.put('%d MAIN ST' % number, self.result(u'%d MAIN ST' % number, 'MAIN'))
+            self.clock.now += 1
+        self.assertEqual(cache.stats()['rows'], 2)
+        self.assertEqual(cache.get('1 MAIN ST'), None)
+        self.assertNotEqual(cache.get('2 MAIN ST'), None)
+
+    def test_invalidate_street(self):
+        cache = self.cache()
+        cache.put('228 S BROADWAY AVE', self.result(u'228 S BROADWAY AVE'))
+        cache.put('1 MAIN ST', self.result(u'1 MAIN ST', 'MAIN'))
+        self.assertEqual(cache.invalidate_street('BROADWAY'), 1)
+        self.assertEqual(cache.get('228 S BROADWAY AVE'), None)
+        self.assertNotEqual(cache.get('1 MAIN ST'), None)
+
+    def test_local_geocoder(self):
+        conn = FakeBlocksConnection({'BROADWAY': [
+            (1, 'BROADWAY AVE', 200, 298, 200, 298, 201, 299, 'SRID=4326;LINESTRING(-87.6 41.0,-87.6 41.1)') + BROADWAY]})
+        geocoder = LocalGeocoder(conn, cache=self.cache())
+        first = geocoder.geocode('228 S BROADWAY AVE')
+        queries = len(conn.queries)
+        self.assertTrue(geocoder.geocode('228 s. broadway ave') is first)
+        self.assertEqual(geocoder.geocode_many(['228 S BROADWAY AVE', '230 S BROADWAY AVE'])[0][0], first)
+        self.assertEqual(LocalGeocoder(None, cache=self.cache()).geocode('230 S BROADWAY AVE').address, '230 S BROADWAY AVE')
+        self.assertEqual(len(conn.queries), queries + 1)
+
+class NegativeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.clock = Clock()
+        self.conn = FakeBlocksConnection({'BROADWAY': [
+            (1, 'BROADWAY AVE', 200, 298, 200, 298, 201, 299, 'SRID=4326;LINESTRING(-87.6 41.0,-87.6 41.1)') + BROADWAY]})
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def cache(self, **kwargs):
+        return GeocoderCache(self.filename, clock=self.clock, ttl=3600, negative_ttl=60, **kwargs)
+
+    def test_failures_cached_by_type(self):
+        geocoder = LocalGeocoder(self.conn, cache=self.cache())
+        for location, error in (('228 MAIN ST', DoesNotExist), ('', ParsingError), ('9999 S BROADWAY AVE CHICAGO', InvalidBlockButValidStreet)):
+            self.assertRaises(error, geocoder.geocode, location)
+            queries = len(self.conn.queries)
+            self.assertRaises(error, geocoder.geocode, location)
+            self.assertRaises(error, LocalGeocoder(None, cache=self.cache()).geocode, location)
+            self.assertEqual(len(self.conn.queries), queries)
+        stats = geocoder.cache.stats()
+        self.assertEqual((stats['hits'], stats['negative_hits'], stats['misses']), (0, 3, 3))
+
+    def test_ambiguous_choices_round_trip(self):
+        choices = [PostgisResult(address=u'1 STATE ST', point=(1.0, 2.0)), PostgisResult(address=u'1 STATE AVE', point=(3.0, 4.0))]
+        self.cache().put_error('1 STATE', AmbiguousResult(choices))
+        result, error = self.cache().lookup('1 STATE')
+        self.assertTrue(isinstance(error, AmbiguousResult))
+        self.assertEqual([choice.point for choice in error.choices], [(1.0, 2.0), (3.0, 4.0)])
+
+    def test_shorter_ttl(self):
+        cache = self.cache()
+        geocoder = LocalGeocoder(self.conn, cache=cache)
+        geocoder.geocode_many(['228 MAIN ST', '228 S BROADWAY AVE'])
+        self.clock.now += 61
+        self.assertEqual(cache.lookup('228 MAIN ST'), None)
+        self.assertNotEqual(cache.lookup('228 S BROADWAY AVE'), None)
+
+    def test_timeouts_not_cached(self):
+        cache = self.cache()
+        cache.put_error('228 MAIN ST', GeocodeTimeout('slow'))
+        self.assertEqual(cache.lookup('228 MAIN ST'), None)
+
+    def test_invalidate_street(self):
+        cache = self.cache()
+        cache.put_error('228 MAIN ST', DoesNotExist('228 MAIN ST'))
+        self.assertEqual(cache.invalidate_street('MAIN'), 1)
+        self.assertEqual(self.cache().lookup('228 MAIN ST'), None)
+
+class FakeIntersectionsCursor(FakeCursor):
+    """
+    Answers search_pairs() queries from the connection's intersections, and
+    PREPARE and EXECUTE of them as Postgres would.
+    """
+    def execute(self, query, params=None):
+        self.conn.queries.append(query)
+        words = query.split(None, 3)
+        if words[0] == 'PREPARE':
+            self.conn.prepared[words[1]] = re.sub(r'\$\d+', '%s', words[3])
+            return
+        if words[0] == 'EXECUTE':
+            query = self.conn.prepared[words[1]]
+        width = len(INTERSECTION_FIELDS) + 1
+        self.rows = []
+        for start in range(0, len(params), width):
+            if params[start] is None:
+                # Padding, which v.n is not null drops.
+                continue
+            pair = dict(zip(INTERSECTION_FIELDS, params[start + 1:start + width]))
+            for columns in self.conn.intersections:
+                if 'street_lo=least' in query and sorted([pair['street_a'], pair['street_b']]) != sorted([columns['street_a'], columns['street_b']]):
+                    continue
+                if all([pair[field] is None or pair[field] in (columns[field[:-2] + '_a'], columns[field[:-2] + '_b'])
+                        for field in INTERSECTION_FIELDS]):
+                    self.rows.append((params[start], columns['id'], columns['pretty_name']) + parse_point(columns['location']))
+    def fetchall(self):
+        return self.rows
+
+class FakeIntersectionsConnection(FakeConnection):
+    def __init__(self, intersections):
+        FakeConnection.__init__(self)
+        self.intersections = intersections
+        self.prepared = {}
+    def cursor(self):
+        return FakeIntersectionsCursor(self)
+
+class CountingCorrector(SpellingCorrector):
+    def __init__(self):
+        self.corrected = []
+    def correct(self, incorrect):
+        self.corrected.append(incorrect)
+        return SpellingCorrector.correct(self, incorrect)
+
+class IntersectionGeocoderTestCase(unittest.TestCase):
+    def intersection(self, id, predir_a, street_a, suffix_a, predir_b, street_b, suffix_b, location):
+        return {'id': id, 'pretty_name': '%s %s %s & %s %s %s' % (predir_a, street_a, suffix_a, predir_b, street_b, suffix_b),
+                'predir_a': predir_a, 'street_a': street_a, 'suffix_a': suffix_a, 'postdir_a': None,
+                'predir_b': predir_b, 'street_b': street_b, 'suffix_b': suffix_b, 'postdir_b': None, 'location': location}
+
+    def setUp(self):
+        self.conn = FakeIntersectionsConnection([
+            self.intersection(1, 'N', 'STATE', 'ST', 'W', 'MADISON', 'ST', 'SRID=4326;POINT(-87.6277 41.8820)'),
+            self.intersection(2, 'S', 'STATE', 'ST', 'E', 'MADISON', 'ST', 'SRID=4326;POINT(-87.6276 41.8819)'),
+            self.intersection(3, 'N', 'DAMEN', 'AVE', 'W', 'DIVERSEY', 'PKWY', 'SRID=4326;POINT(-87.6785 41.9322)'),
+        ])
+        self.geocoder = PostgisIntersectionGeocoder(self.conn)
+        self.geocoder.spelling = CountingCorrector()
+
+    def test_one_query(self):
+        result = self.geocoder.geocode('DAMEN AVE & DIVERSEY PKWY')
+        self.assertEqual(result.intersection_id, 3)
+        self.assertEqual(result.point, (-87.6785, 41.9322))
+        self.assertEqual(len(self.conn.queries), 1)
+
+    def test_ambiguous_deduplicated(self):
+        try:
+            self.geocoder.geocode('STATE & MADISON')
+        except AmbiguousResult, e:
+            self.assertEqual([choice.intersection_id for choice in e.choices], [1, 2])
+        else:
+            self.fail('STATE & MADISON should be ambiguous')
+        self.assertEqual(len(self.conn.queries), 1)
+
+    def test_corrections_memoized(self):
+        self.geocoder.geocode('N STATE ST & W MADISON ST')
+        corrected = self.geocoder.spelling.corrected
+        self.assertEqual(len(corrected), len(set(corrected)))
+
+    def test_does_not_exist(self):
+        self.assertRaises(DoesNotExist, self.geocoder.geocode, 'DAMEN AVE & MADISON ST')
+
+    def test_street_pair_key(self):
+        geocoder = PostgisIntersectionGeocoder(self.conn, street_pair_key=True)
+        for location in ('DAMEN AVE & DIVERSEY PKWY', 'DIVERSEY PKWY & DAMEN AVE'):
+            self.assertEqual(geocoder.geocode(location).intersection_id, 3)
+        self.assertTrue('i.street_lo=least(v.street_a, v.street_b) and i.street_hi=greatest(v.street_a, v.street_b)' in self.conn.queries[0])
+        self.assertFalse('v.street_a is null' in self.conn.queries[0])
+        self.assertRaises(DoesNotExist, geocoder.geocode, 'DAMEN AVE & MADISON ST')
+
+    def test_prepared(self):
+        geocoder = LocalGeocoder(self.conn, prepared=True)
+        geocoder.warm_up()
+        prepared = len(self.conn.prepared)
+        # Three, and nine, pairs of parsed streets: padded to four and sixteen.
+        for location in ('DAMEN & DIVERSEY PKWY', 'DAMEN AVE & DIVERSEY PKWY'):
+            self.assertEqual(geocoder.geocode(location).intersection_id, 3)
+            self.assertTrue(self.conn.queries[-1].startswith('EXECUTE '))
+        try:
+            geocoder.geocode('STATE & MADISON')
+        except AmbiguousResult, e:
+            self.assertEqual([choice.intersection_id for choice in e.choices], [1, 2])
+        else:
+            self.fail('STATE & MADISON should be ambiguous')
+        # warm_up() prepared every query that was executed.
+        self.assertEqual(len(self.conn.prepared), prepared)
+
+    def test_pairs_query_padding(self):
+        searcher = PostgisIntersectionSearcher(None)
+        query, params = searcher._pairs_query([{'street_a': 'DAMEN', 'street_b': 'DIVERSEY'}], 4)
+        self.assertEqual(query.count('(%s::int, '), 4)
+        self.assertEqual(len(params), 4 * (len(INTERSECTION_FIELDS) + 1))
+        self.assertEqual(params[len(INTERSECTION_FIELDS) + 1:], [None] * 3 * (len(INTERSECTION_FIELDS) + 1))
+        self.assertTrue(' on v.n is not null and ' in query)
+
+    def test_street_pair_key_query(self):
+        searcher = PostgisIntersectionSearcher(None, street_pair_key=True)
+        query, params = searcher._intersection_query(street_a='DIVERSEY', street_b='DAMEN', suffix_b='AVE')
+        self.assertTrue(query.endswith(' where street_lo=least(%s, %s) and street_hi=greatest(%s, %s) and (suffix_a=%s OR suffix_b=%s)'))
+        self.assertEqual(params, ['DIVERSEY', 'DAMEN', 'DIVERSEY', 'DAMEN', 'AVE', 'AVE'])
+        # With one street, there's no pair to look up.
+        query, params = searcher._intersection_query(street_a='DAMEN')
+        self.assertTrue(query.endswith(' where (street_a=%s OR street_b=%s)'))
+
+class AdvisorTestCase(unittest.TestCase):
+    def plan(self, scan='Seq Scan', cost=1500.0):
+        return {'Plan': {'Node Type': 'Sort', 'Total Cost': cost + 10, 'Actual Total Time': 2.5, 'Shared Hit Blocks': 0,
+                         'Plans': [{'Node Type': scan, 'Relation Name': 'blocks', 'Total Cost': cost,
+                                    'Shared Hit Blocks': 30, 'Shared Read Blocks': 12}]}}
+
+    def test_query_shapes(self):
+        shapes = advisor.query_shapes()
+        names = [shape.name for shape in shapes]
+        self.assertEqual(len(names), len(set(names)))
+        self.assertEqual(len(shapes), 1 + 2 ** 7 + 2 ** 6 + 1)
+        self.assertEqual(len(advisor.query_shapes(street_pair_key=True)), 1 + 2 ** 7 + 2 * (2 ** 6 + 1))
+        for shape in advisor.query_shapes(street_pair_key=True):
+            values = dict([(field, 'X') for field in shape.fields])
+            for query, params in shape.queries([values, values]):
+                self.assertEqual(query.count('%s'), len(params))
+                self.assertTrue(shape.table in query)
+
+    def test_plan_summary(self):
+        summary = advisor.plan_summary(self.plan(), 1000.0)
+        self.assertEqual(summary['seq_scans'], ['blocks'])
+        self.assertEqual(summary['costly'], ['Seq Scan (cost 1500)'])
+        self.assertEqual(summary['buffers'], 42)
+        self.assertEqual(summary['time'], 2.5)
+        summary = advisor.plan_summary(self.plan('Index Scan', 8.0), 1000.0)
+        self.assertEqual((summary['seq_scans'], summary['costly']), ([], []))
+
+    def test_recommend(self):
+        shapes = advisor.query_shapes()
+        summaries = {'search(street)': advisor.plan_summary(self.plan(), 1000.0),
+                     'search(street, pre_dir, number)': advisor.plan_summary(self.plan(), 1000.0)}
+        self.assertEqual(advisor.recommend(shapes, summaries, {}),
+                         ['CREATE INDEX blocks_street_predir_from_num_idx ON blocks (street, predir, from_num);'])
+        self.assertEqual(advisor.recommend(shapes, summaries, {'blocks': [('street', 'predir', 'from_num', 'to_num')]}), [])
+
+    def test_regressions(self):
+        baseline = {'search(street)': advisor.plan_summary(self.plan('Index Scan', 8.0), 1000.0)}
+        found = advisor.regressions(baseline, {'search(street)': advisor.plan_summary(self.plan(), 1000.0),
+                                               'search(street, city)': advisor.plan_summary(self.plan(), 1000.0)}, 2.0)
+        self.assertEqual(found, [('search(street)', 'now scans blocks sequentially'),
+                                 ('search(street)', 'estimated cost rose from 18.0 to 1510.0')])
+        self.assertEqual(advisor.regressions(baseline, baseline, 2.0), [])
+
+    def test_report(self):
+        out = StringIO()
+        shapes = advisor.query_shapes()
+        self.assertTrue(advisor.report(out, shapes, {'search(street)': advisor.plan_summary(self.plan(), 1000.0)}, {}))
+        self.assertTrue(out.getvalue().startswith('search(street): cost 1510.0, 2.50 ms, 42 buffers: seq scan on blocks'))
+        self.assertTrue('CREATE INDEX blocks_street_idx ON blocks (street);' in out.getvalue())
+        self.assertFalse(advisor.report(StringIO(), shapes, {}, {}))
+
+class MigrationsTestCase(unittest.TestCase):
+    def test_applies_once(self):
+        conn = FakeConnection()
+        self.assertEqual(migrations.migrate(conn), ['intersections_street_pair'])
+        self.assertTrue(migrations.STREET_PAIR_KEY[-1] in conn.queries)
+        self.assertTrue(conn.queries[-1].startswith('INSERT INTO djeocoder_migrations'))
+
+        conn = FakeConnection([('intersections_street_pair',)])
+        self.assertEqual(migrations.migrate(conn), [])
+        self.assertFalse(migrations.STREET_PAIR_KEY[0] in conn.queries)
+
+if __name__ == "__main__":
+    unittest.main()
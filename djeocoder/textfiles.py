@@ -10,14 +10,14 @@ def line_generator(inf):
 
 class PipeFileLoader(object):
     def __init__(self, filename):
-		if filename.endswith('.gz'):
-			inf = gzip.open(filename, 'r')
-		else:
-			inf = open(filename, 'r')
+        if filename.endswith('.gz'):
+            inf = gzip.open(filename, 'r')
+        else:
+            inf = open(filename, 'r')
         self.rows = []
         self.column_names = []
         self.columns = {}
-		for line in line_generator(inf):
+        for line in line_generator(inf):
             self.rows.append([x.strip() for x in line.split('|')])
         inf.close()
     def row_as_dict(self, row):